@@ -0,0 +1,273 @@
+import argparse
+import json
+import logging
+import platform
+import random
+import resource
+import subprocess
+import time
+from typing import Callable, Dict, List, Tuple
+from pathlib import Path
+
+import numpy as np
+
+from game import logger
+from game.status import Side, statuses
+from game.unit import Unit
+from game.team import Team
+from game.log import TurnLogs
+from game.turn import Turn
+from game.battle import Battle
+from game.batch import BatchBattle
+from game.env import BattleEnv
+from game.command import AttackCommand
+from game.event import events, PhaseTimer
+from game.gambit import Gambit, NaiveGambit, CunningGambit, MLbasedGambit
+
+
+class TimedGambit(Gambit):
+    """
+    select_command の呼び出し回数と所要時間を計測する
+    """
+
+    def __init__(self, gambit: Gambit):
+        self.gambit = gambit
+        self.count = 0
+        self.seconds = 0.0
+
+    def reset(self, teams: List[Team]):
+        self.gambit.reset(teams)
+
+    def select_command(self, source, units, commands):
+        start = time.perf_counter()
+        result = self.gambit.select_command(source, units, commands)
+        self.seconds += time.perf_counter() - start
+        self.count += 1
+        return result
+
+
+# チームあたりのユニット数（ステータスを繰り返して並べる）
+team_size = 3
+# バトルで使えるコマンドの名前
+commands = ('attack',)
+
+
+def make_teams() -> List[Team]:
+    return [
+        Team(side, [Unit(statuses[side][i % len(statuses[side])]) for i in range(team_size)])
+        for side in (Side.PLAYER, Side.MONSTER)
+    ]
+
+
+def repeat_for(func: Callable[[], None], seconds: float) -> Tuple[int, float]:
+    """
+    一定時間 func を繰り返し、(回数, 所要時間) を返す
+    """
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count, elapsed
+
+
+def bench_simulate(name: str, gambit: Gambit, n_battle: int, seed: int) -> Dict:
+    random.seed(seed)
+    teams = make_teams()
+    player = TimedGambit(gambit)
+    gambits = [player, NaiveGambit()]
+    logs = TurnLogs()
+
+    turns = 0
+    start = time.perf_counter()
+    for n in range(n_battle):
+        size = len(logs)
+        Battle(n, commands).simulate(teams, gambits, logs)
+        if len(logs) > size:
+            turns += int(logs.turn_id[-1])
+    elapsed = time.perf_counter() - start
+
+    log_bytes = sum(np.dtype(t).itemsize for t in TurnLogs.dtypes.values()) * len(logs)
+    return dict(
+        gambit=name,
+        battles_per_sec=n_battle / elapsed,
+        turns_per_sec=turns / elapsed,
+        hits_per_sec=len(logs) / elapsed,
+        decisions_per_sec=player.count / player.seconds if player.seconds else None,
+        log_bytes_per_battle=log_bytes / n_battle,
+    )
+
+
+def bench_batch(name: str, gambit: Gambit, n_battle: int, seed: int) -> Dict:
+    teams = make_teams()
+    logs = TurnLogs()
+    start = time.perf_counter()
+    BatchBattle(n_battle, seed).simulate(teams, [gambit, NaiveGambit()], logs)
+    elapsed = time.perf_counter() - start
+    return dict(
+        gambit=name,
+        battles_per_sec=n_battle / elapsed,
+        hits_per_sec=len(logs) / elapsed,
+    )
+
+
+def bench_env(n_env: int, seconds: float, seed: int) -> Dict:
+    # ランダムな行動で BattleEnv.step を繰り返す
+    env = BattleEnv(make_teams(), n_env=n_env, seed=seed)
+    observation = env.reset()
+    steps = episodes = 0
+
+    def step():
+        nonlocal observation, steps, episodes
+        observation, reward, done, info = env.step(env.sample_actions(observation))
+        steps += n_env
+        episodes += int(done.sum())
+
+    count, elapsed = repeat_for(step, seconds)
+    return dict(n_env=n_env, steps_per_sec=steps / elapsed, episodes_per_sec=episodes / elapsed)
+
+
+def bench_micro(seconds: float, seed: int) -> Dict:
+    random.seed(seed)
+    teams = make_teams()
+    gambits = [CunningGambit(), NaiveGambit()]
+    units = [u for team in teams for u in team.units]
+    command = AttackCommand()
+    logs: List = []
+
+    def proceed():
+        # 決着しないように毎回 HP を戻す
+        for team in teams:
+            team.reset()
+        Turn(1).proceed(teams, gambits, logs)
+        logs.clear()
+
+    def do():
+        units[3].life = units[3].life_max
+        command.do(1, 0, units[0], [units[3]], logs)
+        logs.clear()
+
+    count, elapsed = repeat_for(proceed, seconds)
+    result = dict(turn_proceed_per_sec=count / elapsed)
+    count, elapsed = repeat_for(do, seconds)
+    result['attack_do_per_sec'] = count / elapsed
+    return result
+
+
+def bench_training(n_battle: int, epochs: int, seed: int) -> Dict:
+    import tensorflow as tf
+    tf.logging.set_verbosity(tf.logging.ERROR)
+
+    logs = TurnLogs()
+    BatchBattle(n_battle, seed).simulate(make_teams(), [NaiveGambit(), NaiveGambit()], logs)
+
+    # 与ダメージの推定器で計測する
+    mask = logs.source_side == Side.PLAYER
+    chunk = (logs.source_atk[mask, np.newaxis].astype(np.float32),
+             logs.target_id[mask].astype(np.int32),
+             logs.damage[mask, np.newaxis].astype(np.float32))
+    reg = MLbasedGambit(is_training=True).estimators[1]
+
+    start = time.perf_counter()
+    reg.fit_stream(lambda: iter([chunk]), len(chunk[0]), epochs)
+    elapsed = time.perf_counter() - start
+    return dict(training_samples_per_sec=len(chunk[0]) * epochs / elapsed)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=str(Path(__file__).resolve().parent)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-q', '--quiet', action='count', default=0)
+    parser.add_argument('-n', '--n_battle', action='store', type=int, default=1000)
+    parser.add_argument('-s', '--seed', action='store', type=int, default=0)
+    parser.add_argument('--micro_seconds', action='store', type=float, default=1.0)
+    parser.add_argument('--ml', action='store_true', default=False,
+                        help='学習済みモデルで MLbasedGambit も計測する')
+    parser.add_argument('--training', action='store_true', default=False,
+                        help='Estimator の学習速度も計測する（TensorFlow が必要）')
+    parser.add_argument('--epochs', action='store', type=int, default=5)
+    parser.add_argument('--team_size', action='store', type=int, default=3,
+                        help='チームあたりのユニット数（大人数のバトルを計測する）')
+    parser.add_argument('--commands', action='store', default='attack',
+                        type=lambda s: tuple(s.split(',')),
+                        help='使えるコマンドの名前（例 attack,area,heal,buff）')
+    parser.add_argument('--env', action='store', type=int, default=0,
+                        help='この数の環境で BattleEnv.step も計測する')
+    parser.add_argument('-o', '--output', action='store', default=None)
+    args = parser.parse_args()
+    team_size = args.team_size
+    commands = args.commands
+
+    logging.basicConfig(level=logging.WARN + 10 * (args.quiet - args.verbose))
+
+    gambits: List[Tuple[str, Callable[[], Gambit]]] = [
+        ('Naive', NaiveGambit),
+        ('Cunning', CunningGambit),
+    ]
+    if args.ml:
+        gambits.append(('MLbased', MLbasedGambit))
+
+    results = dict(
+        revision=git_revision(),
+        python=platform.python_version(),
+        n_battle=args.n_battle,
+        team_size=args.team_size,
+        commands=list(args.commands),
+        seed=args.seed,
+        simulate=[],
+        batch=[],
+    )
+
+    for name, factory in gambits:
+        logger.info("# Simulate %s" % name)
+        result = bench_simulate(name, factory(), args.n_battle, args.seed)
+        results['simulate'].append(result)
+        print("%-8s %10.1f battles/s %10.1f turns/s %10.1f decisions/s %8.1f log bytes/battle" % (
+            name, result['battles_per_sec'], result['turns_per_sec'],
+            result['decisions_per_sec'], result['log_bytes_per_battle']))
+
+    for name, factory in gambits:
+        logger.info("# Batch %s" % name)
+        result = bench_batch(name, factory(), args.n_battle * 10, args.seed)
+        results['batch'].append(result)
+        print("%-8s %10.1f battles/s (batch)" % (name, result['battles_per_sec']))
+
+    # イベントフックでフェーズごとの時間を計測する
+    timer = events.attach(PhaseTimer())
+    bench_simulate('Cunning', CunningGambit(), args.n_battle, args.seed)
+    events.detach(timer)
+    results['phases'] = timer.report()
+    for phase, report in results['phases'].items():
+        if report['seconds']:
+            print("%-8s %10.1f /s (phase)" % (phase, report['per_sec']))
+
+    results['micro'] = bench_micro(args.micro_seconds, args.seed)
+    print("Turn.proceed %10.1f /s, AttackCommand.do %10.1f /s" % (
+        results['micro']['turn_proceed_per_sec'], results['micro']['attack_do_per_sec']))
+
+    if args.env > 0:
+        results['env'] = bench_env(args.env, args.micro_seconds, args.seed)
+        print("BattleEnv %10.1f steps/s %10.1f episodes/s (x%d)" % (
+            results['env']['steps_per_sec'], results['env']['episodes_per_sec'], args.env))
+
+    if args.training:
+        results['training'] = bench_training(args.n_battle, args.epochs, args.seed)
+        print("Estimator %10.1f samples/s" % results['training']['training_samples_per_sec'])
+
+    results['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("Peak memory %d KB" % results['max_rss_kb'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
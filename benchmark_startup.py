@@ -0,0 +1,76 @@
+import argparse
+import json
+import subprocess
+from pathlib import Path
+import sys
+
+# 計測対象のモジュール（シミュレーションだけなら TensorFlow は不要）
+MODULES = [
+    'game',
+    'game.battle',
+    'game.batch',
+    'game.gambit',
+    'game.runner',
+    'game.logfile',
+    'game.table',
+]
+
+# 読み込まれてはいけない重いモジュール
+FORBIDDEN = ['tensorflow', 'game.estimator']
+
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+for name in %r:
+    __import__(name)
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(
+    seconds=elapsed,
+    max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    loaded=[m for m in %r if m in sys.modules],
+)))
+"""
+
+
+def measure_import(modules, forbidden, repeat: int = 5) -> dict:
+    """
+    新しいプロセスで import にかかる時間とメモリを計測する
+    """
+    results = []
+    for _ in range(repeat):
+        out = subprocess.check_output(
+            [sys.executable, '-c', PROBE % (modules, forbidden)],
+            cwd=str(Path(__file__).resolve().parent))
+        results.append(json.loads(out))
+    return dict(
+        modules=modules,
+        seconds=min(r['seconds'] for r in results),
+        max_rss_kb=max(r['max_rss_kb'] for r in results),
+        loaded=sorted(set(m for r in results for m in r['loaded'])),
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', action='store', type=int, default=5)
+    parser.add_argument('--budget', action='store', type=float, default=1.0,
+                        help='許容する import 時間（秒）')
+    parser.add_argument('-o', '--output', action='store', default=None)
+    args = parser.parse_args()
+
+    result = measure_import(MODULES, FORBIDDEN, args.repeat)
+    result['budget'] = args.budget
+    print("import game: %.3f sec, max RSS %d KB" % (result['seconds'], result['max_rss_kb']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    failed = False
+    if result['loaded']:
+        print("NG: %s loaded at import time" % ', '.join(result['loaded']))
+        failed = True
+    if result['seconds'] > args.budget:
+        print("NG: import time exceeds budget %.3f sec" % args.budget)
+        failed = True
+    sys.exit(1 if failed else 0)
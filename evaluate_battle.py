@@ -1,33 +1,78 @@
 import argparse
 import logging
-from typing import List, Tuple, Counter as _Counter
+from typing import Callable, List, Tuple, Counter as _Counter
 from collections import Counter
-
-import tensorflow as tf
+from functools import partial
+from pathlib import Path
 
 from game import logger
-from game.status import Side, Status, statuses
+from game.status import Side, statuses
 from game.unit import Unit
 from game.team import Team
-from game.log import TurnLog
-from game.battle import Battle
-from game.gambit import Gambit, NaiveGambit, CunningGambit, MLbasedGambit
+from game.log import TurnLogs
+from game.event import events, LoggingListener
+from game.draws import RandomSource, PythonRandom, BlockRandom
+from game.batch import BatchBattle
+from game.command import COMMANDS
+from game.runner import BattleRunner, GambitFactory
+from game.solver import WinProbabilitySolver
+from game.evaluation import SequentialEvaluator
+from game.sweep import SweepConfig, default_roster, make_teams
+from game.gambit import Gambit, NaiveGambit, CunningGambit, MLbasedGambit, RolloutGambit
+from game.rules import RuleGambit
 
 
-def simulate_battle(teams: List[Team],
-                    gambits: List[Gambit],
-                    n_battle: int = 1000
-                    ) -> Tuple[_Counter[int], List[TurnLog]]:
-    win: _Counter[int] = Counter()
-    logs: List[TurnLog] = []
+# バトルの乱数の供給元
+random_sources = {'python': PythonRandom, 'block': BlockRandom}
 
-    # バトルを複数回シミュレーション
-    for n in range(0, n_battle):
-        battle = Battle(n)
-        result = battle.simulate(teams, gambits, logs)
-        win[result] += 1
 
-    return win, logs
+def simulate_battle(teams: List[Team],
+                    gambits: List[GambitFactory],
+                    n_battle: int = 1000,
+                    batch: bool = False,
+                    n_worker: int = 1,
+                    seed: int = 0,
+                    random_source: Callable[[], RandomSource] = PythonRandom,
+                    commands: Tuple[str, ...] = ('attack',)
+                    ) -> Tuple[_Counter[int], TurnLogs]:
+    # NumPy で一括シミュレーションする
+    if batch:
+        win: _Counter[int] = Counter()
+        logs = TurnLogs()
+        result = BatchBattle(n_battle, seed).simulate(teams, [g() for g in gambits], logs)
+        win.update(result.tolist())
+        return win, logs
+
+    # バトルをプロセス並列でシミュレーション
+    runner = BattleRunner(teams, gambits, seed=seed, n_worker=n_worker,
+                          random_source=random_source, commands=commands)
+    return runner.run(n_battle)
+
+
+def report(name: str, teams: List[Team], gambits: List[GambitFactory], args):
+    # 状態を網羅して勝率を厳密に求める
+    if args.exact:
+        solution = WinProbabilitySolver(teams, [g() for g in gambits]).solve()
+        print("Player(%s) win rate %7.5f%% (exact, unresolved %.1e)" % (
+            name, 100.0 * solution.win[Side.PLAYER], solution.unresolved))
+        return
+
+    # 信頼区間の半幅が precision 以下になるまで、チャンクごとにバトルを重ねる（-n は上限）
+    if args.precision > 0:
+        evaluator = SequentialEvaluator(teams, seed=args.seed, precision=args.precision,
+                                        max_battle=args.n_battle, batch=args.batch,
+                                        n_worker=args.n_worker)
+        print("Player(%s) win rate %s" % (name, evaluator.evaluate(gambits)))
+        if args.paired and gambits[Side.PLAYER] is not NaiveGambit:
+            # 同じ乱数で Naive と戦わせた場合との差
+            baseline = [NaiveGambit] + gambits[1:]
+            print("Player(%s) - Player(Naive) %s" % (name, evaluator.compare(gambits, baseline)))
+        return
+
+    win, logs = simulate_battle(teams, gambits, args.n_battle, args.batch,
+                                args.n_worker, args.seed, random_sources[args.random_source],
+                                args.commands)
+    print("Player(%s) win rate %7.5f%%" % (name, 100.0 * win[0] / sum(win.values())))
 
 
 if __name__ == '__main__':
@@ -35,15 +80,55 @@ if __name__ == '__main__':
     parser.add_argument('-v', '--verbose', action='count', default=0)
     parser.add_argument('-q', '--quiet', action='count', default=0)
     parser.add_argument('-d', '--debug', action='store_true', default=False)
-    parser.add_argument('-n', '--n_battle', action='store', default=1000)
+    parser.add_argument('-n', '--n_battle', action='store', type=int, default=1000)
+    parser.add_argument('-b', '--batch', action='store_true', default=False)
+    parser.add_argument('-j', '--n_worker', action='store', type=int, default=1)
+    parser.add_argument('-s', '--seed', action='store', type=int, default=0)
+    parser.add_argument('-e', '--embedding', action='store_true', default=False)
+    parser.add_argument('-m', '--multi_head', action='store_true', default=False)
+    parser.add_argument('-t', '--table', action='store', type=Path, default=None)
+    parser.add_argument('-x', '--exact', action='store_true', default=False,
+                        help='シミュレーションの代わりに、状態を網羅して勝率を厳密に求める')
+    parser.add_argument('-p', '--precision', action='store', type=float, default=0.0,
+                        help='信頼区間の半幅がこの値になるまでバトルを重ねる（-n は上限）')
+    parser.add_argument('--paired', action='store_true', default=False,
+                        help='同じ乱数で Naive との勝率の差も求める（--precision と使う）')
+    parser.add_argument('--random_source', action='store', default='python',
+                        choices=sorted(random_sources),
+                        help='バトルの乱数の供給元（block は NumPy でまとめて生成する）')
+    parser.add_argument('--commands', action='store', default='attack',
+                        type=lambda s: tuple(s.split(',')),
+                        help='使えるコマンドの名前（例 attack,area,heal,buff。%s から選ぶ）' % ','.join(COMMANDS))
+    parser.add_argument('--rules', action='store', type=Path, default=None,
+                        help='プレイヤーの行動ルールのファイル（例 "enemy.hp < 40 -> attack -> min(hp)"）')
+    parser.add_argument('-r', '--n_rollout', action='store', type=int, default=0,
+                        help='先読みする作戦のロールアウト回数（0 なら評価しない）')
+    parser.add_argument('--time_budget', action='store', type=float, default=None,
+                        help='先読みする作戦の1回の判断にかける秒数の上限')
     args = parser.parse_args()
+    if args.commands != ('attack',) and (args.batch or args.exact or args.precision > 0):
+        parser.error("--commands other than attack needs the scalar simulation "
+                     "(without --batch, --exact, --precision)")
+    unknown = [c for c in args.commands if c not in COMMANDS]
+    if unknown:
+        parser.error("unknown commands: %s" % ','.join(unknown))
+    # MLbased と Rollout は攻撃しかできないので、コマンドが複数なら評価しない
+    attack_only = set(args.commands) == {'attack'}
+    if args.n_rollout > 0 and not attack_only:
+        parser.error("--n_rollout supports only --commands attack")
 
     dbg_format = '%(levelname)-8s %(module)-16s %(lineno)4s: %(message)s'
     logging.basicConfig(
         level=logging.WARN + 10 * (args.quiet - args.verbose),
         format=dbg_format if args.debug else None
     )
-    tf.logging.set_verbosity(tf.logging.ERROR)
+    if logger.isEnabledFor(logging.DEBUG):
+        # バトルの経過はデバッグ時だけ出力する
+        events.attach(LoggingListener())
+    if args.table is None and attack_only:
+        # 参照テーブルを使わない場合だけ TensorFlow を読み込む
+        import tensorflow as tf
+        tf.logging.set_verbosity(tf.logging.ERROR)
 
     teams: List[Team] = [
         # プレイヤーチームのユニット構成
@@ -60,45 +145,58 @@ if __name__ == '__main__':
         ]),
     ]
 
-    gambits: List[Gambit] = [
+    gambits: List[GambitFactory] = [
         # プレイヤーの戦闘AI
-        NaiveGambit(),
+        NaiveGambit,
         # モンスターの戦闘AI
-        NaiveGambit(),
+        NaiveGambit,
     ]
 
     # バトルシミュレーション1 （プレイヤーの行動を、ランダムで決める）
-    win, logs = simulate_battle(teams, gambits, args.n_battle)
-    print("Player(Naive) win rate %7.5f%%" % (100.0 * win[0] / sum(win.values()),))
+    report("Naive", teams, gambits, args)
 
     # バトルシミュレーション2 （プレイヤーの行動を、チートして決める）
-    gambits[Side.PLAYER] = CunningGambit()
-    win, logs = simulate_battle(teams, gambits, args.n_battle)
-    print("Player(Cunning) win rate %7.5f%%" % (100.0 * win[0] / sum(win.values()),))
+    gambits[Side.PLAYER] = CunningGambit
+    report("Cunning", teams, gambits, args)
 
     # バトルシミュレーション3 （プレイヤーの行動を、機械学習モデルで決める）
-    gambits[Side.PLAYER] = MLbasedGambit()
-    win, logs = simulate_battle(teams, gambits, args.n_battle)
-    print("Player(MLbased) win rate %7.5f%%" % (100.0 * win[0] / sum(win.values()),))
-
-    # プレイヤーのステータスをいじる
-    teams[0] = Team(0, [
-        Unit(Status(Side.PLAYER, 0, "knight2", 104, 76, 65, 32)),
-        Unit(Status(Side.PLAYER, 1, "archer2", 76, 52, 40, 50)),
-        Unit(Status(Side.PLAYER, 2, "thief2", 89, 52, 54, 68)),
-    ])
+    if attack_only:
+        gambits[Side.PLAYER] = partial(MLbasedGambit, embedding=args.embedding,
+                                       multi_head=args.multi_head,
+                                       table_path=args.table)
+        report("MLbased", teams, gambits, args)
+
+    # バトルシミュレーション （プレイヤーの行動を、先読みして決める）
+    if args.n_rollout > 0 and not args.batch and not args.exact:
+        gambits[Side.PLAYER] = partial(RolloutGambit, n_rollout=args.n_rollout,
+                                       batch_size=min(args.n_rollout, 256),
+                                       time_budget=args.time_budget)
+        report("Rollout", teams, gambits, args)
+
+    # バトルシミュレーション （プレイヤーの行動を、ルールで決める）
+    if args.rules is not None:
+        gambits[Side.PLAYER] = partial(RuleGambit.load, args.rules)
+        report("Rules", teams, gambits, args)
+
+    # プレイヤーのステータスをいじる（多数の構成を試す場合は sweep_battle.py を使う）
+    alternate = SweepConfig.from_params(default_roster(), {
+        "player.knight.attack": 76,
+        "player.archer.attack": 52,
+        "player.thief.defence": 54,
+    })
+    teams = make_teams(alternate.roster)
 
     # バトルシミュレーション4 （プレイヤーの行動を、ランダムで決める）
-    gambits[Side.PLAYER] = NaiveGambit()
-    win, logs = simulate_battle(teams, gambits, args.n_battle)
-    print("Player(Naive) win rate %7.5f%%" % (100.0 * win[0] / sum(win.values()),))
+    gambits[Side.PLAYER] = NaiveGambit
+    report("Naive", teams, gambits, args)
 
     # バトルシミュレーション5 （プレイヤーの行動を、チートして決める）
-    gambits[Side.PLAYER] = CunningGambit()
-    win, logs = simulate_battle(teams, gambits, args.n_battle)
-    print("Player(Cunning) win rate %7.5f%%" % (100.0 * win[0] / sum(win.values()),))
+    gambits[Side.PLAYER] = CunningGambit
+    report("Cunning", teams, gambits, args)
 
     # バトルシミュレーション6 （プレイヤーの行動を、機械学習モデルで決める）
-    gambits[Side.PLAYER] = MLbasedGambit()
-    win, logs = simulate_battle(teams, gambits, args.n_battle)
-    print("Player(MLbased) win rate %7.5f%%" % (100.0 * win[0] / sum(win.values()),))
+    if attack_only:
+        gambits[Side.PLAYER] = partial(MLbasedGambit, embedding=args.embedding,
+                                       multi_head=args.multi_head,
+                                       table_path=args.table)
+        report("MLbased", teams, gambits, args)
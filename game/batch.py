@@ -0,0 +1,307 @@
+from typing import List, Optional, Tuple, Union
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from . import logger
+from .status import Side
+from .unit import Unit
+from .team import Team
+from .command import AttackCommand
+from .log import MISSING, TurnLog, TurnLogs
+
+
+def observe(side: np.ndarray, values: np.ndarray) -> np.ndarray:
+    # プレイヤー側のステータスだけ観測できる（AttackCommand.do の TurnLog と同じ）
+    return np.where(side == Side.PLAYER, values, MISSING)
+
+
+@dataclass
+class BatchState:
+    """
+    N バトル分のユニット状態（各配列は (N, units)）
+    """
+
+    units: List[Unit]
+    team: np.ndarray
+    side: np.ndarray
+    status_id: np.ndarray
+    life_base: np.ndarray
+    attack: np.ndarray
+    defence: np.ndarray
+    speed: np.ndarray
+    rng: np.random.Generator
+    life: np.ndarray = field(init=False)
+    life_max: np.ndarray = field(init=False)
+    # バトルごと、チームごとの生存数 (N, teams)
+    n_alive: np.ndarray = field(init=False)
+
+    @classmethod
+    def from_teams(cls, teams: List[Team], n_battle: int,
+                   rng: np.random.Generator, reset: bool = True) -> 'BatchState':
+        """
+        reset=False なら、ユニットの現在の HP を全バトルに複製する（途中局面からのロールアウト用）
+        """
+        units = [unit for team in teams for unit in team.units]
+
+        def column(values, dtype=np.int64):
+            return np.tile(np.array(values, dtype=dtype), (n_battle, 1))
+
+        state = cls(
+            units=units,
+            team=np.array([u.team for u in units], dtype=np.int64),
+            side=np.array([u.side for u in units], dtype=np.int64),
+            status_id=np.array([u.id for u in units], dtype=np.int64),
+            life_base=column([u.status.life for u in units]),
+            attack=column([u.attack for u in units]),
+            defence=column([u.defence for u in units]),
+            speed=column([u.speed for u in units]),
+            rng=rng,
+        )
+        if reset:
+            state.reset()
+        else:
+            state.life_max = column([u.life_max for u in units])
+            state.life = column([u.life for u in units])
+            state.count_alive()
+        return state
+
+    @property
+    def n_battle(self) -> int:
+        return self.life.shape[0]
+
+    @property
+    def n_unit(self) -> int:
+        return self.life.shape[1]
+
+    def reset(self, battles: Optional[np.ndarray] = None):
+        """
+        battles を渡すと、そのバトルだけを初めからにする（他のバトルはそのまま）
+        """
+        # モンスターの最大HPは 85%〜100% の範囲でばらつく（Unit.reset と同じ）
+        if battles is None:
+            var = self.rng.uniform(0.85, 1.0, size=self.life_base.shape)
+            rolled = (var * self.life_base).astype(np.int64)
+            self.life_max = np.where(self.side == Side.MONSTER, rolled, self.life_base)
+            self.life = self.life_max.copy()
+        else:
+            base = self.life_base[battles]
+            var = self.rng.uniform(0.85, 1.0, size=base.shape)
+            rolled = (var * base).astype(np.int64)
+            self.life_max[battles] = np.where(self.side == Side.MONSTER, rolled, base)
+            self.life[battles] = self.life_max[battles]
+        self.count_alive()
+
+    def count_alive(self):
+        n_team = int(self.team.max()) + 1
+        onehot = self.team[:, np.newaxis] == np.arange(n_team)[np.newaxis, :]
+        self.n_alive = (self.life > 0).astype(np.int64) @ onehot.astype(np.int64)
+
+    def has_adversary(self, battles: np.ndarray, teams: np.ndarray) -> np.ndarray:
+        # 他チームに生存ユニットがいるか（ユニット数ではなくチーム数に比例する）
+        n_alive = self.n_alive[battles]
+        return n_alive.sum(axis=1) > n_alive[np.arange(len(battles)), teams]
+
+    def adversaries(self, battles: np.ndarray, sources: np.ndarray) -> np.ndarray:
+        # 攻撃対象のマスク（Unit.can_attack と同じ）
+        return (self.life[battles] > 0) & \
+            (self.team[np.newaxis, :] != self.team[sources][:, np.newaxis])
+
+    def action_order(self, battles: np.ndarray) -> np.ndarray:
+        """
+        行動が早い順のユニットの位置（Turn.proceed と同じく、生存ユニットだけが乱数を引いて並ぶ）
+        倒されたユニットは末尾に回すので、先頭からの位置が生存ユニットの中での行動順になる
+        """
+        alive = self.life[battles] > 0
+        priority = np.full(alive.shape, -np.inf)
+        priority[alive] = self.speed[battles][alive] * \
+            self.rng.uniform(0.5, 1.0, size=int(alive.sum()))
+        return np.argsort(-priority, axis=1, kind='stable')
+
+
+@dataclass
+class BatchBattle:
+    """
+    複数バトルを NumPy 配列で一括シミュレーション
+    """
+
+    n_battle: int
+    seed: Optional[int] = None
+    command: AttackCommand = field(default_factory=AttackCommand)
+
+    def simulate(self,
+                 teams: List[Team],
+                 gambits: List['Gambit'],
+                 logs: Optional[Union[List[TurnLog], TurnLogs]] = None,
+                 max_turn: int = 1000,
+                 ) -> np.ndarray:
+        """
+        バトルごとの勝利チーム ID（決着しなければ -1）を返す
+        """
+        logger.debug("## Batch battle x%d" % self.n_battle)
+
+        rng = np.random.default_rng(self.seed)
+        state = BatchState.from_teams(teams, self.n_battle, rng)
+
+        for gambit in gambits:
+            gambit.reset(teams)
+
+        winner, columns = self.run(state, gambits, max_turn, logs is not None)
+
+        if logs is not None:
+            logs.extend(self.to_turn_logs(state, columns))
+
+        return winner
+
+    def run(self,
+            state: BatchState,
+            gambits: List['Gambit'],
+            max_turn: int = 1000,
+            with_logs: bool = False,
+            first_order: Optional[np.ndarray] = None,
+            running: Optional[np.ndarray] = None,
+            winner: Optional[np.ndarray] = None,
+            ) -> Tuple[np.ndarray, List[dict]]:
+        """
+        state から上限までターンを進める
+        first_order を渡すと、最初のターンは並べ替えずにその順（途中から始まるターンの残り）で行動する
+        """
+        if winner is None:
+            winner = np.full(state.n_battle, -1, dtype=np.int64)
+        if running is None:
+            running = np.ones(state.n_battle, dtype=bool)
+        columns: Optional[List[dict]] = [] if with_logs else None
+
+        turn_id = 1
+        if first_order is not None:
+            order = np.broadcast_to(np.asarray(first_order, dtype=np.int64),
+                                    (state.n_battle, len(first_order)))
+            self.proceed(turn_id, state, gambits, running, winner, columns, order)
+            turn_id += 1
+
+        # 上限までターンを進める
+        for turn_id in range(turn_id, max_turn):
+            if not running.any():
+                break
+            self.proceed(turn_id, state, gambits, running, winner, columns)
+
+        return winner, columns or []
+
+    @staticmethod
+    def attack(state: BatchState,
+               battles: np.ndarray,
+               sources: np.ndarray,
+               targets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        AttackCommand.do と同じダメージ計算を一括で行い、(ダメージ, 攻撃前の HP) を返す
+        """
+        atk = state.attack[battles, sources]
+        dfc = state.defence[battles, targets]
+        base = np.maximum((atk - dfc // 2) // 2, 0)
+        damage = state.rng.integers(base * 7 // 8, base * 9 // 8, endpoint=True)
+        life_before = state.life[battles, targets]
+        life = np.maximum(0, life_before - damage)
+        state.life[battles, targets] = life
+        # 倒されたユニットを生存数から除く（battles は重複しない）
+        defeated = (life_before > 0) & (life <= 0)
+        state.n_alive[battles[defeated], state.team[targets[defeated]]] -= 1
+        return damage, life_before
+
+    def proceed(self,
+                turn_id: int,
+                state: BatchState,
+                gambits: List['Gambit'],
+                running: np.ndarray,
+                winner: np.ndarray,
+                columns: Optional[List[dict]],
+                order: Optional[np.ndarray] = None):
+        """
+        稼働中の全バトルのターンを一括で進める
+        """
+        if order is None:
+            # 行動が早い順にユニットソート（ログの order は生存ユニットの中での順位）
+            order = state.action_order(np.arange(state.n_battle))
+
+        for no in range(order.shape[1]):
+            battles = np.flatnonzero(running)
+            if battles.size == 0:
+                return
+            sources = order[battles, no]
+
+            # 行動可能かチェック
+            active = state.life[battles, sources] > 0
+            battles, sources = battles[active], sources[active]
+            if battles.size == 0:
+                continue
+
+            # 陣営ごとに作戦を選ぶ
+            targets = np.empty_like(sources)
+            source_team = state.team[sources]
+            candidates = state.adversaries(battles, sources)
+            for team_id, gambit in enumerate(gambits):
+                mask = source_team == team_id
+                if mask.any():
+                    targets[mask] = gambit.select_targets(
+                        state, battles[mask], sources[mask], candidates[mask])
+
+            # ダメージを計算する
+            damage, life_before = self.attack(state, battles, sources, targets)
+            life = state.life[battles, targets]
+
+            if columns is not None:
+                columns.append(dict(
+                    battle=battles, turn_id=turn_id, order=no,
+                    source=sources, target=targets,
+                    source_life=state.life[battles, sources],
+                    target_life=life,
+                    damage=damage,
+                    damage_cumsum=state.life_max[battles, targets] - life_before + damage,
+                ))
+
+            # 戦闘終了の判定
+            finished = ~state.has_adversary(battles, source_team)
+            winner[battles[finished]] = source_team[finished]
+            running[battles[finished]] = False
+
+    def to_turn_logs(self, state: BatchState, columns: List[dict]) -> TurnLogs:
+        """
+        一括で記録したログを、バトル順の列指向ログにまとめる
+        """
+        logs = TurnLogs(capacity=0)
+        if not columns:
+            return logs
+
+        def concat(key):
+            return np.concatenate([np.broadcast_to(c[key], c['battle'].shape)
+                                   for c in columns])
+
+        keys = ['battle', 'turn_id', 'order', 'source', 'target',
+                'source_life', 'target_life', 'damage', 'damage_cumsum']
+        col = {k: concat(k) for k in keys}
+        index = np.lexsort((col['order'], col['turn_id'], col['battle']))
+        col = {k: v[index] for k, v in col.items()}
+        battle, source, target = col['battle'], col['source'], col['target']
+
+        source_side = state.side[source]
+        target_side = state.side[target]
+        logs.append_columns(
+            self.command,
+            turn_id=col['turn_id'],
+            order=col['order'],
+            source_id=state.status_id[source],
+            source_side=source_side,
+            source_hp=observe(source_side, col['source_life']),
+            source_atk=observe(source_side, state.attack[battle, source]),
+            source_def=observe(source_side, state.defence[battle, source]),
+            source_spd=observe(source_side, state.speed[battle, source]),
+            target_id=state.status_id[target],
+            target_side=target_side,
+            target_hp=observe(target_side, col['target_life']),
+            target_atk=observe(target_side, state.attack[battle, target]),
+            target_def=observe(target_side, state.defence[battle, target]),
+            target_spd=observe(target_side, state.speed[battle, target]),
+            damage=col['damage'],
+            damage_cumsum=col['damage_cumsum'],
+            defeated=col['target_life'] <= 0,
+        )
+        return logs
@@ -1,29 +1,49 @@
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from dataclasses import dataclass
 
-from game import logger
 from game.team import Team
-from game.turn import Turn, TurnResult
+from game.turn import BattleState, Turn, TurnResult
 from game.log import TurnLog
+from game.command import make_commands
 from game.gambit import Gambit
+from game.event import events
+from game.draws import RandomSource, draws
 
 
 @dataclass(frozen=True)
 class Battle:
     """
-    バトル
+    バトル（commands は使えるコマンドの名前。command.COMMANDS から作る）
     """
 
     id: int
+    commands: Tuple[str, ...] = ('attack',)
 
     def simulate(self,
                  teams: List[Team],
                  gambits: List[Gambit],
                  logs: List[TurnLog],
                  max_turn: int = 1000,
+                 source: Optional[RandomSource] = None,
                  ) -> int:
-        logger.debug("## Battle No.%d" % self.id)
+        """
+        source を渡すと、このバトルの間だけ乱数をそこから引く
+        """
+        if source is None:
+            return self.run(teams, gambits, logs, max_turn)
 
+        previous, draws.source = draws.source, source
+        try:
+            return self.run(teams, gambits, logs, max_turn)
+        finally:
+            draws.source = previous
+
+    def run(self,
+            teams: List[Team],
+            gambits: List[Gambit],
+            logs: List[TurnLog],
+            max_turn: int = 1000,
+            ) -> int:
         # バトルのシミュレーション
         for team in teams:
             team.reset()
@@ -31,13 +51,23 @@ class Battle:
         for gambit in gambits:
             gambit.reset(teams)
 
+        if events.listeners:
+            events.battle_start(self.id, teams)
+
+        # ターン間で使い回す状態
+        state = BattleState(teams, make_commands(self.commands))
+        turn = Turn(0)
+
         # 上限までターンを進める
+        win_id = -1
         for turn_id in range(1, max_turn):
-            logger.debug("### Turn No.%d" % turn_id)
-
-            turn = Turn(turn_id)
-            result, win_team = turn.proceed(teams, gambits, logs)
+            turn.id = turn_id
+            result, win_team = turn.proceed(teams, gambits, logs, state)
             if win_team:
-                return win_team.id
+                win_id = win_team.id
+                break
+
+        if events.listeners:
+            events.battle_end(self.id, win_id, turn.id)
 
-        return -1
+        return win_id
@@ -1,9 +1,11 @@
 from enum import IntEnum
-from typing import List
-from dataclasses import dataclass
-import random
+from typing import ClassVar, Dict, List, Optional, Sequence, Tuple, Type
+from dataclasses import dataclass, field
 
-from . import logger
+import numpy as np
+
+from .event import events
+from .draws import draws
 from .status import Side
 from .unit import Unit
 from .log import TurnLog
@@ -13,21 +15,160 @@ class TargetScope(IntEnum):
     """
     対象範囲
     """
-    UNIT = 0,
-    GROUP = 1,
-    TEAM = 2,
-    ALL = 3,
+    UNIT = 0,   # 1 体
+    GROUP = 1,  # 同じ種類（ステータス ID）のユニットすべて
+    TEAM = 2,   # チーム全体
+    ALL = 3,    # 生存しているユニットすべて
+
+
+@dataclass
+class Options:
+    """
+    (コマンド, 対象の組) の候補を並べた索引表
+    候補ごとの対象は、(候補の位置, units の位置) の組を並べて表す（対象数が違っても詰め物をしない）
+    """
+
+    commands: List['Command']
+    command: np.ndarray        # (候補数,) commands の位置
+    sets: List[List[Unit]]     # 候補ごとの対象
+    units: List[Unit]          # 候補に現れるユニット
+    owner: np.ndarray          # (対象数の合計,) 候補の位置
+    slots: np.ndarray          # (対象数の合計,) units の位置
+    # (コマンド, ユニット) の推定価値を平らにした配列での、対象ごとの位置
+    cells: np.ndarray = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.cells = self.command[self.owner] * len(self.units) + self.slots
+
+    @classmethod
+    def build(cls, commands: List['Command'], sets_per_command: List[List[List[Unit]]]) -> 'Options':
+        positions: Dict[int, int] = {}
+        units: List[Unit] = []
+        sets = [s for sets in sets_per_command for s in sets]
+        slots = []
+        for targets in sets:
+            for unit in targets:
+                position = positions.get(id(unit))
+                if position is None:
+                    position = positions[id(unit)] = len(units)
+                    units.append(unit)
+                slots.append(position)
+        command = np.repeat(np.arange(len(commands)), [len(s) for s in sets_per_command])
+        owner = np.repeat(np.arange(len(sets)), [len(s) for s in sets])
+        return cls(list(commands), command, sets, units, owner, np.array(slots, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.sets)
+
+    def choose(self, index: int) -> Tuple['Command', List[Unit]]:
+        return self.commands[self.command[index]], self.sets[index]
+
+    def estimate(self, source: Unit) -> np.ndarray:
+        """
+        候補ごとの推定価値（対象ごとの Command.estimate_values の和）
+        値はコマンドごとに候補に現れるユニット単位で一度だけ求め、索引で候補へ配る
+        （候補の数に依らず、NumPy の呼び出し回数はコマンド数程度）
+        """
+        columns = np.array([(u.life, u.life_max, u.attack, u.defence) for u in self.units],
+                           dtype=np.float64).reshape(-1, 4).T
+        values = np.concatenate([c.estimate_values(source, *columns) for c in self.commands])
+        return np.bincount(self.owner, weights=values[self.cells], minlength=len(self.sets))
+
+
+class TargetTable:
+    """
+    対象範囲ごとの索引（チームごと・グループごとの生存ユニット）
+    BattleState が生存ユニットの増減に合わせて更新し、候補の表は次に減るまで使い回す
+    """
+
+    __slots__ = ('members', 'groups', 'layouts')
+
+    def __init__(self, n_team: int):
+        # チームごとの生存ユニット（ユニットの並び順）
+        self.members: List[List[Unit]] = [[] for _ in range(n_team)]
+        # チームごと、ステータス ID ごとの生存ユニット
+        self.groups: List[Dict[int, List[Unit]]] = [{} for _ in range(n_team)]
+        # (チーム, コマンド) ごとの候補の表
+        self.layouts: Dict[Tuple, Options] = {}
+
+    @classmethod
+    def from_units(cls, units: List[Unit]) -> 'TargetTable':
+        # BattleState の外で判断する場合（決定サーバーなど）に、ユニット一覧から作る
+        table = cls(max(u.team for u in units) + 1)
+        for unit in units:
+            if unit.life > 0:
+                table.add(unit)
+        return table
+
+    def add(self, unit: Unit):
+        self.members[unit.team].append(unit)
+        self.groups[unit.team].setdefault(unit.id, []).append(unit)
+        self.layouts.clear()
+
+    def remove(self, unit: Unit):
+        self.members[unit.team].remove(unit)
+        self.groups[unit.team][unit.id].remove(unit)
+        self.layouts.clear()
+
+    def clear(self):
+        for members, groups in zip(self.members, self.groups):
+            members.clear()
+            groups.clear()
+        self.layouts.clear()
+
+    def options(self, source: Unit, commands: List['Command']) -> Options:
+        key = (source.team,) + tuple(map(id, commands))
+        options = self.layouts.get(key)
+        if options is None:
+            options = Options.build(commands, [c.target_sets(source, self) for c in commands])
+            self.layouts[key] = options
+        return options
 
 
 @dataclass
 class Command:
-    @staticmethod
-    @property
-    def target_scope():
-        pass
+    # 対象範囲と、味方を対象にするか
+    target_scope: ClassVar[TargetScope] = TargetScope.UNIT
+    target_ally: ClassVar[bool] = False
+
+    # 対象範囲の索引（BattleState が設定する）
+    table: Optional[TargetTable] = field(default=None, init=False, repr=False, compare=False)
+
+    def __getstate__(self):
+        # 索引は保存しない
+        state = dict(self.__dict__)
+        state['table'] = None
+        return state
 
     def targets(self, source: Unit, units: List[Unit]) -> List[Unit]:
-        pass
+        """
+        対象にできる生存ユニット（範囲が UNIT 以外なら、対象の組のどれかに含まれるユニット）
+        """
+        team, ally = source.team, self.target_ally
+        if self.target_scope == TargetScope.ALL:
+            return [u for u in units if u.life > 0]
+        return [u for u in units if u.life > 0 and (u.team == team) == ally]
+
+    def target_sets(self, source: Unit, table: TargetTable) -> List[List[Unit]]:
+        """
+        対象範囲に従って、選べる対象の組を返す（組はユニットの並び順）
+        """
+        team = source.team
+        if self.target_scope == TargetScope.ALL:
+            return [[u for members in table.members for u in members]]
+        teams = [t for t in range(len(table.members)) if (t == team) == self.target_ally]
+        if self.target_scope == TargetScope.UNIT:
+            return [[u] for t in teams for u in table.members[t]]
+        if self.target_scope == TargetScope.GROUP:
+            return [list(g) for t in teams for g in table.groups[t].values() if g]
+        return [list(table.members[t]) for t in teams if table.members[t]]
+
+    def estimate_values(self, source: Unit, life: np.ndarray, life_max: np.ndarray,
+                        attack: np.ndarray, defence: np.ndarray) -> np.ndarray:
+        """
+        対象ごとの推定価値（CunningGambit が候補を比べる目安）
+        """
+        return np.zeros(life.shape)
 
     def do(self, turn_id: int, order: int, source: Unit, targets: List[Unit],
            logs: List[TurnLog]):
@@ -39,30 +180,60 @@ class AttackCommand(Command):
     """
     たたかう コマンド
     """
-    @staticmethod
-    @property
-    def target_scope() -> TargetScope:
-        return TargetScope.UNIT
+
+    buffer: List[Unit] = field(default_factory=list, init=False, repr=False, compare=False)
+
+    def __getstate__(self):
+        # 使い回しのバッファと索引は保存しない
+        return {}
+
+    def __setstate__(self, state):
+        self.buffer = []
+        self.table = None
 
     @staticmethod
     def estimate_damage(attack: int, defence: int) -> int:
         # 平均ダメージの推定
         return max((attack - defence//2)//2, 0)
 
+    def base_damage(self, source: Unit, target: Unit) -> int:
+        return max((source.attack - target.defence // 2) // 2, 0)
+
     def targets(self, source: Unit, units: List[Unit]) -> List[Unit]:
-        return list(filter(lambda u: source.can_attack(u), units))
+        # 返すリストは使い回すので、次の呼び出しまでに使い切ること
+        buffer = self.buffer
+        buffer.clear()
+        team = source.team
+        if self.table is not None:
+            # 他チームの生存ユニットを、ユニットの並び順で集める
+            for team_id, members in enumerate(self.table.members):
+                if team_id != team:
+                    buffer.extend(members)
+            return buffer
+        for u in units:
+            if u.life > 0 and u.team != team:
+                buffer.append(u)
+        return buffer
+
+    def estimate_values(self, source, life, life_max, attack, defence):
+        # CunningGambit の優先度と同じ（被ダメージ × 与ダメージ / 最大HP）
+        damage_taken = np.maximum((attack - source.defence // 2) // 2, 0)
+        damage_given = np.maximum((source.attack - defence // 2) // 2, 0)
+        return damage_taken / life_max * damage_given
 
     def do(self, turn_id: int, order: int, source: Unit, targets: List[Unit],
            logs: List[TurnLog]):
         for target in targets:
             # ダメージを計算する
-            base = max((source.attack - target.defence // 2) // 2, 0)
+            base = self.base_damage(source, target)
             damage_cumsum = target.life_max - target.life
-            damage = random.randint(base * 7 // 8, base * 9 // 8)
+            damage = draws.source.randint(base * 7 // 8, base * 9 // 8)
             target.life = max(0, target.life - damage)
 
-            logger.debug("%12s %10s -> %10s damage=%d %s" % (
-                "Attack", str(source), str(target), damage, "" if target.life > 0 else "defeated"))
+            if events.listeners:
+                events.damage(turn_id, self, source, target, damage)
+                if target.life <= 0:
+                    events.defeat(turn_id, source, target)
 
             source_observable = source.side == Side.PLAYER
             target_observable = target.side == Side.PLAYER
@@ -87,3 +258,93 @@ class AttackCommand(Command):
                 damage_cumsum=damage_cumsum+damage,
                 defeated=target.life <= 0,
             ))
+
+
+@dataclass
+class AreaAttackCommand(AttackCommand):
+    """
+    グループ攻撃（1 体あたりのダメージは power % に下がる）
+    """
+
+    target_scope: ClassVar[TargetScope] = TargetScope.GROUP
+
+    power: int = 50
+
+    def __getstate__(self):
+        return dict(power=self.power)
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.power = state['power']
+
+    def base_damage(self, source: Unit, target: Unit) -> int:
+        return max((source.attack - target.defence // 2) // 2, 0) * self.power // 100
+
+    def estimate_values(self, source, life, life_max, attack, defence):
+        damage_taken = np.maximum((attack - source.defence // 2) // 2, 0)
+        damage_given = np.maximum((source.attack - defence // 2) // 2, 0) * self.power // 100
+        return damage_taken / life_max * damage_given
+
+
+@dataclass
+class HealCommand(Command):
+    """
+    味方 1 体の HP を回復する（ログは残さない）
+    """
+
+    target_ally: ClassVar[bool] = True
+
+    power: int = 40
+
+    def estimate_values(self, source, life, life_max, attack, defence):
+        # 回復できる割合 × 対象の与ダメージ（相手の防御力は自分の防御力で代用する）
+        healed = np.minimum(self.power, life_max - life)
+        return healed / life_max * np.maximum((attack - source.defence // 2) // 2, 0)
+
+    def do(self, turn_id: int, order: int, source: Unit, targets: List[Unit],
+           logs: List[TurnLog]):
+        for target in targets:
+            amount = draws.source.randint(self.power * 7 // 8, self.power * 9 // 8)
+            target.life = min(target.life_max, target.life + amount)
+
+
+@dataclass
+class BuffCommand(Command):
+    """
+    味方全体の攻撃力を rate 倍ずつ上げる（元の攻撃力の max_rate 倍まで。ログは残さない）
+    """
+
+    target_scope: ClassVar[TargetScope] = TargetScope.TEAM
+    target_ally: ClassVar[bool] = True
+
+    rate: float = 0.25
+    max_rate: float = 2.0
+
+    def estimate_values(self, source, life, life_max, attack, defence):
+        # 与ダメージの増分 × 与ダメージ / 最大HP（攻撃の優先度と同じ形）× 残り HP の割合
+        # 相手の防御力は自分の防御力で代用する
+        damage = np.maximum((attack - source.defence // 2) // 2, 0)
+        gain = np.maximum((attack * (1.0 + self.rate) - source.defence // 2) // 2, 0) - damage
+        return gain / life_max * damage * life / life_max
+
+    def do(self, turn_id: int, order: int, source: Unit, targets: List[Unit],
+           logs: List[TurnLog]):
+        for target in targets:
+            limit = int(target.status.attack * self.max_rate)
+            target.attack = min(int(target.attack * (1.0 + self.rate)), limit)
+
+
+# コマンドの登録表（attack は常に先頭。一択の作戦は commands[0] で攻撃する）
+COMMANDS: Dict[str, Type[Command]] = {
+    'attack': AttackCommand,
+    'area': AreaAttackCommand,
+    'heal': HealCommand,
+    'buff': BuffCommand,
+}
+
+
+def make_commands(names: Sequence[str] = ('attack',)) -> List[Command]:
+    unknown = [n for n in names if n not in COMMANDS]
+    if unknown:
+        raise ValueError("unknown commands %s (choose from %s)" % (unknown, sorted(COMMANDS)))
+    return [COMMANDS[n]() for n in ['attack'] + [n for n in names if n != 'attack']]
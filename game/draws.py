@@ -0,0 +1,144 @@
+from typing import Iterator, List, Optional, Sequence
+import itertools
+import random
+
+import numpy as np
+
+
+class RandomSource:
+    """
+    バトルで使う乱数の供給元（一様乱数 random() から他の乱数を作る）
+    """
+
+    def seed(self, seed: Optional[int]):
+        pass
+
+    def random(self) -> float:
+        raise NotImplementedError
+
+    def uniforms(self, n: int) -> List[float]:
+        return [self.random() for _ in range(n)]
+
+    def uniform(self, a: float, b: float) -> float:
+        return a + (b - a) * self.random()
+
+    def randint(self, a: int, b: int) -> int:
+        return a + int(self.random() * (b - a + 1))
+
+    def choice(self, seq: Sequence):
+        return seq[int(self.random() * len(seq))]
+
+
+class PythonRandom(RandomSource):
+    """
+    global な random を使う（既定。random.seed によるこれまでの乱数列と同じになる）
+    """
+
+    def __init__(self):
+        # 呼び出しを一段減らすため、random の関数をそのまま属性にする
+        self.seed = random.seed
+        self.random = random.random
+        self.uniform = random.uniform
+        self.randint = random.randint
+        self.choice = random.choice
+
+    def uniforms(self, n: int) -> List[float]:
+        _random = random.random
+        return [_random() for _ in range(n)]
+
+
+class BlockRandom(RandomSource):
+    """
+    NumPy でまとめて生成した一様乱数を、順に渡す
+    """
+
+    def __init__(self, seed: Optional[int] = None, block: int = 128):
+        # バトル 1 回で引く乱数は 3 対 3 で 70 個ほどなので、ブロックは小さめにする
+        self.block = block
+        self.generator = np.random.Generator(np.random.PCG64())
+        self.state = self.generator.bit_generator.state
+        self.seed(seed)
+
+    def seed(self, seed: Optional[int]):
+        # バトルごとに Generator を作り直すと遅いので、PCG64 の状態だけを書き換える
+        # seed は SeedSequence でハッシュし、小さい値や隣り合う値でも系列が似ないようにする
+        words = [int(w) for w in np.random.SeedSequence(seed).generate_state(4, np.uint64)]
+        self.state['state']['state'] = words[0] << 64 | words[1]
+        self.state['state']['inc'] = words[2] << 64 | words[3] | 1  # 増分は奇数
+        self.generator.bit_generator.state = self.state
+        self.restart()
+
+    def restart(self):
+        # 1 個ずつ引く random() は、ジェネレーターの __next__ をそのまま使う
+        self.stream = self.blocks()
+        self.random = self.stream.__next__
+
+    def blocks(self) -> Iterator[float]:
+        while True:
+            yield from self.generator.random(self.block).tolist()
+
+    def uniforms(self, n: int) -> List[float]:
+        return list(itertools.islice(self.stream, n))
+
+
+class RecordingRandom(RandomSource):
+    """
+    別の供給元から引いた一様乱数を記録する（TapeRandom で同じバトルを再現できる）
+    """
+
+    def __init__(self, base: RandomSource):
+        self.base = base
+        self.records: List[float] = []
+
+    def seed(self, seed: Optional[int]):
+        self.base.seed(seed)
+        self.records = []
+
+    def random(self) -> float:
+        value = self.base.random()
+        self.records.append(value)
+        return value
+
+    def uniforms(self, n: int) -> List[float]:
+        values = self.base.uniforms(n)
+        self.records.extend(values)
+        return values
+
+    @property
+    def tape(self) -> np.ndarray:
+        return np.array(self.records, dtype=np.float64)
+
+
+class TapeRandom(RandomSource):
+    """
+    記録した一様乱数を先頭から順に返す（使い切ったら IndexError）
+    seed は巻き戻すだけなので、同じ乱数を別の作戦でも使い回せる
+    """
+
+    def __init__(self, tape: Sequence[float]):
+        self.tape: List[float] = np.asarray(tape, dtype=np.float64).tolist()
+        self.seed(None)
+
+    def seed(self, seed: Optional[int]):
+        self.stream = self.replay()
+        self.random = self.stream.__next__
+
+    def replay(self) -> Iterator[float]:
+        yield from self.tape
+        raise IndexError("random tape exhausted after %d draws" % len(self.tape))
+
+    def uniforms(self, n: int) -> List[float]:
+        return list(itertools.islice(self.stream, n))
+
+
+class Draws:
+    """
+    バトルが乱数を引く供給元（Battle.simulate がバトルの間だけ差し替える）
+    """
+
+    def __init__(self):
+        self.source: RandomSource = PythonRandom()
+
+
+# プロセス全体で共有する供給元
+draws = Draws()
@@ -0,0 +1,173 @@
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from .status import Side
+from .team import Team
+from .batch import BatchBattle, BatchState, observe
+from .gambit import Gambit, NaiveGambit
+
+Observation = Dict[str, np.ndarray]
+
+
+@dataclass
+class BattleEnv:
+    """
+    強化学習用に、K 個のバトルをまとめて進める環境（Gym のベクトル環境と同じ reset/step）
+    エージェントは agent_team のユニットの攻撃対象を選び、他のチームは opponent の作戦で行動する
+    行動順とダメージの規則は BatchBattle と同じで、決着したバトルは step の中で初めからやり直す
+
+    観測はユニットごとの (K, ユニット数) の配列で、TurnLog と同じくプレイヤー側のステータスだけが見える
+    （見えない値は MISSING。モンスターも生死と受けた累計ダメージはログから分かるので見える）
+    """
+
+    teams: List[Team]
+    n_env: int = 1024
+    agent_team: int = Side.PLAYER
+    opponent: Gambit = field(default_factory=NaiveGambit)
+    max_turn: int = 100
+    seed: Optional[int] = None
+    state: BatchState = field(init=False, repr=False)
+    order: np.ndarray = field(init=False, repr=False)    # (K, ユニット数) このターンの行動順
+    cursor: np.ndarray = field(init=False, repr=False)   # (K,) 行動順の何番目か
+    turn: np.ndarray = field(init=False, repr=False)     # (K,) ターン数
+
+    def __post_init__(self):
+        if self.max_turn < 2:
+            raise ValueError("max_turn must be at least 2")
+        self.state = BatchState.from_teams(self.teams, self.n_env, np.random.default_rng(self.seed),
+                                           reset=False)
+        self.order = np.zeros(self.state.life.shape, dtype=np.int64)
+        self.cursor = np.zeros(self.n_env, dtype=np.int64)
+        self.turn = np.zeros(self.n_env, dtype=np.int64)
+        self.opponent.reset(self.teams)
+
+    @property
+    def n_unit(self) -> int:
+        return self.state.n_unit
+
+    def reset(self) -> Observation:
+        self.restart(np.arange(self.n_env))
+        return self.observe()
+
+    def step(self, actions: np.ndarray
+             ) -> Tuple[Observation, np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
+        """
+        バトルごとに、行動するユニットの攻撃対象（ユニットの位置）を受け取って進める
+        返り値は (観測, 報酬, 決着したか, info)。報酬は勝ちで 1、負けで -1、それ以外は 0
+        info の winner は決着したバトルの勝利チーム（ターン上限なら -1 で truncated が True）
+        """
+        state = self.state
+        battles = np.arange(self.n_env)
+        sources = self.order[battles, self.cursor]
+        targets = np.asarray(actions, dtype=np.int64)
+        if targets.shape != (self.n_env,):
+            raise ValueError("expected %d actions, got shape %s" % (self.n_env, targets.shape))
+        if not self.action_mask(sources)[battles, targets].all():
+            raise ValueError("actions must target living adversaries (see observation 'mask')")
+
+        winner = np.full(self.n_env, -1, dtype=np.int64)
+        done = np.zeros(self.n_env, dtype=bool)
+        truncated = np.zeros(self.n_env, dtype=bool)
+
+        BatchBattle.attack(state, battles, sources, targets)
+        self.cursor += 1
+        won = ~state.has_adversary(battles, state.team[sources])
+        winner[won] = self.agent_team
+        done |= won
+
+        self.advance(np.flatnonzero(~done), winner, done, truncated)
+
+        reward = np.where(winner == self.agent_team, 1.0, 0.0) - \
+            np.where(done & ~truncated & (winner != self.agent_team), 1.0, 0.0)
+        info = dict(winner=winner, truncated=truncated, turn=self.turn.copy())
+
+        self.restart(np.flatnonzero(done))
+        return self.observe(), reward, done, info
+
+    def restart(self, battles: np.ndarray):
+        # バトルを初めからにし、エージェントの最初の判断まで進める
+        # （判断の前に決着したバトルは、もう一度やり直す）
+        while battles.size:
+            self.state.reset(battles)
+            self.cursor[battles] = self.n_unit
+            self.turn[battles] = 0
+            winner = np.full(self.n_env, -1, dtype=np.int64)
+            done = np.zeros(self.n_env, dtype=bool)
+            self.advance(battles, winner, done, np.zeros(self.n_env, dtype=bool))
+            battles = np.flatnonzero(done)
+
+    def advance(self, battles: np.ndarray, winner: np.ndarray, done: np.ndarray,
+                truncated: np.ndarray):
+        """
+        各バトルを、次にエージェントのユニットが行動するところまで一括で進める
+        （相手の行動、倒されたユニットの飛ばし、ターンの切り替えをバトルごとの位置で行う）
+        """
+        state = self.state
+        agent = self.agent_team
+        while battles.size:
+            # 行動順の最後まで来たバトルは、次のターンの行動順を決める（BatchBattle.proceed と同じ）
+            starting = battles[self.cursor[battles] >= self.n_unit]
+            if starting.size:
+                self.turn[starting] += 1
+                over = starting[self.turn[starting] >= self.max_turn]
+                done[over] = truncated[over] = True
+                starting = starting[self.turn[starting] < self.max_turn]
+                self.order[starting] = state.action_order(starting)
+                self.cursor[starting] = 0
+                battles = battles[~done[battles]]
+
+            sources = self.order[battles, self.cursor[battles]]
+
+            # 倒されたユニットは飛ばし、エージェントのユニットの番になったバトルは止める
+            alive = state.life[battles, sources] > 0
+            acting = alive & (state.team[sources] != agent)
+            skipped = battles[~alive]
+            self.cursor[skipped] += 1
+            battles, sources = battles[acting], sources[acting]
+
+            if battles.size:
+                candidates = state.adversaries(battles, sources)
+                targets = self.opponent.select_targets(state, battles, sources, candidates)
+                BatchBattle.attack(state, battles, sources, targets)
+                self.cursor[battles] += 1
+
+                # 決着したか、エージェントのチームが全滅したら終わり
+                finished = ~state.has_adversary(battles, state.team[sources])
+                winner[battles[finished]] = state.team[sources[finished]]
+                ended = finished | (state.n_alive[battles, agent] == 0)
+                done[battles[ended]] = True
+                battles = battles[~ended]
+
+            battles = np.concatenate([battles, skipped]) if skipped.size else battles
+
+    def action_mask(self, sources: np.ndarray) -> np.ndarray:
+        return self.state.adversaries(np.arange(self.n_env), sources)
+
+    def observe(self) -> Observation:
+        """
+        source は行動するユニットの位置、mask は選べる攻撃対象
+        """
+        state = self.state
+        sources = self.order[np.arange(self.n_env), self.cursor]
+        side = np.broadcast_to(state.side, state.life.shape)
+        return dict(
+            source=sources,
+            mask=self.action_mask(sources),
+            turn=self.turn.copy(),
+            status_id=np.broadcast_to(state.status_id, state.life.shape),
+            side=side,
+            alive=state.life > 0,
+            damage_taken=state.life_max - state.life,
+            life=observe(side, state.life),
+            life_max=observe(side, state.life_max),
+            attack=observe(side, state.attack),
+            defence=observe(side, state.defence),
+            speed=observe(side, state.speed),
+        )
+
+    def sample_actions(self, observation: Observation) -> np.ndarray:
+        # 選べる攻撃対象から一様に選ぶ（動作確認やベースライン用）
+        keys = self.state.rng.random(observation['mask'].shape)
+        return np.argmax(np.where(observation['mask'], keys, -1.0), axis=1)
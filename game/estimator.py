@@ -1,10 +1,15 @@
 from dataclasses import dataclass, field
-from typing import List, Tuple
+from typing import Callable, Iterator, List, Tuple
 from pathlib import Path
 
 import numpy as np
 import tensorflow as tf
 
+from .registry import models
+
+# 学習データのチャンクを順に返すジェネレーター関数
+Source = Callable[[], Iterator[Tuple[np.ndarray, ...]]]
+
 
 @dataclass
 class Estimator:
@@ -15,14 +20,17 @@ class Estimator:
     name: str
     n_class: int
     hidden_layers: List[int]
+    embedding: bool
 
     def __init__(self,
                  name: str,
                  n_class: int,
-                 hidden_layers: List[int] = [16, 8]):
+                 hidden_layers: List[int] = [16, 8],
+                 embedding: bool = False):
         self.name = name
         self.n_class = n_class
         self.hidden_layers = hidden_layers
+        self.embedding = embedding
         self.model = None
         self.model_prob = None
 
@@ -33,6 +41,8 @@ class Estimator:
         model_name = "DNN"
         for hl in self.hidden_layers:
             model_name += '-%d' % hl
+        if self.embedding:
+            model_name += '-emb'
         return model_name
 
     def get_path(self) -> Path:
@@ -42,6 +52,8 @@ class Estimator:
         if inputs is None:
             inputs = [
                 tf.keras.Input(shape=(1,), name="input_v"),
+                tf.keras.Input(shape=(1,), name="input_c", dtype=tf.int32)
+                if self.embedding else
                 tf.keras.Input(shape=(self.n_class,), name="input_c"),
             ]
 
@@ -52,17 +64,37 @@ class Estimator:
         # _ = tf.keras.layers.Dense(self.hidden_layers[0])(_)
 
         # more better
-        _c = tf.keras.layers.Dense(self.hidden_layers[0])(_c)
+        if self.embedding:
+            # one-hot + Dense と等価（後段が線形なのでバイアスは吸収される）
+            _c = tf.keras.layers.Embedding(self.n_class, self.hidden_layers[0])(_c)
+            _c = tf.keras.layers.Flatten()(_c)
+        else:
+            _c = tf.keras.layers.Dense(self.hidden_layers[0])(_c)
         _ = tf.keras.layers.Concatenate()([_v, _c])
 
-        _ = tf.keras.layers.Dense(self.hidden_layers[1])(_)
+        # 2 層目以降（既定は [16, 8] なので 1 層）
+        for units in self.hidden_layers[1:]:
+            _ = tf.keras.layers.Dense(units)(_)
         _ = tf.keras.layers.Dense(1, name="output")(_)
 
         self.model = tf.keras.Model(inputs, _)
         self.model.compile(loss='mean_squared_error', optimizer="adam")
 
     def load_model(self):
-        self.model = tf.keras.models.load_model(str(self.get_path()))
+        # 同じファイルはプロセス内で一度だけ読み込み、他のインスタンスと共有する
+        self.model = models.get(self.get_path(),
+                                lambda path: tf.keras.models.load_model(str(path)),
+                                self.warm_up)
+
+    def load_weights(self):
+        # 共有せず、この推定器のモデルに重みだけを読み込む（学習を続ける場合）
+        self.model.load_weights(str(self.get_path()))
+
+    def dummy_inputs(self, n: int = 1) -> List[np.ndarray]:
+        return [np.zeros((n, 1), dtype=np.float32), self.encode_class(np.zeros(n))]
+
+    def warm_up(self, model):
+        model.predict(self.dummy_inputs())
 
     def save_model(self):
         # import shutil
@@ -70,3 +102,215 @@ class Estimator:
         model_dir = self.get_dir()
         model_dir.mkdir(parents=True, exist_ok=True)
         tf.keras.models.save_model(self.model, str(self.get_path()))
+
+    def encode_class(self, ids: np.ndarray) -> np.ndarray:
+        # クラス入力を ID のまま、または one-hot で渡す
+        ids = np.asarray(ids, dtype=np.int32)
+        if self.embedding:
+            return ids[:, np.newaxis]
+        # 単位行列を作らず、ID の位置だけ 1 にする（クラス数が多くてもメモリが増えない）
+        onehot = np.zeros((len(ids), self.n_class), dtype=np.float32)
+        onehot[np.arange(len(ids)), ids] = 1.0
+        return onehot
+
+    def predict(self, values: np.ndarray, ids: np.ndarray) -> np.ndarray:
+        Xv = np.asarray(values, dtype=np.float32).reshape(-1, 1)
+        return np.ravel(self.model.predict([Xv, self.encode_class(ids)]))
+
+    def chunk_spec(self):
+        # source が流すチャンク (値, クラス ID, 目的変数) の型
+        return ((tf.float32, tf.int32, tf.float32),
+                (tf.TensorShape([None, 1]), tf.TensorShape([None]), tf.TensorShape([None, 1])))
+
+    def encode_class_tensor(self, c):
+        if self.embedding:
+            return tf.expand_dims(c, -1)
+        return tf.one_hot(c, self.n_class)
+
+    def to_features(self, v, c, y):
+        return {"input_v": v, "input_c": self.encode_class_tensor(c)}, y
+
+    def make_dataset(self,
+                     source: Source,
+                     batch_size: int = 128,
+                     shuffle_buffer: int = 10000,
+                     prefetch: int = 4,
+                     repeat: bool = True):
+        """
+        チャンクを流す source から、学習用のストリームを作る
+        """
+        dataset = tf.data.Dataset.from_generator(source, *self.chunk_spec())
+        dataset = dataset.flat_map(
+            lambda *chunk: tf.data.Dataset.from_tensor_slices(chunk))
+        if shuffle_buffer:
+            dataset = dataset.shuffle(shuffle_buffer)
+        if repeat:
+            dataset = dataset.repeat()
+        dataset = dataset.batch(batch_size)
+        dataset = dataset.map(self.to_features)
+        return dataset.prefetch(prefetch)
+
+    def fit_stream(self,
+                   source: Source,
+                   n_sample: int,
+                   epochs: int,
+                   batch_size: int = 128,
+                   shuffle_buffer: int = 10000,
+                   callbacks=None):
+        """
+        ストリームから学習する（特徴量の生成と勾配計算を重ねる）
+        """
+        dataset = self.make_dataset(source, batch_size, shuffle_buffer)
+        steps = max(1, -(-n_sample // batch_size))
+        return self.model.fit(dataset, epochs=epochs, steps_per_epoch=steps,
+                              callbacks=callbacks, verbose=0)
+
+    def to_arrays(self, chunk: Tuple[np.ndarray, ...]) -> Tuple[List[np.ndarray], np.ndarray, None]:
+        # チャンクを (入力, 目的変数, 重み) にする（重みは無し）
+        v, c, y = chunk
+        return [v, self.encode_class(c)], y, None
+
+    def fit_early_stopping(self,
+                           train: Tuple[np.ndarray, ...],
+                           test: Tuple[np.ndarray, ...],
+                           max_epochs: int = 50,
+                           batch_size: int = 128,
+                           patience: int = 5) -> Tuple[float, float, int]:
+        """
+        holdout の損失が patience エポック改善しなければ打ち切り、最良のエポックの重みに戻す
+        (最良の holdout 損失, そのエポックの学習損失, 学習したエポック数) を返す
+        """
+        x, y, w = self.to_arrays(train)
+        vx, vy, vw = self.to_arrays(test)
+        stop = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=patience,
+                                                restore_best_weights=True)
+        history = self.model.fit(x, y, sample_weight=w,
+                                 validation_data=(vx, vy) if vw is None else (vx, vy, vw),
+                                 epochs=max_epochs, batch_size=batch_size,
+                                 callbacks=[stop], verbose=0).history
+        best = int(np.argmin(history['val_loss']))
+        return float(history['val_loss'][best]), float(history['loss'][best]), len(history['loss'])
+
+    def train_batch(self, chunk: Tuple[np.ndarray, ...], index: np.ndarray) -> float:
+        v, c, y = chunk
+        return float(np.ravel(self.model.train_on_batch(
+            [v[index], self.encode_class(c[index])], y[index]))[0])
+
+    def partial_fit(self,
+                    chunk: Tuple[np.ndarray, ...],
+                    batch_size: int = 128,
+                    epochs: int = 1,
+                    seed=None) -> float:
+        """
+        メモリ上のチャンクで重みを更新し、平均の損失を返す（オンライン学習用）
+        呼ぶたびにデータセットのグラフを作らないよう、train_on_batch で学習する
+        """
+        n = len(chunk[1])
+        if n == 0:
+            return float('nan')
+        rng = np.random.default_rng(seed)
+        losses = []
+        for _ in range(epochs):
+            order = rng.permutation(n)
+            for begin in range(0, n, batch_size):
+                losses.append(self.train_batch(chunk, order[begin:begin + batch_size]))
+        return float(np.mean(losses))
+
+    def evaluate_stream(self,
+                        source: Source,
+                        n_sample: int,
+                        batch_size: int = 128) -> float:
+        dataset = self.make_dataset(source, batch_size, shuffle_buffer=0, repeat=False)
+        steps = max(1, -(-n_sample // batch_size))
+        # 複数出力の場合は合計の損失を返す
+        return float(np.ravel(self.model.evaluate(dataset, steps=steps, verbose=0))[0])
+
+
+@dataclass
+class MultiHeadEstimator(Estimator):
+    """
+    クラス入力を共有し、複数の推定を一つのモデルで行う
+    """
+
+    heads: List[str]
+
+    def __init__(self,
+                 name: str,
+                 n_class: int,
+                 heads: List[str],
+                 hidden_layers: List[int] = [16, 8],
+                 embedding: bool = False):
+        super().__init__(name, n_class, hidden_layers, embedding)
+        self.heads = heads
+
+    def build_model(self, inputs=None):
+        if inputs is None:
+            inputs = [tf.keras.Input(shape=(1,), name="input_v%d" % i)
+                      for i in range(len(self.heads))]
+            inputs.append(
+                tf.keras.Input(shape=(1,), name="input_c", dtype=tf.int32)
+                if self.embedding else
+                tf.keras.Input(shape=(self.n_class,), name="input_c"))
+
+        *_vs, _c = inputs
+
+        outputs = []
+        for head, _v in zip(self.heads, _vs):
+            # 各推定は単体の Estimator と同じ構造
+            if self.embedding:
+                _h = tf.keras.layers.Embedding(self.n_class, self.hidden_layers[0])(_c)
+                _h = tf.keras.layers.Flatten()(_h)
+            else:
+                _h = tf.keras.layers.Dense(self.hidden_layers[0])(_c)
+            _ = tf.keras.layers.Concatenate()([_v, _h])
+            for units in self.hidden_layers[1:]:
+                _ = tf.keras.layers.Dense(units)(_)
+            outputs.append(tf.keras.layers.Dense(1, name=head)(_))
+
+        self.model = tf.keras.Model(inputs, outputs)
+        self.model.compile(loss='mean_squared_error', optimizer="adam")
+
+    def dummy_inputs(self, n: int = 1) -> List[np.ndarray]:
+        values = [np.zeros((n, 1), dtype=np.float32) for _ in self.heads]
+        return values + [self.encode_class(np.zeros(n))]
+
+    def to_arrays(self, chunk: Tuple[np.ndarray, ...]):
+        # 重み 0 のヘッドは、そのサンプルでは学習しない（to_features と同じ）
+        v, c, y, w = chunk
+        n = len(self.heads)
+        return ([v[:, i:i+1] for i in range(n)] + [self.encode_class(c)],
+                [y[:, i:i+1] for i in range(n)],
+                [w[:, i] for i in range(n)])
+
+    def train_batch(self, chunk: Tuple[np.ndarray, ...], index: np.ndarray) -> float:
+        # 重み 0 のヘッドは、そのサンプルでは学習しない（to_features と同じ）
+        v, c, y, w = chunk
+        n = len(self.heads)
+        inputs = [v[index, i:i+1] for i in range(n)] + [self.encode_class(c[index])]
+        targets = [y[index, i:i+1] for i in range(n)]
+        weights = [w[index, i] for i in range(n)]
+        return float(np.ravel(self.model.train_on_batch(inputs, targets, sample_weight=weights))[0])
+
+    def predict(self, values: np.ndarray, ids: np.ndarray) -> np.ndarray:
+        """
+        values は (サンプル数, ヘッド数)、戻り値も同じ形
+        """
+        values = np.asarray(values, dtype=np.float32)
+        Xs = [values[:, i:i+1] for i in range(len(self.heads))]
+        ys = self.model.predict(Xs + [self.encode_class(ids)])
+        return np.concatenate([np.reshape(y, (-1, 1)) for y in ys], axis=1)
+
+    def chunk_spec(self):
+        # source が流すチャンク (値, クラス ID, 目的変数, 重み) の型（クラス ID 以外は (n, ヘッド数)）
+        n = len(self.heads)
+        return ((tf.float32, tf.int32, tf.float32, tf.float32),
+                (tf.TensorShape([None, n]), tf.TensorShape([None]),
+                 tf.TensorShape([None, n]), tf.TensorShape([None, n])))
+
+    def to_features(self, v, c, y, w):
+        # 重み 0 のヘッドは、そのサンプルでは学習しない
+        inputs = {"input_v%d" % i: v[:, i:i+1] for i in range(len(self.heads))}
+        inputs["input_c"] = self.encode_class_tensor(c)
+        targets = {head: y[:, i:i+1] for i, head in enumerate(self.heads)}
+        weights = {head: w[:, i] for i, head in enumerate(self.heads)}
+        return inputs, targets, weights
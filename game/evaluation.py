@@ -0,0 +1,126 @@
+from typing import Iterator, List
+from dataclasses import dataclass
+from statistics import NormalDist
+import itertools
+import math
+
+import numpy as np
+
+from . import logger
+from .team import Team
+from .batch import BatchBattle
+from .runner import BattleRunner, GambitFactory, battle_seed
+
+
+@dataclass
+class Estimate:
+    """
+    推定値と信頼区間
+    """
+
+    mean: float
+    low: float
+    high: float
+    n: int
+
+    @property
+    def half_width(self) -> float:
+        return (self.high - self.low) / 2
+
+    def __str__(self):
+        return "%7.5f%% [%7.5f%%, %7.5f%%] (n=%d)" % (
+            100.0 * self.mean, 100.0 * self.low, 100.0 * self.high, self.n)
+
+    @classmethod
+    def proportion(cls, wins: int, n: int, z: float) -> 'Estimate':
+        # Wilson の信頼区間（勝率が 0 や 1 に近くても幅が潰れない）
+        p = wins / n
+        center = (p + z * z / (2 * n)) / (1 + z * z / n)
+        width = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+        return cls(mean=p, low=center - width, high=center + width, n=n)
+
+    @classmethod
+    def paired(cls, total: float, total_sq: float, n: int, z: float) -> 'Estimate':
+        # 対応のある差の平均と、正規近似の信頼区間
+        mean = total / n
+        var = max(total_sq / n - mean * mean, 0.0) * n / max(n - 1, 1)
+        width = z * math.sqrt(var / n)
+        return cls(mean=mean, low=mean - width, high=mean + width, n=n)
+
+
+@dataclass
+class SequentialEvaluator:
+    """
+    チャンクごとにバトルを重ね、信頼区間の半幅が precision 以下になるか、
+    max_battle に達したところで打ち切る
+    """
+
+    teams: List[Team]
+    seed: int = 0
+    chunk_size: int = 1000
+    precision: float = 0.005
+    confidence: float = 0.95
+    max_battle: int = 100000
+    batch: bool = False
+    n_worker: int = 1
+
+    @property
+    def z(self) -> float:
+        return NormalDist().inv_cdf((1 + self.confidence) / 2)
+
+    def chunks(self, gambits: List[GambitFactory]) -> Iterator[np.ndarray]:
+        """
+        チャンクごとの勝利チーム ID を返す
+        チャンク番号とシードが同じなら同じ乱数を使うので、作戦の比較は対応のあるものになる
+        """
+        if self.batch:
+            instances = [g() for g in gambits]
+            for index in itertools.count():
+                seed = battle_seed(self.seed, index)
+                yield BatchBattle(self.chunk_size, seed).simulate(self.teams, instances)
+            return
+
+        with BattleRunner(self.teams, gambits, seed=self.seed, n_worker=self.n_worker) as runner:
+            for index in itertools.count():
+                yield runner.winners(self.chunk_size, start=index * self.chunk_size)
+
+    def evaluate(self, gambits: List[GambitFactory], team_id: int = 0) -> Estimate:
+        """
+        team_id の勝率を推定する
+        """
+        chunks = self.chunks(gambits)
+        wins = n = 0
+        try:
+            for winners in chunks:
+                wins += int((winners == team_id).sum())
+                n += len(winners)
+                estimate = Estimate.proportion(wins, n, self.z)
+                logger.debug("evaluate %s" % estimate)
+                if estimate.half_width <= self.precision or n >= self.max_battle:
+                    return estimate
+        finally:
+            chunks.close()
+
+    def compare(self,
+                gambits: List[GambitFactory],
+                baseline: List[GambitFactory],
+                team_id: int = 0) -> Estimate:
+        """
+        gambits と baseline の勝率の差を、同じ乱数で戦わせて推定する
+        """
+        chunks, others = self.chunks(gambits), self.chunks(baseline)
+        total = total_sq = 0.0
+        n = 0
+        try:
+            for winners, others_winners in zip(chunks, others):
+                diff = (winners == team_id).astype(np.int64) - (others_winners == team_id)
+                total += diff.sum()
+                total_sq += (diff * diff).sum()
+                n += len(diff)
+                estimate = Estimate.paired(total, total_sq, n, self.z)
+                logger.debug("compare %s" % estimate)
+                if estimate.half_width <= self.precision or n >= self.max_battle:
+                    return estimate
+        finally:
+            chunks.close()
+            others.close()
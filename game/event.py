@@ -0,0 +1,185 @@
+from typing import Deque, Dict, List, Optional, Tuple
+from collections import deque
+import time
+
+from . import logger
+
+
+class Listener:
+    """
+    バトル中のイベントを受け取る（必要なものだけオーバーライドする）
+    """
+
+    def on_battle_start(self, battle_id: int, teams):
+        pass
+
+    def on_battle_end(self, battle_id: int, win_team: int, turn_id: int):
+        pass
+
+    def on_turn_start(self, turn_id: int, units):
+        pass
+
+    def on_action(self, turn_id: int, order: int, source, command, targets):
+        pass
+
+    def on_damage(self, turn_id: int, command, source, target, damage: int):
+        pass
+
+    def on_defeat(self, turn_id: int, source, target):
+        pass
+
+
+class Events:
+    """
+    イベントの通知先
+    呼び出し側は `if events.listeners:` で確認してから通知するので、リスナーがいなければ費用はかからない
+    """
+
+    def __init__(self):
+        self.listeners: List[Listener] = []
+
+    def attach(self, listener: Listener) -> Listener:
+        self.listeners.append(listener)
+        return listener
+
+    def detach(self, listener: Listener):
+        self.listeners.remove(listener)
+
+    def battle_start(self, battle_id, teams):
+        for listener in self.listeners:
+            listener.on_battle_start(battle_id, teams)
+
+    def battle_end(self, battle_id, win_team, turn_id):
+        for listener in self.listeners:
+            listener.on_battle_end(battle_id, win_team, turn_id)
+
+    def turn_start(self, turn_id, units):
+        for listener in self.listeners:
+            listener.on_turn_start(turn_id, units)
+
+    def action(self, turn_id, order, source, command, targets):
+        for listener in self.listeners:
+            listener.on_action(turn_id, order, source, command, targets)
+
+    def damage(self, turn_id, command, source, target, damage):
+        for listener in self.listeners:
+            listener.on_damage(turn_id, command, source, target, damage)
+
+    def defeat(self, turn_id, source, target):
+        for listener in self.listeners:
+            listener.on_defeat(turn_id, source, target)
+
+
+# プロセス全体で共有する通知先
+events = Events()
+
+
+class LoggingListener(Listener):
+    """
+    バトルの経過をデバッグログに出力する
+    """
+
+    def on_battle_start(self, battle_id, teams):
+        logger.debug("## Battle No.%d" % battle_id)
+
+    def on_turn_start(self, turn_id, units):
+        logger.debug("### Turn No.%d" % turn_id)
+
+    def on_damage(self, turn_id, command, source, target, damage):
+        name = type(command).__name__.replace('Command', '')
+        logger.debug("%12s %10s -> %10s damage=%d %s" % (
+            name, str(source), str(target), damage, "" if target.life > 0 else "defeated"))
+
+
+class PhaseTimer(Listener):
+    """
+    フェーズ（バトル、ターン、行動）ごとの回数と所要時間を集計する
+    行動の時間は、その行動の通知から次のイベントまで（コマンドの実行を含む）
+    """
+
+    def __init__(self):
+        self.counts: Dict[str, int] = dict(battle=0, turn=0, action=0, damage=0, defeat=0)
+        self.seconds: Dict[str, float] = dict(battle=0.0, turn=0.0, action=0.0)
+        self.started: Dict[str, Optional[float]] = dict(battle=None, turn=None, action=None)
+
+    def _stop(self, phase: str, now: float):
+        start = self.started[phase]
+        if start is not None:
+            self.seconds[phase] += now - start
+            self.started[phase] = None
+
+    def on_battle_start(self, battle_id, teams):
+        self.counts['battle'] += 1
+        self.started['battle'] = time.perf_counter()
+
+    def on_battle_end(self, battle_id, win_team, turn_id):
+        now = time.perf_counter()
+        for phase in ('action', 'turn', 'battle'):
+            self._stop(phase, now)
+
+    def on_turn_start(self, turn_id, units):
+        now = time.perf_counter()
+        self._stop('action', now)
+        self._stop('turn', now)
+        self.counts['turn'] += 1
+        self.started['turn'] = now
+
+    def on_action(self, turn_id, order, source, command, targets):
+        now = time.perf_counter()
+        self._stop('action', now)
+        self.counts['action'] += 1
+        self.started['action'] = now
+
+    def on_damage(self, turn_id, command, source, target, damage):
+        self.counts['damage'] += 1
+
+    def on_defeat(self, turn_id, source, target):
+        self.counts['defeat'] += 1
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        return {phase: dict(count=self.counts[phase],
+                            seconds=self.seconds.get(phase),
+                            per_sec=self.counts[phase] / self.seconds[phase]
+                            if self.seconds.get(phase) else None)
+                for phase in self.counts}
+
+
+class SampledTracer(Listener):
+    """
+    every バトルに一度だけ、そのバトルのイベントを記録する
+    シミュレーションの乱数は消費しないので、結果は変わらない
+    """
+
+    def __init__(self, every: int = 1000, max_events: int = 100000):
+        self.every = every
+        self.active = False
+        self.battle_id = -1
+        self.trace: Deque[Tuple] = deque(maxlen=max_events)
+
+    def on_battle_start(self, battle_id, teams):
+        self.active = battle_id % self.every == 0
+        self.battle_id = battle_id
+        if self.active:
+            self.trace.append((battle_id, 'battle_start'))
+
+    def on_battle_end(self, battle_id, win_team, turn_id):
+        if self.active:
+            self.trace.append((battle_id, 'battle_end', win_team, turn_id))
+        self.active = False
+
+    def on_turn_start(self, turn_id, units):
+        if self.active:
+            self.trace.append((self.battle_id, 'turn_start', turn_id))
+
+    def on_action(self, turn_id, order, source, command, targets):
+        if self.active:
+            self.trace.append((self.battle_id, 'action', turn_id, order, str(source),
+                               type(command).__name__, [str(t) for t in targets]))
+
+    def on_damage(self, turn_id, command, source, target, damage):
+        if self.active:
+            self.trace.append((self.battle_id, 'damage', turn_id, str(source), str(target), damage))
+
+    def on_defeat(self, turn_id, source, target):
+        if self.active:
+            self.trace.append((self.battle_id, 'defeat', turn_id, str(source), str(target)))
@@ -1,20 +1,58 @@
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+from collections import OrderedDict
+from pathlib import Path
 from dataclasses import dataclass, field
 import random
+import time
 
 import numpy as np
 
-from .status import Side, statuses
+from .status import Side, Status, statuses
 from .unit import Unit
 from .team import Team
-from .command import Command, AttackCommand
-from .estimator import Estimator
+from .command import Command, AttackCommand, Options, TargetTable
+from .table import LookupTable
+from .draws import draws
+from .batch import BatchBattle, BatchState
+
+if TYPE_CHECKING:
+    from .estimator import Estimator
+
+
+def n_class(roster: List[Status]) -> int:
+    # ステータス ID をクラスとする（同じ ID のユニットが何体いてもクラス数は増えない）
+    return max(s.id for s in roster) + 1
+
+
+def pad_candidates(candidates: List[List[Unit]], attr: str, fill=0) -> np.ndarray:
+    # 候補数の異なる行を (行数, 最大候補数) の配列に詰める
+    values = np.full((len(candidates), max(map(len, candidates))), fill, dtype=np.float64)
+    for row, targets in enumerate(candidates):
+        values[row, :len(targets)] = [getattr(t, attr) for t in targets]
+    return values
+
+
+def candidate_mask(candidates: List[List[Unit]]) -> np.ndarray:
+    # 詰め物でない位置のマスク
+    lengths = np.array([len(targets) for targets in candidates])
+    return np.arange(lengths.max())[np.newaxis, :] < lengths[:, np.newaxis]
+
+
+def argmax_last(values: np.ndarray) -> np.ndarray:
+    # 同順位なら後ろのユニットを選ぶ（安定ソートの末尾を取るのと同じ）
+    return values.shape[1] - 1 - np.argmax(values[:, ::-1], axis=1)
 
 
 class Gambit:
     def reset(self, teams: List[Team]):
         pass
 
+    def seed(self, seed: int):
+        """
+        作戦が使う乱数を初期化する（BattleRunner がバトルごとに呼ぶ）
+        """
+        pass
+
     def select_command(self,
                        source: Unit,
                        units: List[Unit],
@@ -22,6 +60,73 @@ class Gambit:
                        ) -> Tuple[Command, List[Unit]]:
         pass
 
+    def options(self,
+                source: Unit,
+                units: List[Unit],
+                commands: List[Command]
+                ) -> Options:
+        """
+        (コマンド, 対象の組) の候補の表（BattleState の索引があれば、それから作って使い回す）
+        """
+        table = commands[0].table
+        if table is None:
+            table = TargetTable.from_units(units)
+        return table.options(source, commands)
+
+    def score_options(self, source: Unit, options: Options) -> np.ndarray:
+        """
+        候補ごとの評価値を一括で求める（コマンドが複数ある場合に使う）
+        """
+        raise NotImplementedError(
+            "%s does not support multiple commands" % type(self).__name__)
+
+    def attack_command(self, commands: List[Command]) -> Command:
+        # 攻撃しかできない作戦は、コマンドが複数あればエラーにする（黙って攻撃しない）
+        if len(commands) > 1:
+            raise NotImplementedError(
+                "%s does not support multiple commands" % type(self).__name__)
+        return commands[0]
+
+    def select_many(self,
+                    sources: List[Unit],
+                    candidates: List[List[Unit]]
+                    ) -> List[int]:
+        """
+        複数の (行動ユニット, 攻撃対象の候補) について、選んだ候補の位置を返す（決定サーバー用）
+        既定では select_command を一つずつ呼ぶ
+        """
+        commands: List[Command] = [AttackCommand()]
+        result = []
+        for source, targets in zip(sources, candidates):
+            _, chosen = self.select_command(source, [source] + targets, commands)
+            result.append(targets.index(chosen[0]))
+        return result
+
+    def select_targets(self,
+                       state: 'BatchState',
+                       battles: np.ndarray,
+                       sources: np.ndarray,
+                       candidates: np.ndarray
+                       ) -> np.ndarray:
+        """
+        BatchBattle 用に、行動ユニットごとの攻撃対象を一括で選ぶ
+        """
+        raise NotImplementedError(
+            "%s does not support batch simulation" % type(self).__name__)
+
+    def target_probabilities(self,
+                             state: 'BatchState',
+                             battles: np.ndarray,
+                             sources: np.ndarray,
+                             candidates: np.ndarray
+                             ) -> np.ndarray:
+        """
+        攻撃対象ごとの選択確率（既定では select_targets が決定的な作戦とみなす）
+        """
+        probs = np.zeros(candidates.shape)
+        probs[np.arange(len(sources)), self.select_targets(state, battles, sources, candidates)] = 1.0
+        return probs
+
 
 @dataclass
 class NaiveGambit(Gambit):
@@ -29,16 +134,44 @@ class NaiveGambit(Gambit):
     ランダムに行動する
     """
 
+    # seed されるまではバトルと同じ乱数の供給元を使う
+    rng: Optional[random.Random] = field(default=None, repr=False, compare=False)
+
+    def seed(self, seed: int):
+        self.rng = random.Random(seed)
+
     def select_command(self,
                        source: Unit,
                        units: List[Unit],
                        commands: List[Command]
                        ) -> Tuple[Command, List[Unit]]:
+        if len(commands) > 1:
+            # コマンドと対象の組の候補から一様に選ぶ
+            options = self.options(source, units, commands)
+            return options.choose((self.rng or draws.source).choice(range(len(options))))
         command = commands[0]  # 一択のためコマンドは固定
         targets = command.targets(source, units)
-        targets[:] = [random.choice(targets)]
+        targets[:] = [(self.rng or draws.source).choice(targets)]
         return command, targets
 
+    def select_targets(self,
+                       state: 'BatchState',
+                       battles: np.ndarray,
+                       sources: np.ndarray,
+                       candidates: np.ndarray
+                       ) -> np.ndarray:
+        # 攻撃対象の中から一様に選ぶ
+        keys = state.rng.random(candidates.shape)
+        return np.argmax(np.where(candidates, keys, -1.0), axis=1)
+
+    def target_probabilities(self,
+                             state: 'BatchState',
+                             battles: np.ndarray,
+                             sources: np.ndarray,
+                             candidates: np.ndarray
+                             ) -> np.ndarray:
+        return candidates / candidates.sum(axis=1, keepdims=True)
+
 
 @dataclass
 class CunningGambit(Gambit):
@@ -57,11 +190,49 @@ class CunningGambit(Gambit):
                        units: List[Unit],
                        commands: List[Command]
                        ) -> Tuple[Command, List[Unit]]:
+        if len(commands) > 1:
+            options = self.options(source, units, commands)
+            index = argmax_last(self.score_options(source, options)[np.newaxis, :])[0]
+            return options.choose(int(index))
         command = commands[0]  # 一択のためコマンドは固定
         targets = command.targets(source, units)
         targets.sort(key=lambda t: self.estimate_priority(source, t))
         return command, targets[-1:]
 
+    def score_options(self, source: Unit, options: Options) -> np.ndarray:
+        # 対象ごとの推定価値の和（攻撃だけなら estimate_priority と同じ値）
+        return options.estimate(source)
+
+    def select_many(self,
+                    sources: List[Unit],
+                    candidates: List[List[Unit]]
+                    ) -> List[int]:
+        source_atk = np.array([[s.attack] for s in sources])
+        source_def = np.array([[s.defence] for s in sources])
+        target_atk = pad_candidates(candidates, 'attack')
+        target_def = pad_candidates(candidates, 'defence')
+        life_max = pad_candidates(candidates, 'life_max', fill=1)
+        damage_taken = np.maximum((target_atk - source_def // 2) // 2, 0)
+        damage_given = np.maximum((source_atk - target_def // 2) // 2, 0)
+        priority = damage_taken / life_max * damage_given
+        mask = candidate_mask(candidates)
+        return argmax_last(np.where(mask, priority, -np.inf)).tolist()
+
+    def select_targets(self,
+                       state: 'BatchState',
+                       battles: np.ndarray,
+                       sources: np.ndarray,
+                       candidates: np.ndarray
+                       ) -> np.ndarray:
+        source_atk = state.attack[battles, sources][:, np.newaxis]
+        source_def = state.defence[battles, sources][:, np.newaxis]
+        target_atk = state.attack[battles]
+        target_def = state.defence[battles]
+        damage_taken = np.maximum((target_atk - source_def // 2) // 2, 0)
+        damage_given = np.maximum((source_atk - target_def // 2) // 2, 0)
+        priority = damage_taken / state.life_max[battles] * damage_given
+        return argmax_last(np.where(candidates, priority, -np.inf))
+
 
 @dataclass
 class MLbasedGambit(Gambit):
@@ -72,16 +243,36 @@ class MLbasedGambit(Gambit):
     is_training: bool = False
     source_side: Side = Side.PLAYER
     target_side: Side = Side.MONSTER
-    estimators: List[Estimator] = field(default_factory=list)
-    n_class: int = field(init=False)
+    embedding: bool = False
+    multi_head: bool = False
+    heads: Tuple[str, ...] = ('TakenDamage', 'GivenDamage', 'MaxHP')
+    table_path: Optional[Path] = None
+    estimators: List['Estimator'] = field(default_factory=list)
+    # 省略すると、相手陣営のステータス ID の最大値 + 1（ID をクラスとして符号化する）
+    n_class: Optional[int] = None
+    table: Optional[LookupTable] = field(default=None, init=False, repr=False)
+    cache: Dict[Tuple[int, int, int], float] = field(default_factory=dict, repr=False)
 
     def __post_init__(self):
-        self.n_class = len(statuses[self.target_side])
-        self.estimators = [
-            Estimator('TakenDamage', self.n_class),
-            Estimator('GivenDamage', self.n_class),
-            Estimator('MaxHP', self.n_class),
-        ]
+        if self.n_class is None:
+            self.n_class = n_class(statuses[self.target_side])
+        if self.table_path is not None:
+            # 参照テーブルで推定する（TensorFlow は読み込まない）
+            self.table = LookupTable.load(self.table_path)
+            return
+
+        from .estimator import Estimator, MultiHeadEstimator
+
+        if self.multi_head:
+            self.estimators = [
+                MultiHeadEstimator('MultiHead', self.n_class, list(self.heads),
+                                   embedding=self.embedding),
+            ]
+        else:
+            self.estimators = [
+                Estimator(name, self.n_class, embedding=self.embedding)
+                for name in self.heads
+            ]
 
         for reg in self.estimators:
             if not self.is_training:
@@ -89,34 +280,262 @@ class MLbasedGambit(Gambit):
             else:
                 reg.build_model()
 
-    def id2vec(self, _id: int):
-        return np.eye(self.n_class)[_id]
+        if not self.is_training:
+            self.precompute()
 
-    def estimate_priority(self, source: Unit, target: Unit):
-        # 被ダメージの推定
-        Xv = np.array([[source.defence]], dtype=np.float32)
-        Xc = np.array([self.id2vec(target.id)], dtype=np.float32)
-        damage_taken = self.estimators[0].model.predict([Xv, Xc])
+    def id2vec(self, _id):
+        vec = np.zeros(self.n_class)
+        vec[_id] = 1.0
+        return vec
+
+    def clear_cache(self):
+        # モデルの重みを更新したら推論結果を破棄する
+        self.cache.clear()
+
+    def swap_weights(self, weights: List[List[np.ndarray]]):
+        """
+        推定器ごとの重みを差し替える（同じプロセスの OnlineTrainer から）
+        レジストリで共有しているモデルなら、共有している全インスタンスに効く
+        """
+        for reg, w in zip(self.estimators, weights):
+            reg.model.set_weights(w)
+        self.clear_cache()
+
+    def reload(self):
+        """
+        保存し直されたモデルや参照テーブルを読み直す（別プロセスのチェックポイントから）
+        """
+        if self.table_path is not None:
+            self.table = LookupTable.load(self.table_path)
+        for reg in self.estimators:
+            reg.load_model()
+        self.clear_cache()
+
+    def precompute(self):
+        """
+        既知のステータスと全クラスの組み合わせを、あらかじめ推論しておく
+        """
+        sources = statuses[self.source_side]
+        self.predict([
+            np.array([[s.defence] for s in sources]),  # 被ダメージ
+            np.array([[s.attack] for s in sources]),   # 与ダメージ
+            1,                                         # 最大HP
+        ], np.arange(self.n_class)[np.newaxis, :])
+
+    def export_table(self,
+                     path: Optional[Path] = None,
+                     grid: Optional[List[np.ndarray]] = None) -> LookupTable:
+        """
+        推定器を 値 × クラス の参照テーブルに蒸留して保存する
+        grid を省略すると、既知のステータスの値を格子点にする
+        """
+        if grid is None:
+            sources = statuses[self.source_side]
+            grid = [
+                [s.defence for s in sources],  # 被ダメージ
+                [s.attack for s in sources],   # 与ダメージ
+                [1],                           # 最大HP
+            ]
+        grid = [np.unique(np.asarray(g, dtype=np.float32)) for g in grid]
+
+        classes = np.arange(self.n_class)[np.newaxis, :]
+        tables = []
+        for head, values in enumerate(grid):
+            inputs = [g[0] for g in grid]
+            inputs[head] = values[:, np.newaxis]
+            tables.append(self.predict(inputs, classes)[head])
+
+        table = LookupTable(list(self.heads), grid, tables)
+        table.save(path or self.estimators[0].get_dir() / 'table.npz')
+        return table
+
+    def predict(self, values: List[np.ndarray], classes: np.ndarray) -> List[np.ndarray]:
+        """
+        推定ごとの入力値に対する推定結果を返す
+        (推定, 値, クラス) 単位でキャッシュし、未知の組み合わせだけを推定器ごとに一括で推論する
+        """
+        if self.table is not None:
+            return [self.table.lookup(head, v, classes) for head, v in enumerate(values)]
+
+        arrays = np.broadcast_arrays(*values, classes)
+        shape = arrays[0].shape
+        rows, inverse = np.unique(
+            np.stack([a.ravel() for a in arrays], axis=1).astype(np.int64),
+            axis=0, return_inverse=True)
+        n_head = len(values)
+        keys = [[(index, int(row[index]), int(row[-1])) for row in rows]
+                for index in range(n_head)]
 
-        # 与ダメージの推定
-        Xv = np.array([[source.attack]], dtype=np.float32)
-        Xc = np.array([self.id2vec(target.id)], dtype=np.float32)
-        damage_given = self.estimators[1].model.predict([Xv, Xc])
+        missing = [[j for j, k in enumerate(keys[index]) if k not in self.cache]
+                   for index in range(n_head)]
+        if self.multi_head:
+            # 一つでも欠けていれば、全推定を一度に推論する
+            index = sorted(set(j for m in missing for j in m))
+            if index:
+                y = self.estimators[0].predict(rows[index, :-1], rows[index, -1])
+                for head in range(n_head):
+                    self.cache.update(zip([keys[head][j] for j in index], y[:, head].tolist()))
+        else:
+            for head, index in enumerate(missing):
+                if index:
+                    y = self.estimators[head].predict(rows[index, head], rows[index, -1])
+                    self.cache.update(zip([keys[head][j] for j in index], y.tolist()))
 
-        # 最大HPの推定
-        Xv = np.array([[1]], dtype=np.float32)
-        Xc = np.array([self.id2vec(target.id)], dtype=np.float32)
-        life_max = self.estimators[2].model.predict([Xv, Xc])
+        results = []
+        for head in range(n_head):
+            y = np.array([self.cache[k] for k in keys[head]], dtype=np.float32)
+            results.append(y[inverse.reshape(-1)].reshape(shape))
+        return results
+
+    def estimate_priorities(self,
+                            defence: np.ndarray,
+                            attack: np.ndarray,
+                            classes: np.ndarray) -> np.ndarray:
+        # 被ダメージ、与ダメージ、最大HPの推定
+        damage_taken, damage_given, life_max = self.predict([defence, attack, 1], classes)
 
         # 優先度の推定
         return damage_taken / life_max * damage_given
 
+    def estimate_priority(self, source: Unit, target: Unit):
+        return float(self.estimate_priorities(source.defence, source.attack, target.id))
+
     def select_command(self,
                        source: Unit,
                        units: List[Unit],
                        commands: List[Command]
                        ) -> Tuple[Command, List[Unit]]:
-        command = commands[0]  # 一択のためコマンドは固定
+        command = self.attack_command(commands)
         targets = command.targets(source, units)
-        targets.sort(key=lambda t: self.estimate_priority(source, t))
-        return command, targets[-1:]
+        priority = self.estimate_priorities(
+            source.defence, source.attack, np.array([t.id for t in targets]))
+        return command, [targets[int(argmax_last(priority[np.newaxis, :])[0])]]
+
+    def select_many(self,
+                    sources: List[Unit],
+                    candidates: List[List[Unit]]
+                    ) -> List[int]:
+        # 全リクエストの候補を詰めて、一度の推論で優先度を求める
+        mask = candidate_mask(candidates)
+        classes = pad_candidates(candidates, 'id').astype(np.int64)
+        priority = self.estimate_priorities(
+            np.array([[s.defence] for s in sources]),
+            np.array([[s.attack] for s in sources]),
+            classes)
+        return argmax_last(np.where(mask, priority, -np.inf)).tolist()
+
+    def select_targets(self,
+                       state: 'BatchState',
+                       battles: np.ndarray,
+                       sources: np.ndarray,
+                       candidates: np.ndarray
+                       ) -> np.ndarray:
+        # 攻撃対象外はクラスを 0 に寄せて、推論する組み合わせを増やさない
+        classes = np.where(candidates, state.status_id[np.newaxis, :], 0)
+        priority = self.estimate_priorities(
+            state.defence[battles, sources][:, np.newaxis],
+            state.attack[battles, sources][:, np.newaxis],
+            classes)
+        return argmax_last(np.where(candidates, priority, -np.inf))
+
+
+@dataclass
+class RolloutGambit(Gambit):
+    """
+    モンテカルロ法で先読みし、勝率が最も高い攻撃対象を選ぶ
+    攻撃対象の候補ごとに、残りのバトルを BatchBattle でまとめてロールアウトする
+    """
+
+    n_rollout: int = 256
+    batch_size: int = 256
+    time_budget: Optional[float] = None
+    max_turn: int = 100
+    # seed() メソッドと名前が重ならないようにする
+    rng_seed: Optional[int] = None
+    cache_size: int = 100000
+    policies: Optional[List[Gambit]] = None
+    teams: List[Team] = field(default_factory=list, init=False, repr=False)
+    rng: np.random.Generator = field(init=False, repr=False)
+    cache: 'OrderedDict[bytes, Tuple[np.ndarray, np.ndarray]]' = field(
+        default_factory=OrderedDict, init=False, repr=False)
+
+    def __post_init__(self):
+        # global な random は使わないので、他の作戦の乱数の引き順は変わらない
+        self.rng = np.random.default_rng(self.rng_seed)
+
+    def reset(self, teams: List[Team]):
+        self.teams = teams
+
+    def seed(self, seed: int):
+        self.rng = np.random.default_rng(seed)
+
+    def rollout_policies(self, team_id: int) -> List[Gambit]:
+        # ロールアウト中は、自陣営は CunningGambit、他陣営は NaiveGambit で行動する
+        if self.policies is not None:
+            return self.policies
+        return [CunningGambit() if team.id == team_id else NaiveGambit() for team in self.teams]
+
+    def state_key(self, source: Unit, rest: List[int]) -> bytes:
+        # HP と行動順が同じ局面は同じ結果になる（ターン数は先読みの上限にしか効かないので含めない）
+        units = [u for team in self.teams for u in team.units]
+        key = [u.life for u in units] + [u.life_max for u in units] + [source.index, -1] + rest
+        return np.array(key, dtype=np.int64).tobytes()
+
+    def rollout(self, source: Unit, candidates: np.ndarray, rest: List[int]) -> np.ndarray:
+        """
+        候補ごとに batch_size 回ずつロールアウトし、候補ごとの勝利数を返す
+        """
+        n_battle = len(candidates) * self.batch_size
+        state = BatchState.from_teams(self.teams, n_battle, self.rng, reset=False)
+        battles = np.arange(n_battle)
+        sources = np.full(n_battle, source.index)
+        targets = np.repeat(candidates, self.batch_size)
+
+        # 最初の攻撃だけは候補を固定して行う
+        BatchBattle.attack(state, battles, sources, targets)
+        finished = ~state.has_adversary(battles, state.team[sources])
+        winner = np.where(finished, source.team, -1)
+
+        first_order = np.array(rest, dtype=np.int64) if rest else None
+        BatchBattle(n_battle).run(state, self.rollout_policies(source.team), self.max_turn,
+                                  first_order=first_order, running=~finished, winner=winner)
+        wins = winner == source.team
+        return wins.reshape(len(candidates), self.batch_size).sum(axis=1)
+
+    def select_command(self,
+                       source: Unit,
+                       units: List[Unit],
+                       commands: List[Command]
+                       ) -> Tuple[Command, List[Unit]]:
+        command = self.attack_command(commands)
+        targets = command.targets(source, units)
+        if len(targets) == 1:
+            return command, targets
+
+        # このターンでまだ行動していないユニット
+        position = next(i for i, u in enumerate(units) if u is source)
+        rest = [u.index for u in units[position + 1:]]
+        candidates = np.array([t.index for t in targets], dtype=np.int64)
+
+        key = self.state_key(source, rest)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            wins, counts = self.cache[key]
+        else:
+            wins = np.zeros(len(candidates), dtype=np.int64)
+            counts = np.zeros(len(candidates), dtype=np.int64)
+
+        # 回数か時間の上限までロールアウトを繰り返す
+        start = time.perf_counter()
+        while counts.min() < self.n_rollout:
+            wins = wins + self.rollout(source, candidates, rest)
+            counts = counts + self.batch_size
+            if self.time_budget is not None and \
+                    time.perf_counter() - start >= self.time_budget:
+                break
+
+        self.cache[key] = wins, counts
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return command, [targets[int(argmax_last((wins / counts)[np.newaxis, :])[0])]]
@@ -1,5 +1,7 @@
-from typing import List, Tuple, Optional
-from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Tuple, Optional
+from dataclasses import dataclass, fields
+
+import numpy as np
 
 
 @dataclass(frozen=True)
@@ -8,7 +10,7 @@ class TurnLog:
     ターンログ
     """
     turn_id: int
-    order: int
+    order: int   # そのターンの生存ユニットの中での行動順（倒されたユニットは数えない）
     command: int
     source_id: int
     source_side: int
@@ -25,3 +27,159 @@ class TurnLog:
     damage: int
     damage_cumsum: int
     defeated: bool
+
+
+# 観測できないステータスの番兵値
+MISSING = -1
+
+
+class TurnLogs:
+    """
+    列指向のターンログ（型付き NumPy 配列に追記する）
+    """
+
+    dtypes = dict(
+        turn_id=np.int32,
+        order=np.int32,
+        command=np.int8,
+        source_id=np.int16,
+        source_side=np.int8,
+        source_hp=np.int32,
+        source_atk=np.int32,
+        source_def=np.int32,
+        source_spd=np.int32,
+        target_id=np.int16,
+        target_side=np.int8,
+        target_hp=np.int32,
+        target_atk=np.int32,
+        target_def=np.int32,
+        target_spd=np.int32,
+        damage=np.int32,
+        damage_cumsum=np.int32,
+        defeated=np.bool_,
+    )
+    optionals = {f.name for f in fields(TurnLog) if f.type == Optional[int]}
+
+    def __init__(self, capacity: int = 1024):
+        self.size = 0
+        self.commands: List = []
+        self.data: Dict[str, np.ndarray] = {
+            name: np.empty(capacity, dtype=dtype) for name, dtype in self.dtypes.items()}
+
+    @classmethod
+    def from_records(cls, records: np.ndarray, commands: List) -> 'TurnLogs':
+        """
+        固定長レコード配列（メモリマップ可）を、コピーせずに列として扱う
+        """
+        logs = cls(capacity=0)
+        logs.commands = list(commands)
+        logs.data = {name: records[name] for name in cls.dtypes}
+        logs.size = len(records)
+        return logs
+
+    def to_records(self) -> np.ndarray:
+        records = np.empty(self.size, dtype=record_dtype)
+        for name in self.dtypes:
+            records[name] = getattr(self, name)
+        return records
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getattr__(self, name: str) -> np.ndarray:
+        # 列はコピーせずにビューで返す
+        if name in self.dtypes:
+            return self.data[name][:self.size]
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        return dict(size=self.size, commands=self.commands,
+                    data={k: v[:self.size] for k, v in self.data.items()})
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __getitem__(self, index: int) -> TurnLog:
+        if not -self.size <= index < self.size:
+            raise IndexError(index)
+        index %= self.size
+        row = {}
+        for name, column in self.data.items():
+            value = column[index].item()
+            row[name] = None if name in self.optionals and value == MISSING else value
+        row['command'] = self.commands[row['command']]
+        return TurnLog(**row)
+
+    def __iter__(self) -> Iterator[TurnLog]:
+        for index in range(self.size):
+            yield self[index]
+
+    def reserve(self, size: int):
+        capacity = len(self.data['turn_id'])
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity = max(capacity * 2, 1)
+        for name, column in self.data.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.data[name] = grown
+
+    def command_id(self, command) -> int:
+        if command not in self.commands:
+            self.commands.append(command)
+        return self.commands.index(command)
+
+    def append(self, log: TurnLog):
+        self.reserve(self.size + 1)
+        for name, column in self.data.items():
+            value = getattr(log, name)
+            if name == 'command':
+                value = self.command_id(value)
+            elif value is None:
+                value = MISSING
+            column[self.size] = value
+        self.size += 1
+
+    def append_columns(self, command, **columns: np.ndarray):
+        """
+        同じコマンドのログを列単位でまとめて追記する
+        """
+        n = len(columns['turn_id'])
+        self.reserve(self.size + n)
+        columns['command'] = self.command_id(command)
+        for name, column in self.data.items():
+            column[self.size:self.size + n] = columns[name]
+        self.size += n
+
+    def extend(self, logs: Iterable[TurnLog]):
+        if not isinstance(logs, TurnLogs):
+            for log in logs:
+                self.append(log)
+            return
+
+        n = len(logs)
+        self.reserve(self.size + n)
+        remap = np.array([self.command_id(c) for c in logs.commands], dtype=np.int8)
+        for name, column in self.data.items():
+            values = getattr(logs, name)
+            column[self.size:self.size + n] = remap[values] if name == 'command' else values
+        self.size += n
+
+    def masked(self, name: str) -> np.ma.MaskedArray:
+        # 観測できない値をマスクした列
+        return np.ma.masked_equal(getattr(self, name), MISSING)
+
+    def where(self, mask: np.ndarray) -> 'TurnLogs':
+        """
+        条件に合う行だけを取り出す（例: logs.where(logs.target_side == Side.PLAYER)）
+        """
+        selected = TurnLogs(capacity=0)
+        selected.commands = list(self.commands)
+        selected.data = {k: getattr(self, k)[mask] for k in self.dtypes}
+        selected.size = len(selected.data['turn_id'])
+        return selected
+
+
+# ファイルに書き出す際の固定長レコード
+record_dtype = np.dtype(list(TurnLogs.dtypes.items()))
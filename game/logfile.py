@@ -0,0 +1,141 @@
+from typing import Iterable, Iterator, List, Optional
+from pathlib import Path
+import json
+import queue
+import threading
+
+import numpy as np
+
+from . import logger
+from .log import TurnLog, TurnLogs, record_dtype
+
+
+class TurnLogWriter:
+    """
+    ターンログを固定長レコードのチャンクファイルへ書き出す（書き込みはバックグラウンド）
+    """
+
+    def __init__(self, path: Path, chunk_size: int = 1 << 20, max_pending: int = 4):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.chunk_size = chunk_size
+        self.n_chunk = len(list(self.path.glob('chunk-*.npy')))
+        self.buffer = TurnLogs(chunk_size)
+        self.commands: List[str] = []
+        self.pending: queue.Queue = queue.Queue(max_pending)
+        # 書き込みスレッドで起きた例外（次の flush / close で送出する）
+        self.error: Optional[Exception] = None
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> 'TurnLogWriter':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+    def append(self, log: TurnLog):
+        self.buffer.append(log)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def extend(self, logs: Iterable[TurnLog]):
+        self.buffer.extend(logs)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        self.raise_error()
+        if len(self.buffer) == 0:
+            return
+
+        # コマンドはクラス名で記録する
+        names = [type(c).__name__ if not isinstance(c, str) else c
+                 for c in self.buffer.commands]
+        for name in names:
+            if name not in self.commands:
+                self.commands.append(name)
+        remap = np.array([self.commands.index(n) for n in names], dtype=np.int8)
+
+        records = self.buffer.to_records()
+        records['command'] = remap[records['command']]
+        path = self.path / ('chunk-%06d.npy' % self.n_chunk)
+        self.n_chunk += 1
+        self.put((path, records))
+        self.buffer = TurnLogs(self.chunk_size)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.put(None, check=False)
+            self.thread.join()
+        # 書けなかったチャンクがあれば meta.json は書かない（読める形に見せない）
+        self.raise_error()
+        meta = dict(commands=self.commands, dtype=record_dtype.descr)
+        (self.path / 'meta.json').write_text(json.dumps(meta))
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, item, check: bool = True):
+        # キューが空くのを待つ間も、書き込みスレッドの失敗を調べる（止まったスレッドを待ち続けない）
+        while True:
+            if check:
+                self.raise_error()
+            try:
+                self.pending.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if not self.thread.is_alive():
+                    if check:
+                        raise RuntimeError("turn log writer thread has stopped")
+                    return
+
+    def _write(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            if self.error is not None:
+                # 失敗した後は書かずに読み捨てる（flush が詰まらないように）
+                continue
+            path, records = item
+            logger.debug("write %d logs to %s" % (len(records), path))
+            try:
+                np.save(path, records)
+            except Exception as e:
+                self.error = e
+                try:
+                    # 書きかけのチャンクは残さない
+                    path.unlink()
+                except OSError:
+                    pass
+
+
+class TurnLogReader:
+    """
+    チャンクファイルをメモリマップで読み込む
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        meta = json.loads((self.path / 'meta.json').read_text())
+        self.commands: List[str] = meta['commands']
+        self.files = sorted(self.path.glob('chunk-*.npy'))
+
+    def __len__(self) -> int:
+        return sum(len(chunk) for chunk in self)
+
+    def __iter__(self) -> Iterator[TurnLogs]:
+        for path in self.files:
+            records = np.load(path, mmap_mode='r')
+            yield TurnLogs.from_records(records, self.commands)
+
+    @staticmethod
+    def exists(path: Optional[Path]) -> bool:
+        return path is not None and (Path(path) / 'meta.json').exists()
@@ -0,0 +1,131 @@
+from typing import List, Optional, Tuple
+from dataclasses import dataclass, field
+import math
+import time
+
+import numpy as np
+
+from . import logger
+from .status import Side
+from .log import TurnLogs
+from .gambit import MLbasedGambit
+
+
+def attack_logs(logs: TurnLogs) -> TurnLogs:
+    # 推定器は通常攻撃のダメージを学習するので、他のコマンドのログは除く
+    names = [c if isinstance(c, str) else type(c).__name__ for c in logs.commands]
+    if all(name == 'AttackCommand' for name in names):
+        return logs
+    attack = np.array([name == 'AttackCommand' for name in names])
+    return logs.where(attack[logs.command])
+
+
+def make_dataset(ai: MLbasedGambit, i: int, logs: TurnLogs
+                 ) -> Tuple[np.ndarray, ...]:
+    logs = attack_logs(logs)
+    if ai.multi_head:  # 全推定をまとめて学習（対象外のヘッドは重み 0）
+        taken = logs.target_side == Side.PLAYER
+        given = logs.source_side == Side.PLAYER
+        V = np.stack([
+            np.where(taken, logs.target_def, 0),
+            np.where(given, logs.source_atk, 0),
+            logs.defeated,
+        ], axis=1).astype(np.float32)
+        c = np.where(taken, logs.source_id, logs.target_id).astype(np.int32)
+        Y = np.stack([logs.damage, logs.damage, logs.damage_cumsum], axis=1).astype(np.float32)
+        W = np.stack([taken, given, given], axis=1).astype(np.float32)
+        return V, c, Y, W
+
+    if i == 0:  # 被ダメージ
+        mask = logs.target_side == Side.PLAYER
+        y = logs.damage[mask, np.newaxis].astype(np.float32)
+        Xv = logs.target_def[mask, np.newaxis].astype(np.float32)
+        c = logs.source_id[mask].astype(np.int32)
+    elif i == 1:  # 与ダメージ
+        mask = logs.source_side == Side.PLAYER
+        y = logs.damage[mask, np.newaxis].astype(np.float32)
+        Xv = logs.source_atk[mask, np.newaxis].astype(np.float32)
+        c = logs.target_id[mask].astype(np.int32)
+    elif i == 2:  # 最大HP
+        mask = logs.source_side == Side.PLAYER
+        y = logs.damage_cumsum[mask, np.newaxis].astype(np.float32)
+        Xv = logs.defeated[mask, np.newaxis].astype(np.float32)
+        c = logs.target_id[mask].astype(np.int32)
+    return Xv, c, y
+
+
+@dataclass
+class OnlineTrainer:
+    """
+    届いたログで推定器を少しずつ学習し、重みを実行中の作戦へ差し替える
+    ログの書き出し先として BattleRunner.run(logs=...) や BatchBattle.simulate に渡せる
+    """
+
+    ai: MLbasedGambit
+    min_samples: int = 4096
+    batch_size: int = 128
+    epochs: int = 1
+    checkpoint_every: int = 10
+    export_table: bool = False
+    seed: Optional[int] = None
+    gambits: List[MLbasedGambit] = field(default_factory=list, init=False, repr=False)
+    pending: TurnLogs = field(default_factory=TurnLogs, init=False, repr=False)
+    n_update: int = field(default=0, init=False)
+    n_sample: int = field(default=0, init=False)
+    losses: List[float] = field(default_factory=list, init=False, repr=False)
+
+    def resume(self):
+        # 保存済みのモデルがあれば、その重みから学習を続ける
+        for reg in self.ai.estimators:
+            if reg.get_path().exists():
+                reg.load_weights()
+
+    def subscribe(self, gambit: MLbasedGambit):
+        self.gambits.append(gambit)
+        gambit.swap_weights(self.weights())
+
+    def weights(self) -> List[List[np.ndarray]]:
+        return [reg.model.get_weights() for reg in self.ai.estimators]
+
+    def extend(self, logs: TurnLogs):
+        self.pending.extend(logs)
+        if len(self.pending) >= self.min_samples:
+            self.update()
+
+    def update(self):
+        """
+        たまったログで全推定器を更新し、購読中の作戦へ重みを配る
+        """
+        if len(self.pending) == 0:
+            return
+        logs, self.pending = self.pending, TurnLogs()
+
+        start = time.perf_counter()
+        losses = []
+        for i, reg in enumerate(self.ai.estimators):
+            chunk = make_dataset(self.ai, i, logs)
+            losses.append(reg.partial_fit(chunk, self.batch_size, self.epochs,
+                                          seed=None if self.seed is None else self.seed + self.n_update))
+        self.n_update += 1
+        self.n_sample += len(logs)
+        self.losses.append(float(np.nanmean(losses)) if losses else math.nan)
+        logger.info("online update %d: %d logs, loss %.5f (%.2f sec)" % (
+            self.n_update, len(logs), self.losses[-1], time.perf_counter() - start))
+
+        self.publish()
+        if self.checkpoint_every and self.n_update % self.checkpoint_every == 0:
+            self.checkpoint()
+
+    def publish(self):
+        weights = self.weights()
+        for gambit in self.gambits:
+            gambit.swap_weights(weights)
+
+    def checkpoint(self):
+        # 他のプロセスは MLbasedGambit.reload() で読み直す
+        for reg in self.ai.estimators:
+            reg.save_model()
+        if self.export_table:
+            self.ai.clear_cache()
+            self.ai.export_table()
+        logger.info("checkpoint after %d updates (%d logs)" % (self.n_update, self.n_sample))
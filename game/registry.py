@@ -0,0 +1,65 @@
+from typing import Any, Callable, Dict, Optional, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+import hashlib
+
+from . import logger
+
+
+@dataclass
+class ModelRegistry:
+    """
+    読み込んだモデルをプロセス内で共有する（キーは パス + 内容のハッシュ）
+    ファイルを上書きすると別のキーになり、古いモデルは LRU で追い出される
+    """
+
+    capacity: int = 16
+    models: 'OrderedDict[Tuple[str, str], Any]' = field(
+        default_factory=OrderedDict, init=False, repr=False)
+    # (パス, 更新時刻, サイズ) ごとのハッシュ（変わっていなければ読み直さない）
+    digests: Dict[Tuple[str, int, int], str] = field(default_factory=dict, init=False, repr=False)
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+
+    def key(self, path: Path) -> Tuple[str, str]:
+        path = Path(path).resolve()
+        stat = path.stat()
+        version = (str(path), stat.st_mtime_ns, stat.st_size)
+        if version not in self.digests:
+            with open(path, 'rb') as f:
+                self.digests[version] = hashlib.sha1(f.read()).hexdigest()
+        return str(path), self.digests[version]
+
+    def get(self,
+            path: Path,
+            loader: Callable[[Path], Any],
+            warm_up: Optional[Callable[[Any], None]] = None) -> Any:
+        """
+        登録済みならそのモデルを、無ければ loader で読み込み、warm_up してから返す
+        """
+        key = self.key(path)
+        if key in self.models:
+            self.hits += 1
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        self.misses += 1
+        logger.debug("load model %s (%s)" % key)
+        model = loader(path)
+        if warm_up is not None:
+            # 最初の推論で起きるグラフ構築を済ませておく
+            warm_up(model)
+        self.models[key] = model
+        while len(self.models) > self.capacity:
+            evicted, _ = self.models.popitem(last=False)
+            logger.debug("evict model %s (%s)" % evicted)
+        return model
+
+    def clear(self):
+        self.models.clear()
+        self.digests.clear()
+
+
+# プロセス全体で共有するレジストリ
+models = ModelRegistry()
@@ -0,0 +1,334 @@
+from typing import Callable, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+from functools import lru_cache
+from operator import attrgetter, lt, le, gt, ge, eq, ne
+import re
+
+import numpy as np
+
+from .unit import Unit
+from .command import COMMANDS, Command, TargetScope, TargetTable
+from .draws import draws
+from .gambit import Gambit, argmax_last
+
+# 属性名（短縮形も使える）
+ATTRIBUTES = {
+    'life': 'life', 'hp': 'life',
+    'life_max': 'life_max', 'hp_max': 'life_max',
+    'life_ratio': 'life_ratio', 'hp_ratio': 'life_ratio',
+    'attack': 'attack', 'atk': 'attack',
+    'defence': 'defence', 'def': 'defence',
+    'speed': 'speed', 'spd': 'speed',
+    'count': 'count',
+}
+OPERATORS = {'<': lt, '<=': le, '>': gt, '>=': ge, '==': eq, '!=': ne}
+
+CONDITION = re.compile(r'^(self|ally|enemy)\.(\w+)\s*(<=|>=|==|!=|<|>)\s*([-+.\d]+)(%?)$')
+SELECTOR = re.compile(r'^(?:(min|max)\((\w+)\)|(random))$')
+
+
+class RuleError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Rule:
+    """
+    条件 -> コマンド -> 対象の選び方
+    条件の対象がコマンドの対象と同じ側（攻撃なら enemy、回復なら ally）の場合は、条件を満たすユニットだけから選ぶ
+    """
+
+    subject: Optional[str]   # self, ally, enemy（None なら常に）
+    attr: Optional[str]
+    op: Optional[str]
+    value: float
+    command: str
+    order: Optional[str]     # min, max（None なら random）
+    key: Optional[str]
+
+    @classmethod
+    def parse(cls, line: str) -> 'Rule':
+        """
+        例: "ally.hp_ratio < 30% -> attack -> min(hp)"、"always -> attack -> random"
+        """
+        parts = [p.strip() for p in line.split('->')]
+        if len(parts) != 3:
+            raise RuleError("expected 'condition -> command -> selector': %r" % line)
+        condition, command, selector = parts
+
+        if command not in COMMANDS:
+            raise RuleError("unknown command %r" % command)
+
+        if condition == 'always':
+            subject = attr = op = None
+            value = 0.0
+        else:
+            m = CONDITION.match(condition)
+            if m is None or m.group(2) not in ATTRIBUTES:
+                raise RuleError("invalid condition %r" % condition)
+            subject, attr, op = m.group(1), ATTRIBUTES[m.group(2)], m.group(3)
+            value = float(m.group(4))
+            if m.group(5):
+                # % は HP の割合だけ（hp < 30% は hp_ratio < 30% と同じ）
+                if attr == 'life':
+                    attr = 'life_ratio'
+                if attr != 'life_ratio':
+                    raise RuleError("%% is only for hp or hp_ratio: %r" % condition)
+                value /= 100.0
+            if attr == 'count' and subject == 'self':
+                raise RuleError("self has no count: %r" % condition)
+
+        m = SELECTOR.match(selector)
+        if m is None or (m.group(2) is not None and
+                         ATTRIBUTES.get(m.group(2), 'count') == 'count'):
+            raise RuleError("invalid selector %r" % selector)
+        order, key = m.group(1), ATTRIBUTES.get(m.group(2)) if m.group(2) else None
+        return cls(subject, attr, op, value, command, order, key)
+
+
+def parse_rules(text: str) -> Tuple[Rule, ...]:
+    # 1 行 1 ルール、# 以降はコメント
+    lines = (line.split('#')[0].strip() for line in text.splitlines())
+    return tuple(Rule.parse(line) for line in lines if line)
+
+
+# ---- スカラー版: ルールを (行動ユニット, ユニット一覧, 対象の候補) -> 対象 の関数にする
+
+Getter = Callable[[Unit], float]
+ScalarRule = Callable[[Unit, List[Unit], List[Unit]], Optional[Unit]]
+
+
+def getter(attr: str) -> Getter:
+    if attr == 'life_ratio':
+        return lambda u: u.life / u.life_max
+    return attrgetter(attr)
+
+
+def compile_selector(rule: Rule) -> Callable[[List[Unit]], Unit]:
+    if rule.order is None:
+        return lambda targets: draws.source.choice(targets)
+    # 同順位なら後ろのユニットを選ぶ（argmax_last と同じ）
+    pick = max if rule.order == 'max' else min
+    key = getter(rule.key)
+    return lambda targets: pick(reversed(targets), key=key)
+
+
+def compile_scalar(rule: Rule) -> ScalarRule:
+    select = compile_selector(rule)
+    op, value = OPERATORS.get(rule.op), rule.value
+    # 対象の候補の側（候補と違う側の条件は、生存ユニットに当てはまるものがあるかを調べる）
+    ally = COMMANDS[rule.command].target_ally
+    side = 'ally' if ally else 'enemy'
+
+    if rule.subject is None:
+        return lambda source, units, targets: select(targets)
+
+    if rule.attr == 'count':
+        if rule.subject == side:
+            def count_targets(source, units, targets):
+                return select(targets) if op(len(targets), value) else None
+            return count_targets
+
+        def count_units(source, units, targets):
+            team = source.team
+            n = sum(1 for u in units if (u.team == team) != ally and u.life > 0)
+            return select(targets) if op(n, value) else None
+        return count_units
+
+    get = getter(rule.attr)
+    if rule.subject == 'self':
+        return lambda source, units, targets: select(targets) if op(get(source), value) else None
+
+    if rule.subject != side:
+        def exists(source, units, targets):
+            team = source.team
+            for u in units:
+                if (u.team == team) != ally and u.life > 0 and op(get(u), value):
+                    return select(targets)
+            return None
+        return exists
+
+    def filtered(source, units, targets):
+        matched = [t for t in targets if op(get(t), value)]
+        return select(matched) if matched else None
+    return filtered
+
+
+# ---- 一括版: ルールを (条件を満たす行, 対象の候補マスク, 優先度) を返す関数にする
+
+BatchRule = Callable[['RuleArrays'], Tuple[np.ndarray, np.ndarray, np.ndarray]]
+
+
+@dataclass
+class RuleArrays:
+    """
+    BatchState から必要な列だけを切り出す（行は行動ユニット、列はユニット）
+    """
+
+    state: 'BatchState'
+    battles: np.ndarray
+    sources: np.ndarray
+    candidates: np.ndarray
+    cache: Dict[str, np.ndarray] = field(default_factory=dict)
+
+    def column(self, attr: str) -> np.ndarray:
+        if attr not in self.cache:
+            state, battles = self.state, self.battles
+            if attr == 'life_ratio':
+                values = state.life[battles] / state.life_max[battles]
+            else:
+                values = getattr(state, attr)[battles]
+            self.cache[attr] = values
+        return self.cache[attr]
+
+    def source_value(self, attr: str) -> np.ndarray:
+        return self.column(attr)[np.arange(len(self.sources)), self.sources]
+
+    @property
+    def allies(self) -> np.ndarray:
+        if 'allies' not in self.cache:
+            state = self.state
+            self.cache['allies'] = (state.life[self.battles] > 0) & \
+                (state.team[np.newaxis, :] == state.team[self.sources][:, np.newaxis])
+        return self.cache['allies']
+
+
+def compile_batch(rule: Rule) -> BatchRule:
+    op, value = OPERATORS.get(rule.op), rule.value
+
+    def priority(arrays: RuleArrays) -> np.ndarray:
+        if rule.order is None:
+            return arrays.state.rng.random(arrays.candidates.shape)
+        values = arrays.column(rule.key).astype(np.float64)
+        return values if rule.order == 'max' else -values
+
+    def evaluate(arrays: RuleArrays):
+        candidates = arrays.candidates
+        if rule.subject is None:
+            matched = np.ones(len(candidates), dtype=bool)
+        elif rule.attr == 'count':
+            group = candidates if rule.subject == 'enemy' else arrays.allies
+            matched = op(group.sum(axis=1), value)
+        elif rule.subject == 'self':
+            matched = op(arrays.source_value(rule.attr), value)
+        elif rule.subject == 'ally':
+            matched = (arrays.allies & op(arrays.column(rule.attr), value)).any(axis=1)
+        else:
+            candidates = candidates & op(arrays.column(rule.attr), value)
+            matched = candidates.any(axis=1)
+        return matched, candidates, priority(arrays)
+
+    return evaluate
+
+
+@dataclass(frozen=True)
+class CompiledRules:
+    rules: Tuple[Rule, ...]
+    scalar: Tuple[ScalarRule, ...]
+    batch: Tuple[BatchRule, ...]
+
+
+@lru_cache(maxsize=4096)
+def compile_rules(text: str) -> CompiledRules:
+    """
+    ルールを一度だけ解析・コンパイルする（同じテキストは使い回す）
+    """
+    rules = parse_rules(text)
+    return CompiledRules(rules,
+                         tuple(compile_scalar(r) for r in rules),
+                         tuple(compile_batch(r) for r in rules))
+
+
+@dataclass
+class RuleGambit(Gambit):
+    """
+    ルールを上から順に調べ、最初に当てはまったルールのコマンドで行動する
+    どれにも当てはまらなければ、ランダムに攻撃する
+    """
+
+    text: str = "always -> attack -> random"
+    compiled: CompiledRules = field(init=False, repr=False)
+    bound: Optional[Tuple[List[Command], Tuple[Command, ...]]] = field(
+        default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.compiled = compile_rules(self.text)
+
+    @classmethod
+    def load(cls, path) -> 'RuleGambit':
+        with open(path) as f:
+            return cls(f.read())
+
+    @staticmethod
+    def command(name: str, commands: List[Command]) -> Command:
+        # ルールのコマンドを、このバトルで使えるコマンドから探す
+        for command in commands:
+            if type(command) is COMMANDS[name]:
+                return command
+        raise RuleError("command %r is not available in this battle" % name)
+
+    def bind(self, commands: List[Command]) -> Tuple[Command, ...]:
+        """
+        ルールごとのコマンド（末尾はどれにも当てはまらない場合の攻撃）
+        バトルの間は同じリストが渡されるので、最後に探したリストの結果を使い回す
+        """
+        if self.bound is None or self.bound[0] is not commands:
+            names = [rule.command for rule in self.compiled.rules] + ['attack']
+            self.bound = (commands, tuple(self.command(name, commands) for name in names))
+        return self.bound[1]
+
+    def select_command(self,
+                       source: Unit,
+                       units: List[Unit],
+                       commands: List[Command]
+                       ) -> Tuple[Command, List[Unit]]:
+        bound = self.bind(commands)
+        # 対象の候補は、コマンドが前のルールと変わったときだけ求め直す
+        last, targets = None, []
+        for command, scalar in zip(bound, self.compiled.scalar):
+            if command is not last:
+                last, targets = command, command.targets(source, units)
+            target = scalar(source, units, targets)
+            if target is not None:
+                break
+        else:
+            command = bound[-1]
+            if command is not last:
+                targets = command.targets(source, units)
+            target = draws.source.choice(targets)
+        if command.target_scope != TargetScope.UNIT:
+            return command, self.target_set(command, source, units, target)
+        targets[:] = [target]
+        return command, targets
+
+    @staticmethod
+    def target_set(command: Command, source: Unit, units: List[Unit], target: Unit) -> List[Unit]:
+        # 範囲が UNIT 以外のコマンドは、選んだユニットを含む対象の組に行う
+        table = command.table if command.table is not None else TargetTable.from_units(units)
+        return next(s for s in command.target_sets(source, table) if any(u is target for u in s))
+
+    def select_targets(self,
+                       state: 'BatchState',
+                       battles: np.ndarray,
+                       sources: np.ndarray,
+                       candidates: np.ndarray
+                       ) -> np.ndarray:
+        if any(rule.command != 'attack' for rule in self.compiled.rules):
+            raise NotImplementedError("batch simulation supports only attack rules")
+        arrays = RuleArrays(state, battles, sources, candidates)
+        targets = np.zeros(len(sources), dtype=np.int64)
+        pending = np.ones(len(sources), dtype=bool)
+        for rule in self.compiled.batch:
+            matched, mask, priority = rule(arrays)
+            matched &= pending
+            if matched.any():
+                chosen = argmax_last(np.where(mask, priority, -np.inf))
+                targets[matched] = chosen[matched]
+                pending &= ~matched
+            if not pending.any():
+                return targets
+
+        # どのルールにも当てはまらなければランダム
+        keys = np.where(candidates[pending], state.rng.random(candidates[pending].shape), -np.inf)
+        targets[pending] = np.argmax(keys, axis=1)
+        return targets
@@ -0,0 +1,144 @@
+from typing import Callable, List, Optional, Tuple, Counter as _Counter
+from dataclasses import dataclass, field
+from collections import Counter
+import multiprocessing
+import multiprocessing.pool
+
+import numpy as np
+
+from . import logger
+from .team import Team
+from .log import TurnLogs
+from .battle import Battle
+from .gambit import Gambit
+from .draws import RandomSource, PythonRandom
+
+GambitFactory = Callable[[], Gambit]
+
+# ワーカープロセスごとに一度だけ構築するチームと作戦、乱数の供給元
+_worker: Optional[Tuple[List[Team], List[Gambit], RandomSource]] = None
+
+
+def battle_seed(master_seed: int, battle_id: int) -> int:
+    """
+    (マスターシード, バトル ID) からバトル固有のシードを求める
+    """
+    return int(np.random.SeedSequence([master_seed, battle_id]).generate_state(1)[0])
+
+
+def _init_worker(teams: List[Team],
+                 factories: List[GambitFactory],
+                 random_source: Callable[[], RandomSource] = PythonRandom):
+    global _worker
+    _worker = (teams, [factory() for factory in factories], random_source())
+
+
+def _run_chunk(args: Tuple[int, List[int], bool, Tuple[str, ...]]) -> Tuple[np.ndarray, TurnLogs]:
+    master_seed, battle_ids, with_logs, commands = args
+    teams, gambits, source = _worker
+    winners = np.empty(len(battle_ids), dtype=np.int64)
+    logs = TurnLogs()
+
+    for i, n in enumerate(battle_ids):
+        # バトルごとに乱数を初期化し、ワーカー数に依らず同じ結果にする
+        seed = battle_seed(master_seed, n)
+        source.seed(seed)
+        for team_id, gambit in enumerate(gambits):
+            # 作戦の乱数は別の系列にして、作戦を替えてもバトル側の乱数の並びがずれないようにする
+            gambit.seed(battle_seed(seed, team_id))
+        winners[i] = Battle(n, commands).simulate(teams, gambits, logs if with_logs else [],
+                                        source=source)
+
+    return winners, logs
+
+
+@dataclass
+class BattleRunner:
+    """
+    バトル ID をプロセスプールに分配して並列にシミュレーション
+    """
+
+    teams: List[Team]
+    gambits: List[GambitFactory]
+    seed: int = 0
+    n_worker: int = 1
+    chunk_size: int = 100
+    # バトルごとの乱数の供給元（既定は global な random）
+    random_source: Callable[[], RandomSource] = PythonRandom
+    # バトルで使えるコマンドの名前
+    commands: Tuple[str, ...] = ('attack',)
+    pool: Optional[multiprocessing.pool.Pool] = field(default=None, init=False, repr=False)
+    worker: Optional[Tuple[List[Team], List[Gambit], RandomSource]] = field(
+        default=None, init=False, repr=False)
+
+    def __enter__(self) -> 'BattleRunner':
+        # with の間はプロセスプールを使い回す（run を何度も呼ぶ場合）
+        if self.n_worker > 1:
+            self.pool = multiprocessing.Pool(self.n_worker,
+                                             initializer=_init_worker,
+                                             initargs=(self.teams, self.gambits,
+                                                       self.random_source))
+        return self
+
+    def __exit__(self, *exc):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def chunks(self, n_battle: int, start: int = 0) -> List[List[int]]:
+        end = start + n_battle
+        return [list(range(begin, min(begin + self.chunk_size, end)))
+                for begin in range(start, end, self.chunk_size)]
+
+    def run(self,
+            n_battle: int,
+            with_logs: bool = True,
+            logs=None
+            ) -> Tuple[_Counter[int], TurnLogs]:
+        """
+        logs を渡すと、チャンクごとのログをそこへ順に書き出す（TurnLogWriter など）
+        """
+        logger.debug("## Run %d battles on %d workers" % (n_battle, self.n_worker))
+
+        tasks = [(self.seed, ids, with_logs, self.commands) for ids in self.chunks(n_battle)]
+        if self.pool is not None:
+            return self.merge(self.pool.imap(_run_chunk, tasks), logs)
+
+        if self.n_worker <= 1:
+            _init_worker(self.teams, self.gambits, self.random_source)
+            return self.merge(map(_run_chunk, tasks), logs)
+
+        with multiprocessing.Pool(self.n_worker,
+                                  initializer=_init_worker,
+                                  initargs=(self.teams, self.gambits, self.random_source)) as pool:
+            # チャンク順に結合するので、ログの並びもワーカー数に依らない
+            return self.merge(pool.imap(_run_chunk, tasks), logs)
+
+    def winners(self, n_battle: int, start: int = 0) -> np.ndarray:
+        """
+        バトル ID start から n_battle 回分の勝利チーム ID を、ID 順に返す（ログは取らない）
+        同じシードなら ID ごとの乱数も同じなので、作戦を変えて対応のある比較ができる
+        """
+        tasks = [(self.seed, ids, False, self.commands) for ids in self.chunks(n_battle, start)]
+        if self.pool is not None:
+            results = self.pool.imap(_run_chunk, tasks)
+        else:
+            # 直列の場合は、この BattleRunner の作戦を使う（他の BattleRunner と交互に呼ばれてもよいように）
+            global _worker
+            if self.worker is None:
+                self.worker = (self.teams, [factory() for factory in self.gambits],
+                               self.random_source())
+            _worker = self.worker
+            results = map(_run_chunk, tasks)
+        return np.concatenate([winners for winners, _ in results])
+
+    @staticmethod
+    def merge(results, logs=None) -> Tuple[_Counter[int], TurnLogs]:
+        win: _Counter[int] = Counter()
+        if logs is None:
+            logs = TurnLogs()
+        for winners, _logs in results:
+            win.update(winners.tolist())
+            logs.extend(_logs)
+        return win, logs
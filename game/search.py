@@ -0,0 +1,170 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+from dataclasses import astuple, dataclass
+from pathlib import Path
+import hashlib
+import itertools
+import multiprocessing
+import time
+
+import numpy as np
+
+from . import logger
+
+# 推定ごとの (学習用, 検証用) のチャンク（make_dataset を train_test_split で分けたもの）
+Split = Tuple[Tuple[np.ndarray, ...], Tuple[np.ndarray, ...]]
+
+# 結果の表（1 行が 推定 × 構成）
+search_dtype = np.dtype([
+    ('key', 'U40'),
+    ('dataset', 'U40'),
+    ('head', 'U32'),
+    ('hidden_layers', 'U64'),
+    ('embedding', np.bool_),
+    ('batch_size', np.int32),
+    ('max_epochs', np.int32),
+    ('patience', np.int32),
+    ('val_loss', np.float32),
+    ('loss', np.float32),
+    ('epochs', np.int32),
+    ('seconds', np.float32),
+])
+
+
+def dataset_digest(split: Split) -> str:
+    # 学習データの中身のハッシュ（同じログから作れば同じになる）
+    sha1 = hashlib.sha1()
+    for array in (a for part in split for a in part):
+        array = np.ascontiguousarray(array)
+        sha1.update(repr((array.dtype.str, array.shape)).encode())
+        sha1.update(array.tobytes())
+    return sha1.hexdigest()
+
+
+@dataclass(frozen=True)
+class SearchConfig:
+    """
+    探索する推定器の構成の一つ（heads を渡すと MultiHeadEstimator）
+    """
+
+    head: str
+    hidden_layers: Tuple[int, ...] = (16, 8)
+    embedding: bool = False
+    batch_size: int = 128
+    max_epochs: int = 50
+    patience: int = 5
+    heads: Tuple[str, ...] = ()
+
+    def key(self, dataset: str, seed: int) -> str:
+        # 学習データと構成のハッシュ（同じなら結果を使い回す）
+        text = repr((dataset, seed, astuple(self)))
+        return hashlib.sha1(text.encode()).hexdigest()
+
+
+def search_grid(heads: Sequence[str],
+                hidden_layers: Sequence[Sequence[int]],
+                batch_sizes: Sequence[int] = (128,),
+                **fields) -> List[SearchConfig]:
+    """
+    推定 × 隠れ層 × バッチサイズ の直積（他の項目は fields で共通に指定する）
+    """
+    return [SearchConfig(head, tuple(layers), batch_size=batch_size, **fields)
+            for head, layers, batch_size in itertools.product(heads, hidden_layers, batch_sizes)]
+
+
+# ワーカープロセスごとに一度だけ受け取る学習データ
+_splits: Optional[Dict[str, Split]] = None
+
+
+def _init_worker(splits: Dict[str, Split]):
+    global _splits
+    _splits = splits
+
+
+def _train(task: Tuple[SearchConfig, int, int]) -> Tuple[float, float, int, float]:
+    """
+    一つの構成を早期終了つきで学習し、(検証損失, 学習損失, エポック数, 秒数) を返す
+    """
+    config, n_class, seed = task
+    # TensorFlow はワーカーの中でだけ読み込む
+    import tensorflow as tf
+    from .estimator import Estimator, MultiHeadEstimator
+
+    tf.keras.backend.clear_session()
+    np.random.seed(seed)
+    tf.set_random_seed(seed)
+    if config.heads:
+        reg = MultiHeadEstimator(config.head, n_class, list(config.heads),
+                                 list(config.hidden_layers), config.embedding)
+    else:
+        reg = Estimator(config.head, n_class, list(config.hidden_layers), config.embedding)
+    reg.build_model()
+
+    train, test = _splits[config.head]
+    start = time.perf_counter()
+    val_loss, loss, epochs = reg.fit_early_stopping(train, test, config.max_epochs,
+                                                    config.batch_size, config.patience)
+    return val_loss, loss, epochs, time.perf_counter() - start
+
+
+@dataclass
+class HyperparameterSearch:
+    """
+    推定器の構成をプロセス並列で学習し、検証損失の表にまとめる
+    path を渡すと、同じ学習データ・構成の結果は表から読み、足りない分だけ学習する
+    """
+
+    n_class: int
+    n_worker: int = 1
+    seed: int = 0
+    path: Optional[Path] = None
+
+    def load(self) -> np.ndarray:
+        if self.path is not None and Path(self.path).exists():
+            return np.load(self.path)
+        return np.zeros(0, dtype=search_dtype)
+
+    def save(self, table: np.ndarray):
+        if self.path is not None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'wb') as f:
+                np.save(f, table)
+
+    def run(self, splits: Dict[str, Split], configs: List[SearchConfig]) -> np.ndarray:
+        """
+        configs の順に結果を並べた表を返す
+        """
+        digests = {head: dataset_digest(split) for head, split in splits.items()}
+        keys = [config.key(digests[config.head], self.seed) for config in configs]
+        cached = {row['key']: row for row in self.load()}
+        missing = {key: config for key, config in zip(keys, configs) if key not in cached}
+        logger.info("search %d configs (%d cached)" % (len(configs), len(configs) - len(missing)))
+
+        tasks = [(config, self.n_class, self.seed) for config in missing.values()]
+        if self.n_worker <= 1:
+            _init_worker(splits)
+            results = list(map(_train, tasks))
+        else:
+            # TensorFlow は fork と相性が悪いので、ワーカーは spawn で起動する
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(self.n_worker, initializer=_init_worker,
+                              initargs=(splits,)) as pool:
+                results = pool.map(_train, tasks, chunksize=1)
+
+        computed = {}
+        for (key, config), (val_loss, loss, epochs, seconds) in zip(missing.items(), results):
+            row = np.zeros((), dtype=search_dtype)
+            row['key'], row['dataset'], row['head'] = key, digests[config.head], config.head
+            row['hidden_layers'] = '-'.join(map(str, config.hidden_layers))
+            row['embedding'], row['batch_size'] = config.embedding, config.batch_size
+            row['max_epochs'], row['patience'] = config.max_epochs, config.patience
+            row['val_loss'], row['loss'] = val_loss, loss
+            row['epochs'], row['seconds'] = epochs, seconds
+            computed[key] = row
+
+        table = np.array([computed[key] if key in computed else cached[key] for key in keys],
+                         dtype=search_dtype)
+
+        # 過去の結果も残して保存する
+        if computed:
+            self.save(np.concatenate([self.load(), np.array(list(computed.values()), dtype=search_dtype)]))
+        return table
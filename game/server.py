@@ -0,0 +1,294 @@
+from typing import Deque, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+from collections import deque
+import asyncio
+import itertools
+import json
+import random
+import time
+
+import numpy as np
+
+from . import logger
+from .status import Side, Status, statuses
+from .unit import Unit
+from .gambit import Gambit
+
+
+def unit_to_dict(unit: Unit) -> Dict:
+    return dict(team=unit.team, no=unit.no, side=int(unit.side), id=unit.id,
+                life=unit.life, life_max=unit.life_max,
+                attack=unit.attack, defence=unit.defence, speed=unit.speed)
+
+
+def unit_from_dict(d: Dict) -> Unit:
+    unit = Unit(Status(Side(d['side']), d['id'], '', d['life_max'],
+                       d['attack'], d['defence'], d['speed']))
+    unit.team, unit.no = d['team'], d['no']
+    unit.life_max, unit.life = d['life_max'], d['life']
+    return unit
+
+
+def validate_request(source: Unit, targets: List[Unit]):
+    """
+    まとめて判断する前に、一件ずつ調べる（不正なリクエストでバッチ全体を失敗させない）
+    """
+    if not targets:
+        raise ValueError("targets must not be empty")
+    for unit in [source] + targets:
+        if unit.life_max <= 0:
+            raise ValueError("life_max must be positive")
+
+
+@dataclass
+class LatencyStats:
+    """
+    直近のレイテンシーと、リクエスト数・推論回数の累計
+    """
+
+    window: int = 10000
+    latencies: Deque[float] = field(default_factory=deque, repr=False)
+    n_request: int = 0
+    n_batch: int = 0
+    started: float = field(default_factory=time.perf_counter)
+
+    def record(self, latencies: List[float]):
+        self.latencies.extend(latencies)
+        while len(self.latencies) > self.window:
+            self.latencies.popleft()
+        self.n_request += len(latencies)
+        self.n_batch += 1
+
+    def report(self) -> Dict:
+        elapsed = time.perf_counter() - self.started
+        lat = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return dict(
+            requests=self.n_request,
+            batches=self.n_batch,
+            mean_batch=self.n_request / self.n_batch if self.n_batch else 0.0,
+            requests_per_sec=self.n_request / elapsed if elapsed > 0 else 0.0,
+            p50_ms=float(np.percentile(lat, 50)) * 1e3,
+            p99_ms=float(np.percentile(lat, 99)) * 1e3,
+        )
+
+
+@dataclass
+class DecisionServer:
+    """
+    作戦の判断を返すローカルサーバー（1 行 1 JSON）
+    window 秒の間に届いたリクエストをまとめて、一度の select_many で判断する
+
+    リクエスト {"id": 1, "source": ユニット, "targets": [ユニット, ...]}
+    レスポンス {"id": 1, "target": 選んだ候補の位置}（不正なリクエストには {"id": 1, "error": 理由}）
+    {"op": "stats"} にはレイテンシーと処理数を返す
+    """
+
+    gambit: Gambit
+    window: float = 0.002
+    max_batch: int = 256
+    host: str = '127.0.0.1'
+    port: int = 8765
+    path: Optional[str] = None
+    stats: LatencyStats = field(default_factory=LatencyStats, init=False)
+    queue: Optional[asyncio.Queue] = field(default=None, init=False, repr=False)
+    server: Optional[asyncio.AbstractServer] = field(default=None, init=False, repr=False)
+    batcher: Optional[asyncio.Task] = field(default=None, init=False, repr=False)
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self.run_batches())
+        if self.path is not None:
+            self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+        else:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+            self.port = self.server.sockets[0].getsockname()[1]
+        logger.info("decision server on %s" % (self.path or "%s:%d" % (self.host, self.port)))
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    async def decide(self, source: Unit, targets: List[Unit]) -> int:
+        validate_request(source, targets)
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((time.perf_counter(), source, targets, future))
+        return await future
+
+    async def run_batches(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            # 最初のリクエストから window 秒待つか、max_batch 件たまるまで集める
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            sources = [b[1] for b in batch]
+            candidates = [b[2] for b in batch]
+            try:
+                # 推論中もリクエストを受け付けられるよう、別スレッドで判断する
+                chosen = await loop.run_in_executor(
+                    None, self.gambit.select_many, sources, candidates)
+            except Exception:
+                # 一件ずつ判断し直し、失敗したリクエストだけをエラーにする
+                chosen = await loop.run_in_executor(None, self.select_each, sources, candidates)
+
+            now = time.perf_counter()
+            for (start, _, _, future), index in zip(batch, chosen):
+                if future.done():
+                    continue
+                if isinstance(index, Exception):
+                    future.set_exception(index)
+                else:
+                    future.set_result(index)
+            self.stats.record([now - b[0] for b in batch])
+
+    def select_each(self, sources: List[Unit], candidates: List[List[Unit]]) -> List:
+        results = []
+        for source, targets in zip(sources, candidates):
+            try:
+                results.append(self.gambit.select_many([source], [targets])[0])
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def respond(self, request: Dict, writer: asyncio.StreamWriter):
+        if request.get('op') == 'stats':
+            response = dict(id=request.get('id'), stats=self.stats.report())
+        else:
+            try:
+                index = await self.decide(unit_from_dict(request['source']),
+                                          [unit_from_dict(t) for t in request['targets']])
+                response = dict(id=request.get('id'), target=index)
+            except Exception as e:
+                response = dict(id=request.get('id'), error=str(e))
+        writer.write((json.dumps(response) + '\n').encode())
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # 同じ接続のリクエストも並行して処理する（レスポンスは id で対応づける）
+        tasks = set()
+        try:
+            async for line in reader:
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("request must be a JSON object")
+                except ValueError as e:
+                    # 読めない行にはエラーを返し、接続はそのまま続ける
+                    writer.write((json.dumps(dict(id=None, error=str(e))) + '\n').encode())
+                    continue
+                task = asyncio.ensure_future(self.respond(request, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            writer.close()
+
+
+@dataclass
+class DecisionClient:
+    """
+    DecisionServer のクライアント（複数のリクエストを並行して送れる）
+    """
+
+    host: str = '127.0.0.1'
+    port: int = 8765
+    path: Optional[str] = None
+    reader: Optional[asyncio.StreamReader] = field(default=None, init=False, repr=False)
+    writer: Optional[asyncio.StreamWriter] = field(default=None, init=False, repr=False)
+    pending: Dict[int, asyncio.Future] = field(default_factory=dict, init=False, repr=False)
+    ids: itertools.count = field(default_factory=itertools.count, init=False, repr=False)
+    receiver: Optional[asyncio.Task] = field(default=None, init=False, repr=False)
+
+    async def connect(self):
+        if self.path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.receiver.cancel()
+
+    async def receive(self):
+        async for line in self.reader:
+            response = json.loads(line)
+            future = self.pending.pop(response['id'], None)
+            if future is not None and not future.done():
+                future.set_result(response)
+
+    async def call(self, request: Dict) -> Dict:
+        request['id'] = next(self.ids)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request['id']] = future
+        self.writer.write((json.dumps(request) + '\n').encode())
+        return await future
+
+    async def decide(self, source: Unit, targets: List[Unit]) -> int:
+        response = await self.call(dict(source=unit_to_dict(source),
+                                        targets=[unit_to_dict(t) for t in targets]))
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response['target']
+
+    async def stats(self) -> Dict:
+        return (await self.call(dict(op='stats')))['stats']
+
+
+def random_request(rng: random.Random) -> Tuple[Unit, List[Unit]]:
+    """
+    既知のステータスから、ランダムな HP の判断リクエストを作る
+    """
+    source = Unit(rng.choice(statuses[Side.PLAYER]))
+    source.team = Side.PLAYER
+    targets = []
+    for no, status in enumerate(statuses[Side.MONSTER]):
+        target = Unit(status)
+        target.team, target.no = Side.MONSTER, no
+        target.life = rng.randint(1, target.life_max)
+        targets.append(target)
+    rng.shuffle(targets)
+    return source, targets[:rng.randint(1, len(targets))]
+
+
+async def generate_load(client_factory,
+                        n_client: int = 16,
+                        n_request: int = 1000,
+                        seed: int = 0) -> Dict:
+    """
+    n_client 本の接続から、それぞれ判断を待っては次を送る負荷をかけ、クライアント側の計測値を返す
+    """
+    stats = LatencyStats(window=n_client * n_request)
+
+    async def worker(worker_id: int):
+        rng = random.Random(seed * 1000003 + worker_id)
+        client = client_factory()
+        await client.connect()
+        try:
+            for _ in range(n_request):
+                source, targets = random_request(rng)
+                start = time.perf_counter()
+                await client.decide(source, targets)
+                stats.record([time.perf_counter() - start])
+        finally:
+            await client.close()
+
+    await asyncio.gather(*[worker(i) for i in range(n_client)])
+    return stats.report()
@@ -0,0 +1,343 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+from dataclasses import dataclass, field
+import itertools
+
+import numpy as np
+from numpy.polynomial import polynomial as P
+
+from . import logger
+from .status import Side
+from .team import Team
+from .batch import BatchState
+from .gambit import Gambit
+
+# 行動順の木（(ユニット, 条件付き確率, 子) のリスト、末端は None）
+OrderTree = List[Tuple[int, float, Optional['OrderTree']]]
+
+
+def life_max_prior(life: int, side: Side) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    最大HPの値と確率（Unit.reset と同じ int(uniform(0.85, 1.0) * life) の分布）
+    """
+    if side != Side.MONSTER:
+        return np.array([life]), np.array([1.0])
+    values = np.arange(int(0.85 * life), life)
+    low = np.maximum(values / life, 0.85)
+    high = np.minimum((values + 1) / life, 1.0)
+    probs = np.clip(high - low, 0.0, None)
+    mask = probs > 0
+    return values[mask], probs[mask] / probs[mask].sum()
+
+
+def order_tree(speeds: List[float]) -> OrderTree:
+    """
+    speed * uniform(0.5, 1.0) の降順で決まる行動順を、前から順に分岐する木で表す
+    各区間で区分多項式を積分するので、確率は厳密に求まる
+    """
+    speeds = np.asarray(speeds, dtype=np.float64)
+    low, high = speeds / 2, speeds
+    points = np.unique(np.concatenate([low, high]))
+    segments = list(zip(points[:-1], points[1:]))
+
+    def density(u):
+        return [np.array([1.0 / (high[u] - low[u])]) if low[u] <= a and b <= high[u]
+                else np.array([0.0]) for a, b in segments]
+
+    def cdf(u):
+        return [np.array([0.0]) if b <= low[u] else
+                np.array([1.0]) if a >= high[u] else
+                np.array([-low[u], 1.0]) / (high[u] - low[u]) for a, b in segments]
+
+    def integrate(polys):
+        # 区間ごとの積分を足し合わせる
+        return sum(P.polyval(b, P.polyint(p)) - P.polyval(a, P.polyint(p))
+                   for p, (a, b) in zip(polys, segments))
+
+    def upper(polys):
+        # x より上の積分 ∫_x^∞ f(y) dy
+        result, total = [], integrate(polys)
+        cum = 0.0
+        for p, (a, b) in zip(polys, segments):
+            q = P.polyint(p)
+            result.append(P.polysub([total - cum + P.polyval(a, q)], q))
+            cum += P.polyval(b, q) - P.polyval(a, q)
+        return result
+
+    densities = [density(u) for u in range(len(speeds))]
+    cdfs = [cdf(u) for u in range(len(speeds))]
+
+    def prob(head, rest):
+        # 直前のユニットより遅く、残りのユニットより速い確率
+        polys = head
+        for r in rest:
+            polys = [P.polymul(p, c) for p, c in zip(polys, cdfs[r])]
+        return integrate(polys)
+
+    def build(head, rest, total) -> Optional[OrderTree]:
+        if not rest:
+            return None
+        tail = upper(head) if head is not None else None
+        tree = []
+        for u in rest:
+            others = [r for r in rest if r != u]
+            polys = densities[u] if tail is None else \
+                [P.polymul(d, t) for d, t in zip(densities[u], tail)]
+            p = prob(polys, others)
+            if p > 1e-15:
+                tree.append((u, p / total, build(polys, others, p)))
+        return tree
+
+    return build(None, list(range(len(speeds))), 1.0)
+
+
+@dataclass
+class HitTable:
+    """
+    ユニットが受けた攻撃の回数（攻撃者ごと）と、それでも生き残っている確率
+    HP は攻撃の履歴が決まればユニットごとに独立なので、回数だけで状態を表せる
+    """
+
+    attackers: List[int]
+    survival: np.ndarray
+    next: np.ndarray
+
+    @classmethod
+    def build(cls, damages: List[np.ndarray], attackers: List[int],
+              values: np.ndarray, probs: np.ndarray) -> 'HitTable':
+        """
+        damages は攻撃者ごとのダメージの候補（一様に出る）、values, probs は最大HPの分布
+        """
+        kernels = []
+        for d in damages:
+            if d.min() <= 0:
+                raise ValueError("damage can be 0, the battle may not finish")
+            k = np.zeros(d.max() + 1)
+            k[d] = 1.0 / len(d)
+            kernels.append(k)
+
+        def survival(pmf):
+            # P(累積ダメージ < 最大HP)
+            cdf = np.cumsum(pmf)
+            return float((probs * cdf[np.minimum(values - 1, len(cdf) - 1)]).sum())
+
+        # 生き残る可能性がある回数の組を列挙する（0 は倒された状態）
+        start = (0,) * len(attackers)
+        codes = {start: 1}
+        pmfs = [np.array([1.0])]
+        queue = [start]
+        while queue:
+            counts = queue.pop(0)
+            pmf = pmfs[codes[counts] - 1]
+            for i, kernel in enumerate(kernels):
+                key = counts[:i] + (counts[i] + 1,) + counts[i + 1:]
+                if key in codes:
+                    continue
+                p = np.convolve(pmf, kernel)
+                if survival(p) > 0:
+                    codes[key] = len(pmfs) + 1
+                    pmfs.append(p)
+                    queue.append(key)
+
+        table = np.zeros(len(pmfs) + 1)
+        table[1:] = [survival(p) for p in pmfs]
+        next = np.zeros((len(pmfs) + 1, len(attackers)), dtype=np.int64)
+        for counts, code in codes.items():
+            for i in range(len(attackers)):
+                key = counts[:i] + (counts[i] + 1,) + counts[i + 1:]
+                next[code, i] = codes.get(key, 0)
+        return cls(attackers=attackers, survival=table, next=next)
+
+    @property
+    def n_code(self) -> int:
+        return len(self.survival)
+
+
+@dataclass
+class Solution:
+    """
+    チームごとの勝率（打ち切った確率 unresolved の分だけ、真の値より小さいことがある）
+    """
+
+    win: List[float]
+    unresolved: float
+    n_state: int
+
+
+@dataclass
+class WinProbabilitySolver:
+    """
+    作戦の組み合わせに対する勝率を、バトルの状態を網羅する動的計画法で求める
+    同じ状態に至る経路はまとめ、確率の小さい状態は打ち切って unresolved に計上する
+    """
+
+    teams: List[Team]
+    gambits: List[Gambit]
+    min_probability: float = 1e-12
+    max_states: int = 4000000
+    max_turn: int = 1000
+    tree: OrderTree = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.units = [unit for team in self.teams for unit in team.units]
+        self.team = np.array([u.team for u in self.units], dtype=np.int64)
+        self.tree = order_tree([u.speed for u in self.units])
+
+    def damages(self, source, target) -> np.ndarray:
+        # AttackCommand.do と同じダメージの候補
+        base = max((source.attack - target.defence // 2) // 2, 0)
+        return np.arange(base * 7 // 8, base * 9 // 8 + 1)
+
+    def priors(self) -> List[Tuple[np.ndarray, np.ndarray]]:
+        return [life_max_prior(u.status.life, u.side) for u in self.units]
+
+    def target_tables(self, life_max: np.ndarray) -> np.ndarray:
+        """
+        最大HPの組ごとに、(生存パターン, 行動ユニット, 攻撃対象) の選択確率を作る
+        """
+        n_unit = len(self.units)
+        n_pattern = 1 << n_unit
+        alive = (np.arange(n_pattern)[:, np.newaxis] >> np.arange(n_unit)) & 1 > 0
+
+        # 最大HPの組 × 生存パターン × 行動ユニット を 1 バトルずつ並べる
+        n_combo = len(life_max)
+        rows = n_combo * n_pattern * n_unit
+        state = BatchState.from_teams(self.teams, rows, np.random.default_rng(0), reset=False)
+        state.life_max = np.repeat(life_max, n_pattern * n_unit, axis=0)
+        state.life = np.where(np.tile(np.repeat(alive, n_unit, axis=0), (n_combo, 1)),
+                              state.life_max, 0)
+        battles = np.arange(rows)
+        sources = np.tile(np.arange(n_unit), n_combo * n_pattern)
+
+        tables = np.zeros((rows, n_unit))
+        candidates = state.adversaries(battles, sources)
+        active = (state.life[battles, sources] > 0) & candidates.any(axis=1)
+        for team_id, gambit in enumerate(self.gambits):
+            mask = active & (self.team[sources] == team_id)
+            if mask.any():
+                tables[mask] = gambit.target_probabilities(
+                    state, battles[mask], sources[mask], candidates[mask])
+        return tables.reshape(n_combo, n_pattern, n_unit, n_unit)
+
+    def boxes(self, priors) -> Iterator[Tuple[List[np.ndarray], np.ndarray]]:
+        """
+        作戦の選択が同じになる最大HPの範囲（直積）に分けて、(範囲, 選択確率) を返す
+        """
+        grid = list(itertools.product(*[values for values, _ in priors]))
+        tables = self.target_tables(np.array(grid, dtype=np.int64))
+        shape = [len(values) for values, _ in priors]
+        tables = tables.reshape(shape + list(tables.shape[1:]))
+
+        def split(index: List[np.ndarray]):
+            sub = tables[np.ix_(*index)]
+            flat = sub.reshape(-1, *sub.shape[len(index):])
+            if (flat == flat[0]).all():
+                yield index, flat[0]
+                return
+            axis = int(np.argmax([len(i) for i in index]))
+            half = len(index[axis]) // 2
+            for part in (index[axis][:half], index[axis][half:]):
+                yield from split(index[:axis] + [part] + index[axis + 1:])
+
+        yield from split([np.arange(s) for s in shape])
+
+    def solve(self) -> Solution:
+        for gambit in self.gambits:
+            gambit.reset(self.teams)
+
+        priors = self.priors()
+        win = np.zeros(len(self.teams))
+        unresolved = 0.0
+        n_state = 0
+        for index, table in self.boxes(priors):
+            # 範囲内の最大HPの分布で解き、範囲の確率で重み付けする
+            weight = 1.0
+            restricted = []
+            for (values, probs), i in zip(priors, index):
+                weight *= probs[i].sum()
+                restricted.append((values[i], probs[i] / probs[i].sum()))
+            logger.debug("solve box %s weight=%f" % ([len(i) for i in index], weight))
+            solution = self.solve_box(restricted, table)
+            win += weight * np.array(solution.win)
+            unresolved += weight * solution.unresolved
+            n_state = max(n_state, solution.n_state)
+        return Solution(win=win.tolist(), unresolved=float(unresolved), n_state=n_state)
+
+    def solve_box(self, priors, table: np.ndarray) -> Solution:
+        units = self.units
+        n_unit = len(units)
+        team = self.team
+
+        hits = []
+        for t, target in enumerate(units):
+            attackers = [a for a in range(n_unit) if team[a] != team[t]]
+            hits.append(HitTable.build([self.damages(units[a], target) for a in attackers],
+                                       attackers, *priors[t]))
+
+        # 状態は (生存パターン, ユニットごとの回数の組) を 1 つの整数にまとめる
+        radix = np.cumprod([1 << n_unit] + [h.n_code for h in hits[:-1]]).astype(np.int64)
+        slot = np.zeros((n_unit, n_unit), dtype=np.int64)
+        for t, h in enumerate(hits):
+            slot[t, h.attackers] = np.arange(len(h.attackers))
+        team_mask = [sum(1 << u for u in range(n_unit) if team[u] == k) for k in range(len(self.teams))]
+
+        win = np.zeros(len(self.teams))
+        dropped = [0.0]
+        peak = [0]
+
+        def merge(keys, probs):
+            keys, inverse = np.unique(keys, return_inverse=True)
+            probs = np.bincount(inverse.ravel(), probs)
+            keep = probs >= self.min_probability
+            if keep.sum() > self.max_states:
+                # 上限を超えたら確率の小さい状態から捨てる
+                keep &= probs >= np.partition(probs, -self.max_states)[-self.max_states]
+            dropped[0] += probs[~keep].sum()
+            peak[0] = max(peak[0], int(keep.sum()))
+            return keys[keep], probs[keep]
+
+        def act(u, keys, probs):
+            pattern = keys & ((1 << n_unit) - 1)
+            alive = (pattern >> u) & 1 > 0
+            out_keys, out_probs = [keys[~alive]], [probs[~alive]]
+            keys, probs, pattern = keys[alive], probs[alive], pattern[alive]
+            for t in hits[u].attackers:
+                q = table[pattern, u, t]
+                mask = q > 0
+                if not mask.any():
+                    continue
+                k, p = keys[mask], probs[mask] * q[mask]
+                code = (k // radix[t]) % hits[t].n_code
+                after = hits[t].next[code, slot[t, u]]
+                survive = hits[t].survival[after] / hits[t].survival[code]
+                out_keys.append(k + (after - code) * radix[t])
+                out_probs.append(p * survive)
+
+                # 倒された場合
+                k = k - code * radix[t] - (1 << t)
+                p = p * (1 - survive)
+                finished = (k & ~team_mask[team[u]] & ((1 << n_unit) - 1)) == 0
+                win[team[u]] += p[finished].sum()
+                out_keys.append(k[~finished])
+                out_probs.append(p[~finished])
+            return merge(np.concatenate(out_keys), np.concatenate(out_probs))
+
+        def proceed(tree, keys, probs, leaves):
+            for u, p, child in tree:
+                k, q = act(u, keys, probs * p)
+                if child is None:
+                    leaves.append((k, q))
+                else:
+                    proceed(child, k, q, leaves)
+
+        keys = np.array([(1 << n_unit) - 1 + int(radix.sum())], dtype=np.int64)
+        probs = np.array([1.0])
+        for turn_id in range(1, self.max_turn):
+            if keys.size == 0:
+                break
+            leaves: List[Tuple[np.ndarray, np.ndarray]] = []
+            proceed(self.tree, keys, probs, leaves)
+            keys, probs = merge(np.concatenate([k for k, _ in leaves]),
+                                np.concatenate([p for _, p in leaves]))
+            logger.debug("turn %d: %d states, %f running" % (turn_id, keys.size, probs.sum()))
+
+        return Solution(win=win.tolist(), unresolved=float(dropped[0] + probs.sum()), n_state=peak[0])
@@ -0,0 +1,211 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+from dataclasses import dataclass, field, replace
+from functools import partial
+from pathlib import Path
+import hashlib
+import itertools
+import json
+import multiprocessing
+
+import numpy as np
+
+from . import logger
+from .status import Side, Status, statuses
+from .unit import Unit
+from .team import Team
+from .batch import BatchBattle
+from .gambit import NaiveGambit
+from .runner import BattleRunner, GambitFactory
+from .evaluation import Estimate
+from .registry import models
+
+# 陣営ごとのステータス
+Roster = Tuple[Tuple[Status, ...], ...]
+
+# 結果の表（1 行が 構成 × 作戦）
+result_dtype = np.dtype([
+    ('key', 'U40'),
+    ('config', np.int32),
+    ('gambit', 'U32'),
+    ('n_battle', np.int32),
+    ('wins', np.int32),
+    ('win_rate', np.float32),
+    ('low', np.float32),
+    ('high', np.float32),
+    ('params', 'U256'),
+])
+
+
+def default_roster() -> Roster:
+    return tuple(tuple(side) for side in statuses)
+
+
+def make_teams(roster: Roster) -> List[Team]:
+    return [Team(team_id, [Unit(s) for s in side]) for team_id, side in enumerate(roster)]
+
+
+def apply(roster: Roster, name: str, value) -> Roster:
+    """
+    パラメーター名 "<陣営>.<ユニット名>.<ステータス>" または "<陣営>.units" の値を変える
+    units の値はユニット名の並びで、元の構成（statuses）から選ぶ
+    """
+    side_name, _, rest = name.partition('.')
+    side = Side[side_name.upper()]
+    units = list(roster[side])
+    if rest == 'units':
+        pool = {s.name: s for s in statuses[side]}
+        pool.update({s.name: s for s in units})
+        units = [pool[n] for n in (value.split(',') if isinstance(value, str) else value)]
+    else:
+        unit_name, _, attr = rest.partition('.')
+        index = next(i for i, s in enumerate(units) if s.name == unit_name)
+        units[index] = replace(units[index], **{attr: int(value)})
+    return roster[:side] + (tuple(units),) + roster[side + 1:]
+
+
+@dataclass(frozen=True)
+class SweepConfig:
+    """
+    スイープする構成の一つ（params は元の構成から変えたパラメーター）
+    """
+
+    roster: Roster
+    params: Tuple[Tuple[str, object], ...] = ()
+
+    @classmethod
+    def from_params(cls, base: Roster, params: Dict[str, object]) -> 'SweepConfig':
+        roster = base
+        for name, value in params.items():
+            roster = apply(roster, name, value)
+        return cls(roster, tuple(params.items()))
+
+    def key(self, gambit: str, opponent: str, digests: Tuple[str, ...],
+            n_battle: int, seed: int, batch: bool) -> str:
+        # 構成と評価条件（相手の作戦、モデルの中身を含む）のハッシュ（同じなら結果を使い回す）
+        text = repr((self.roster, gambit, opponent, digests, n_battle, seed, batch))
+        return hashlib.sha1(text.encode()).hexdigest()
+
+
+def factory_name(factory: GambitFactory) -> str:
+    # partial なら引数も含めた名前にする
+    if isinstance(factory, partial):
+        return '%s%r' % (factory_name(factory.func), sorted(factory.keywords.items()))
+    return getattr(factory, '__qualname__', repr(factory))
+
+
+def grid_design(base: Roster, grid: Dict[str, Sequence]) -> List[SweepConfig]:
+    """
+    パラメーターごとの候補の直積
+    """
+    names = list(grid)
+    return [SweepConfig.from_params(base, dict(zip(names, values)))
+            for values in itertools.product(*[grid[n] for n in names])]
+
+
+def random_design(base: Roster,
+                  ranges: Dict[str, Sequence],
+                  n_config: int,
+                  seed: int = 0) -> List[SweepConfig]:
+    """
+    ステータスは (最小, 最大) の範囲から一様に、units は候補から選ぶ
+    """
+    rng = np.random.default_rng(seed)
+    configs = []
+    for _ in range(n_config):
+        params = {}
+        for name, candidates in ranges.items():
+            if name.endswith('.units'):
+                params[name] = candidates[rng.integers(len(candidates))]
+            else:
+                low, high = candidates
+                params[name] = int(rng.integers(low, high, endpoint=True))
+        configs.append(SweepConfig.from_params(base, params))
+    return configs
+
+
+def _run_cell(args: Tuple[Roster, GambitFactory, GambitFactory, int, int, bool]) -> int:
+    """
+    一つの構成 × 作戦で、プレイヤーの勝利数を返す
+    """
+    roster, factory, opponent, n_battle, seed, batch = args
+    teams = make_teams(roster)
+    if batch:
+        winners = BatchBattle(n_battle, seed).simulate(teams, [factory(), opponent()])
+    else:
+        # セルごとにプロセス並列にしているので、BattleRunner は直列で回す
+        winners = BattleRunner(teams, [factory, opponent], seed=seed, n_worker=1).winners(n_battle)
+    return int((winners == Side.PLAYER).sum())
+
+
+@dataclass
+class Sweep:
+    """
+    構成 × 作戦 の組み合わせをプロセス並列で評価し、結果を表にまとめる
+    path を渡すと、同じ条件の結果は表から読み、足りない分だけ計算する
+    model_files は作戦ごとの学習済みモデル・参照テーブルで、中身が変われば計算し直す
+    """
+
+    gambits: Dict[str, GambitFactory]
+    opponent: GambitFactory = NaiveGambit
+    model_files: Dict[str, Sequence[Path]] = field(default_factory=dict)
+    n_battle: int = 10000
+    seed: int = 0
+    batch: bool = True
+    n_worker: int = 1
+    confidence_z: float = 1.96
+    path: Optional[Path] = None
+
+    def load(self) -> np.ndarray:
+        if self.path is not None and Path(self.path).exists():
+            return np.load(self.path)
+        return np.zeros(0, dtype=result_dtype)
+
+    def save(self, table: np.ndarray):
+        if self.path is not None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'wb') as f:
+                np.save(f, table)
+
+    def run(self, configs: List[SweepConfig]) -> np.ndarray:
+        """
+        configs の順に、作戦ごとの行を並べた表を返す
+        """
+        cached = {row['key']: row for row in self.load()}
+        opponent = factory_name(self.opponent)
+        digests = {name: tuple(models.key(path)[1] for path in self.model_files.get(name, ()))
+                   for name in self.gambits}
+        cells = [(i, config, name, config.key(name, opponent, digests[name],
+                                              self.n_battle, self.seed, self.batch))
+                 for i, config in enumerate(configs) for name in self.gambits]
+        missing = [cell for cell in cells if cell[3] not in cached]
+        logger.info("sweep %d cells (%d cached)" % (len(cells), len(cells) - len(missing)))
+
+        tasks = [(config.roster, self.gambits[name], self.opponent,
+                  self.n_battle, self.seed, self.batch) for _, config, name, _ in missing]
+        if self.n_worker <= 1:
+            wins = list(map(_run_cell, tasks))
+        else:
+            with multiprocessing.Pool(self.n_worker) as pool:
+                wins = pool.map(_run_cell, tasks, chunksize=1)
+
+        computed = {}
+        for (i, config, name, key), w in zip(missing, wins):
+            row = np.zeros((), dtype=result_dtype)
+            estimate = Estimate.proportion(w, self.n_battle, self.confidence_z)
+            row['key'], row['gambit'] = key, name
+            row['n_battle'], row['wins'] = self.n_battle, w
+            row['win_rate'], row['low'], row['high'] = estimate.mean, estimate.low, estimate.high
+            row['params'] = json.dumps(dict(config.params))
+            computed[key] = row
+
+        table = np.zeros(len(cells), dtype=result_dtype)
+        for j, (i, config, name, key) in enumerate(cells):
+            table[j] = computed[key] if key in computed else cached[key]
+        # 同じ構成でも指定の仕方が違うことがあるので、今回の指定で上書きする
+        table['config'] = [i for i, _, _, _ in cells]
+        table['params'] = [json.dumps(dict(config.params)) for _, config, _, _ in cells]
+
+        # 過去の結果も残して保存する
+        if computed:
+            self.save(np.concatenate([self.load(), np.array(list(computed.values()), dtype=result_dtype)]))
+        return table
@@ -0,0 +1,53 @@
+from typing import List
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+
+@dataclass
+class LookupTable:
+    """
+    推定器を蒸留した参照テーブル（推定ごとに 値 × クラス）
+    """
+
+    heads: List[str]
+    values: List[np.ndarray]
+    table: List[np.ndarray]
+
+    def lookup(self, head: int, values, classes) -> np.ndarray:
+        values, classes = np.broadcast_arrays(
+            np.asarray(values, dtype=np.float32), np.asarray(classes, dtype=np.int64))
+        # スカラーも 1 次元にして引き、最後に元の形に戻す
+        shape = values.shape
+        values, classes = np.atleast_1d(values), np.atleast_1d(classes)
+        grid, table = self.values[head], self.table[head]
+
+        index = np.clip(np.searchsorted(grid, values), 0, len(grid) - 1)
+        exact = grid[index] == values
+        y = table[index, classes]
+
+        if not exact.all():
+            # 格子点にない値は、クラスごとに区分線形で補間する
+            for c in np.unique(classes[~exact]):
+                mask = ~exact & (classes == c)
+                y[mask] = np.interp(values[mask], grid, table[:, c])
+        return y.reshape(shape)
+
+    def save(self, path: Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        arrays = {}
+        for head, values, table in zip(self.heads, self.values, self.table):
+            arrays[head + '/values'] = values
+            arrays[head + '/table'] = table
+        with open(path, 'wb') as f:
+            np.savez(f, heads=np.array(self.heads), **arrays)
+
+    @classmethod
+    def load(cls, path: Path) -> 'LookupTable':
+        with np.load(path) as data:
+            heads = [str(h) for h in data['heads']]
+            return cls(heads=heads,
+                       values=[data[h + '/values'] for h in heads],
+                       table=[data[h + '/table'] for h in heads])
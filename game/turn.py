@@ -2,11 +2,12 @@ from enum import IntEnum
 from typing import List, Tuple, Optional
 from dataclasses import dataclass
 
-from . import logger
+from .event import events
+from .draws import draws
 from .unit import Unit
 from .team import Team
 from .gambit import Gambit
-from .command import Command, AttackCommand
+from .command import Command, AttackCommand, TargetTable
 from .log import TurnLog
 
 
@@ -16,12 +17,67 @@ class TurnResult(IntEnum):
     ESCAPED = 2
 
 
-@dataclass(frozen=True)
+class BattleState:
+    """
+    バトル中に使い回す状態（ユニット一覧、行動順、チームごとの生存ユニット、コマンド）
+    ユニット数が多くても 1 行動あたりの処理が全ユニット数に比例しないよう、
+    生存ユニットをチームごと・グループごとに索引しておく（コマンドの対象範囲はこの索引から作る）
+    """
+
+    __slots__ = ('teams', 'units', 'order', 'alive', 'table', 'members', 'n_alive',
+                 'n_team_alive', 'commands')
+
+    def __init__(self, teams: List[Team], commands: Optional[List[Command]] = None):
+        self.teams = teams
+        self.units: List[Unit] = [unit for team in teams for unit in team.units]
+        for index, unit in enumerate(self.units):
+            unit.index = index
+        self.order: List[Unit] = list(self.units)
+        self.alive: List[bool] = [False] * len(self.units)
+        n_team = max(team.id for team in teams) + 1
+        self.table = TargetTable(n_team)
+        self.members: List[List[Unit]] = self.table.members
+        self.n_alive: List[int] = [0] * n_team
+        self.n_team_alive = 0
+        self.commands: List[Command] = commands if commands is not None else [AttackCommand()]
+        for command in self.commands:
+            command.table = self.table
+        self.reset()
+
+    def reset(self):
+        # ユニットの HP から生存ユニットを数え直す
+        self.table.clear()
+        for unit in self.units:
+            self.alive[unit.index] = unit.life > 0
+            if unit.life > 0:
+                self.table.add(unit)
+        for team_id, members in enumerate(self.members):
+            self.n_alive[team_id] = len(members)
+        self.n_team_alive = sum(1 for n in self.n_alive if n > 0)
+
+    def update(self, targets: List[Unit]):
+        # 倒されたユニットを生存ユニットから除く
+        for target in targets:
+            if self.alive[target.index] and target.life <= 0:
+                self.alive[target.index] = False
+                self.table.remove(target)
+                self.n_alive[target.team] -= 1
+                if self.n_alive[target.team] == 0:
+                    self.n_team_alive -= 1
+
+    def has_adversary(self, team_id: int) -> bool:
+        # 生存しているチームの数だけで判定する（チーム数に依らない）
+        return self.n_team_alive > (1 if self.n_alive[team_id] > 0 else 0)
+
+
+@dataclass
 class Turn:
     """
     ターン
     """
 
+    __slots__ = ('id',)
+
     id: int
 
     def __lt__(self, other):
@@ -33,30 +89,41 @@ class Turn:
     def proceed(self,
                 teams: List[Team],
                 gambits: List[Gambit],
-                logs: List[TurnLog]
+                logs: List[TurnLog],
+                state: Optional[BattleState] = None
                 ) -> Tuple[TurnResult, Optional[Team]]:
         """
         ターンを進める
         """
+        if state is None:
+            state = BattleState(teams)
 
-        # 参加ユニットを求める
-        units: List[Unit] = [unit for team in teams for unit in team.units]
+        # 生存ユニットだけを、行動が早い順にソート（毎回元の並びから並べ替える）
+        # 倒されたユニットの分は乱数を引かず、TurnLog.order も生存ユニットの中での順位になる
+        # 乱数はまとめて引く（sort はキーを並び順に一度ずつ求めるので、
+        # Unit.calc_action_priority を順に呼ぶのと同じ値になる）
+        units = state.order
+        units[:] = [u for members in state.members for u in members]
+        variates = iter(draws.source.uniforms(len(units)))
+        units.sort(key=lambda u: u.speed * (0.5 + 0.5 * next(variates)), reverse=True)
 
-        # 行動が早い順にユニットソート
-        units.sort(key=Unit.calc_action_priority, reverse=True)
+        if events.listeners:
+            events.turn_start(self.id, units)
 
         for order, source in enumerate(units):
             # 行動可能かチェック
-            if not source.alive:
+            if source.life <= 0:
                 continue
 
-            commands: List[Command] = [AttackCommand()]
             gambit = gambits[source.team]
-            command, targets = gambit.select_command(source, units, commands)
+            command, targets = gambit.select_command(source, units, state.commands)
+            if events.listeners:
+                events.action(self.id, order, source, command, targets)
             command.do(self.id, order, source, targets, logs)
+            state.update(targets)
 
             # 戦闘終了の判定
-            if not any(filter(lambda u: source.can_attack(u), units)):
+            if not state.has_adversary(source.team):
                 return TurnResult.FINISHED, teams[source.team]
 
         return TurnResult.KEEPING, None
@@ -1,9 +1,8 @@
 from __future__ import annotations
 from typing import List, Tuple
 from dataclasses import dataclass, field
-import random
-
 from .status import Side, Status
+from .draws import draws
 
 
 @dataclass
@@ -12,44 +11,38 @@ class Unit:
     ユニット
     """
 
+    # ステータスはよく参照するので、属性として展開しておく
+    __slots__ = ('status', 'no', 'team', 'index', 'life', 'life_max',
+                 'id', 'side', 'attack', 'defence', 'speed')
+
     status: Status
-    no: int = field(init=False, default=0)
-    team: int = field(init=False, default=0)
-    life: int = field(init=False, default=0)
-    life_max: int = field(init=False, default=0)
 
     def __post_init__(self):
+        self.no = 0
+        self.team = 0
+        self.index = 0
+        self.id = self.status.id
+        self.side = self.status.side
+        self.attack = self.status.attack
+        self.defence = self.status.defence
+        self.speed = self.status.speed
         self.reset()
 
+    def __repr__(self):
+        return "Unit(status=%r, no=%d, team=%d, life=%d, life_max=%d)" % (
+            self.status, self.no, self.team, self.life, self.life_max)
+
     def __str__(self):
         return "%s:%d" % (self.status.name, self.team)
 
     def __eq__(self, other):
         return (other.team, other.no) == (self.team, self.no)
 
-    @property
-    def id(self) -> int:
-        return self.status.id
-
-    @property
-    def side(self) -> Side:
-        return self.status.side
-
-    @property
-    def attack(self) -> int:
-        return self.status.attack
-
-    @property
-    def defence(self) -> int:
-        return self.status.defence
-
-    @property
-    def speed(self) -> int:
-        return self.status.speed
-
     def reset(self):
+        # コマンドで変わった能力値を元に戻す
+        self.attack = self.status.attack
         if self.side == Side.MONSTER:
-            self.life_max = int(random.uniform(0.85, 1.0) * self.status.life)
+            self.life_max = int(draws.source.uniform(0.85, 1.0) * self.status.life)
         else:
             self.life_max = self.status.life
         self.life = self.life_max
@@ -73,5 +66,5 @@ class Unit:
 
     def calc_action_priority(self) -> float:
         # 行動の優先順位を求める
-        var = random.uniform(0.5, 1.0)
+        var = draws.source.uniform(0.5, 1.0)
         return self.speed * var
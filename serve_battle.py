@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import logging
+from functools import partial
+from pathlib import Path
+
+from game import logger
+from game.server import DecisionServer, DecisionClient, generate_load
+from game.gambit import Gambit, NaiveGambit, CunningGambit, MLbasedGambit
+
+
+def make_gambit(args) -> Gambit:
+    if args.gambit == 'MLbased':
+        if args.table is None:
+            # 参照テーブルを使わない場合だけ TensorFlow を読み込む
+            import tensorflow as tf
+            tf.logging.set_verbosity(tf.logging.ERROR)
+        return MLbasedGambit(embedding=args.embedding, multi_head=args.multi_head,
+                             table_path=args.table)
+    return {'Naive': NaiveGambit, 'Cunning': CunningGambit}[args.gambit]()
+
+
+def print_report(name: str, report: dict):
+    print("%-6s %8d requests %10.1f /s p50 %7.3f ms p99 %7.3f ms (mean batch %.1f)" % (
+        name, report['requests'], report['requests_per_sec'],
+        report['p50_ms'], report['p99_ms'], report['mean_batch']))
+
+
+async def load(args):
+    client_factory = partial(DecisionClient, args.host, args.port, args.unix)
+    report = await generate_load(client_factory, args.n_client, args.n_request, args.seed)
+    print_report('client', report)
+
+    client = client_factory()
+    await client.connect()
+    print_report('server', await client.stats())
+    await client.close()
+
+
+async def local(args):
+    # 同じプロセスでサーバーを立て、負荷をかけて計測する
+    server = DecisionServer(make_gambit(args), window=args.window, max_batch=args.max_batch,
+                            host=args.host, port=0 if args.unix is None else args.port,
+                            path=args.unix)
+    await server.start()
+    args.port = server.port
+    try:
+        await load(args)
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-q', '--quiet', action='count', default=0)
+    parser.add_argument('-g', '--gambit', action='store', default='Cunning',
+                        help='判断する作戦（Naive, Cunning, MLbased）')
+    parser.add_argument('-e', '--embedding', action='store_true', default=False)
+    parser.add_argument('-m', '--multi_head', action='store_true', default=False)
+    parser.add_argument('-t', '--table', action='store', type=Path, default=None)
+    parser.add_argument('--host', action='store', default='127.0.0.1')
+    parser.add_argument('--port', action='store', type=int, default=8765)
+    parser.add_argument('--unix', action='store', default=None,
+                        help='TCP の代わりに使う Unix ソケットのパス')
+    parser.add_argument('-w', '--window', action='store', type=float, default=0.002,
+                        help='リクエストをまとめる待ち時間（秒）')
+    parser.add_argument('--max_batch', action='store', type=int, default=256)
+    parser.add_argument('--load', action='store_true', default=False,
+                        help='起動中のサーバーに負荷をかけて計測する')
+    parser.add_argument('--local', action='store_true', default=False,
+                        help='同じプロセスでサーバーを立てて負荷をかける')
+    parser.add_argument('-c', '--n_client', action='store', type=int, default=16)
+    parser.add_argument('-n', '--n_request', action='store', type=int, default=1000,
+                        help='クライアントごとのリクエスト数')
+    parser.add_argument('-s', '--seed', action='store', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN + 10 * (args.quiet - args.verbose))
+
+    if args.load:
+        asyncio.run(load(args))
+    elif args.local:
+        asyncio.run(local(args))
+    else:
+        server = DecisionServer(make_gambit(args), window=args.window, max_batch=args.max_batch,
+                                host=args.host, port=args.port, path=args.unix)
+        asyncio.run(server.serve_forever())
@@ -0,0 +1,91 @@
+import argparse
+import logging
+from typing import Dict, List
+from functools import partial
+from pathlib import Path
+
+from game.sweep import Sweep, default_roster, grid_design, random_design
+from game.runner import GambitFactory
+from game.gambit import NaiveGambit, CunningGambit, MLbasedGambit
+
+
+def parse_values(text: str) -> List:
+    """
+    "60,70,80" や "60:80:5"（開始:終了:刻み、終了を含む）、
+    units の場合は "knight+archer+thief,knight+knight+thief" を候補の並びにする
+    """
+    if '+' in text:
+        return [v.split('+') for v in text.split(',')]
+    if ':' in text:
+        start, stop, *step = [int(v) for v in text.split(':')]
+        return list(range(start, stop + 1, step[0] if step else 1))
+    return [int(v) for v in text.split(',')]
+
+
+def model_files(table: Path) -> List[Path]:
+    # MLbased の結果が依存するファイル（参照テーブル、無ければ推定器ごとのモデル）
+    if table is not None:
+        return [table]
+    from game.estimator import Estimator
+    return [Estimator(head, 0).get_path() for head in MLbasedGambit.heads]
+
+
+def parse_params(items: List[str]) -> Dict[str, List]:
+    params = {}
+    for item in items:
+        name, _, values = item.partition('=')
+        params[name] = parse_values(values)
+    return params
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-q', '--quiet', action='count', default=0)
+    parser.add_argument('-d', '--debug', action='store_true', default=False)
+    parser.add_argument('-n', '--n_battle', action='store', type=int, default=10000)
+    parser.add_argument('-b', '--batch', action='store_true', default=False)
+    parser.add_argument('-j', '--n_worker', action='store', type=int, default=1)
+    parser.add_argument('-s', '--seed', action='store', type=int, default=0)
+    parser.add_argument('-t', '--table', action='store', type=Path, default=None)
+    parser.add_argument('-g', '--grid', action='append', default=[],
+                        help='NAME=VALUES の直積でスイープする（例 player.knight.attack=60:80:5）')
+    parser.add_argument('-r', '--random', action='append', default=[],
+                        help='NAME=LOW:HIGH の範囲から n_config 個の構成を無作為に選ぶ')
+    parser.add_argument('-c', '--n_config', action='store', type=int, default=100)
+    parser.add_argument('-a', '--gambits', action='store', default='Naive,Cunning',
+                        help='評価するプレイヤーの作戦（Naive, Cunning, MLbased）')
+    parser.add_argument('-o', '--output', action='store', type=Path, default=Path('sweep.npy'),
+                        help='結果の表（再実行時は、同じ条件の結果をここから読む）')
+    args = parser.parse_args()
+
+    dbg_format = '%(levelname)-8s %(module)-16s %(lineno)4s: %(message)s'
+    logging.basicConfig(
+        level=logging.WARN + 10 * (args.quiet - args.verbose),
+        format=dbg_format if args.debug else None
+    )
+
+    factories: Dict[str, GambitFactory] = {
+        'Naive': NaiveGambit,
+        'Cunning': CunningGambit,
+        'MLbased': partial(MLbasedGambit, table_path=args.table),
+    }
+    gambits = {name: factories[name] for name in args.gambits.split(',')}
+    files = {'MLbased': model_files(args.table)} if 'MLbased' in gambits else {}
+
+    base = default_roster()
+    if args.random:
+        ranges = {name: values if name.endswith('.units') else (min(values), max(values))
+                  for name, values in parse_params(args.random).items()}
+        configs = random_design(base, ranges, args.n_config, args.seed)
+    else:
+        configs = grid_design(base, parse_params(args.grid))
+
+    sweep = Sweep(gambits, model_files=files, n_battle=args.n_battle, seed=args.seed,
+                  batch=args.batch, n_worker=args.n_worker, path=args.output)
+    table = sweep.run(configs)
+
+    for row in table:
+        print("%4d %-8s %7.3f%% [%7.3f%%, %7.3f%%] %s" % (
+            row['config'], row['gambit'], 100.0 * row['win_rate'],
+            100.0 * row['low'], 100.0 * row['high'], row['params']))
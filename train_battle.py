@@ -1,7 +1,9 @@
 import argparse
 import logging
-from typing import List, Tuple, Counter as _Counter
+import sys
+from typing import List, Tuple, Union, Counter as _Counter
 from collections import Counter
+from pathlib import Path
 
 import numpy as np
 import tensorflow as tf
@@ -12,25 +14,105 @@ from game import logger
 from game.status import Side, Status, statuses
 from game.unit import Unit
 from game.team import Team
-from game.log import TurnLog
-from game.battle import Battle
+from game.log import TurnLogs
+from game.event import events, LoggingListener
+from game.logfile import TurnLogReader, TurnLogWriter
+from game.batch import BatchBattle
+from game.runner import BattleRunner, GambitFactory, battle_seed
 from game.gambit import Gambit, NaiveGambit, MLbasedGambit
+from game.online import OnlineTrainer, make_dataset
+from game.search import HyperparameterSearch, search_grid
 
 
 def simulate_battle(teams: List[Team],
-                    gambits: List[Gambit],
-                    n_battle: int = 1000
-                    ) -> Tuple[_Counter[int], List[TurnLog]]:
-    win: _Counter[int] = Counter()
-    logs: List[TurnLog] = []
+                    gambits: List[GambitFactory],
+                    n_battle: int = 1000,
+                    batch: bool = False,
+                    n_worker: int = 1,
+                    seed: int = 0,
+                    logs=None
+                    ) -> Tuple[_Counter[int], TurnLogs]:
+    # NumPy で一括シミュレーションする
+    if batch:
+        win: _Counter[int] = Counter()
+        if logs is None:
+            logs = TurnLogs()
+        result = BatchBattle(n_battle, seed).simulate(teams, [g() for g in gambits], logs)
+        win.update(result.tolist())
+        return win, logs
 
-    # バトルをシミュレーションする
-    for n in range(0, n_battle):
-        battle = Battle(n)
-        result = battle.simulate(teams, gambits, logs)
-        win[result] += 1
+    # バトルをプロセス並列でシミュレーション
+    runner = BattleRunner(teams, gambits, seed=seed, n_worker=n_worker)
+    return runner.run(n_battle, logs=logs)
 
-    return win, logs
+
+def train_online(teams: List[Team], gambits: List[GambitFactory], args):
+    """
+    シミュレーションのログが届くたびに推定器を更新し、学習中のモデルで戦わせて勝率を見る
+    """
+    ai = MLbasedGambit(is_training=True, embedding=args.embedding, multi_head=args.multi_head)
+    trainer = OnlineTrainer(ai, min_samples=args.min_samples,
+                            checkpoint_every=args.checkpoint_every,
+                            export_table=True, seed=args.seed)
+    if args.resume:
+        trainer.resume()
+
+    # 学習中の重みで行動する作戦（更新のたびに重みが差し替わる）
+    player = MLbasedGambit(is_training=True, embedding=args.embedding,
+                           multi_head=args.multi_head)
+    trainer.subscribe(player)
+
+    for round_id in range(args.online):
+        simulate_battle(teams, gambits, args.n_battle, args.batch,
+                        args.n_worker, battle_seed(args.seed, round_id), trainer)
+        trainer.update()
+
+        result = BatchBattle(args.n_battle, battle_seed(args.seed + 1, round_id)).simulate(
+            teams, [player, NaiveGambit()])
+        logger.info("Round %d: %d updates, loss %.5f, win rate %7.5f%%" % (
+            round_id + 1, trainer.n_update, trainer.losses[-1], 100.0 * np.mean(result == 0)))
+
+    trainer.checkpoint()
+
+
+def split_dataset(ai: MLbasedGambit, i: int, logs: Union[TurnLogs, TurnLogReader]):
+    """
+    チャンクごとに (Xv_train, Xv_test, c_train, c_test, y_train, y_test, ...) を返す
+    """
+    def split(chunk):
+        return train_test_split(*make_dataset(ai, i, chunk), test_size=0.125, random_state=2)
+
+    if isinstance(logs, TurnLogs):
+        return [split(logs)]
+
+    # ファイルから読む場合は、チャンク単位で都度メモリマップする
+    return (split(chunk) for chunk in logs)
+
+
+def search_architectures(logs: Union[TurnLogs, TurnLogReader], args):
+    """
+    同じログから作った学習データで、隠れ層とバッチサイズの組み合わせを並列に学習して比べる
+    """
+    ai = MLbasedGambit(is_training=True, embedding=args.embedding, multi_head=args.multi_head)
+    splits = {}
+    for i, reg in enumerate(ai.estimators):
+        # ファイルから読んだログは、チャンクごとの分割を一つにまとめる
+        parts = list(split_dataset(ai, i, logs))
+        split = [np.concatenate(arrays) for arrays in zip(*parts)]
+        splits[reg.name] = (tuple(split[0::2]), tuple(split[1::2]))
+
+    configs = search_grid([reg.name for reg in ai.estimators],
+                          args.hidden_layers or [(16, 8)], args.batch_sizes,
+                          embedding=args.embedding, max_epochs=args.max_epochs,
+                          patience=args.patience,
+                          heads=tuple(ai.heads) if args.multi_head else ())
+    search = HyperparameterSearch(ai.n_class, n_worker=args.n_worker, seed=args.seed,
+                                  path=args.search_cache)
+    table = search.run(splits, configs)
+    for row in np.sort(table, order=['head', 'val_loss']):
+        print("%-12s DNN-%-12s batch %4d  val_loss %10.5f  loss %10.5f  epochs %3d  %7.1f sec" % (
+            row['head'], row['hidden_layers'], row['batch_size'], row['val_loss'],
+            row['loss'], row['epochs'], row['seconds']))
 
 
 if __name__ == '__main__':
@@ -38,7 +120,33 @@ if __name__ == '__main__':
     parser.add_argument('-v', '--verbose', action='count', default=0)
     parser.add_argument('-q', '--quiet', action='count', default=0)
     parser.add_argument('-d', '--debug', action='store_true', default=False)
-    parser.add_argument('-n', '--n_battle', action='store', default=1000)
+    parser.add_argument('-n', '--n_battle', action='store', type=int, default=1000)
+    parser.add_argument('-b', '--batch', action='store_true', default=False)
+    parser.add_argument('-j', '--n_worker', action='store', type=int, default=1)
+    parser.add_argument('-s', '--seed', action='store', type=int, default=0)
+    parser.add_argument('-e', '--embedding', action='store_true', default=False)
+    parser.add_argument('-m', '--multi_head', action='store_true', default=False)
+    parser.add_argument('-l', '--log_dir', action='store', type=Path, default=None)
+    parser.add_argument('-o', '--online', action='store', type=int, default=0,
+                        help='オンライン学習のラウンド数（ラウンドごとに n_battle 回シミュレーションする）')
+    parser.add_argument('--min_samples', action='store', type=int, default=4096,
+                        help='オンライン学習で、更新までにためるログの数')
+    parser.add_argument('--checkpoint_every', action='store', type=int, default=10,
+                        help='オンライン学習で、モデルを保存する更新間隔')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='保存済みのモデルからオンライン学習を続ける')
+    parser.add_argument('--search', action='store_true', default=False,
+                        help='推定器の構成を探索する（結果は --search_cache に貯める）')
+    parser.add_argument('--hidden_layers', action='append', default=None,
+                        type=lambda s: tuple(int(x) for x in s.split(',')),
+                        help='探索する隠れ層（例 --hidden_layers 16,8 --hidden_layers 32,16,8）')
+    parser.add_argument('--batch_sizes', action='store', default=(128,),
+                        type=lambda s: tuple(int(x) for x in s.split(',')),
+                        help='探索するバッチサイズ（例 64,128,256）')
+    parser.add_argument('--max_epochs', action='store', type=int, default=50)
+    parser.add_argument('--patience', action='store', type=int, default=5,
+                        help='検証損失が改善しないまま何エポックで打ち切るか')
+    parser.add_argument('--search_cache', action='store', type=Path, default=Path('search.npy'))
     args = parser.parse_args()
 
     dbg_format = '%(levelname)-8s %(module)-16s %(lineno)4s: %(message)s'
@@ -46,6 +154,9 @@ if __name__ == '__main__':
         level=logging.WARN + 10 * (args.quiet - args.verbose),
         format=dbg_format if args.debug else None
     )
+    if logger.isEnabledFor(logging.DEBUG):
+        # バトルの経過はデバッグ時だけ出力する
+        events.attach(LoggingListener())
     tf.logging.set_verbosity(tf.logging.ERROR)
 
     teams: List[Team] = [
@@ -63,57 +174,85 @@ if __name__ == '__main__':
         ]),
     ]
 
-    gambits: List[Gambit] = [
+    gambits: List[GambitFactory] = [
         # プレイヤーの戦闘AI
-        NaiveGambit(),
+        NaiveGambit,
         # モンスターの戦闘AI
-        NaiveGambit(),
+        NaiveGambit,
     ]
 
-    # 1000回バトルをシミュレーションする
-    logger.info("# Simulation")
-    win, logs = simulate_battle(teams, gambits, args.n_battle)
+    if args.online > 0:
+        # オンライン学習（バッチ学習はしない）
+        train_online(teams, gambits, args)
+        sys.exit()
+
+    if TurnLogReader.exists(args.log_dir):
+        # 書き出し済みのログを再利用する
+        logger.info("# Load logs from %s" % args.log_dir)
+        logs = TurnLogReader(args.log_dir)
+    elif args.log_dir:
+        # ログをファイルへ書き出しながらシミュレーションする
+        logger.info("# Simulation")
+        with TurnLogWriter(args.log_dir) as writer:
+            simulate_battle(teams, gambits, args.n_battle, args.batch,
+                            args.n_worker, args.seed, writer)
+        logs = TurnLogReader(args.log_dir)
+    else:
+        # 1000回バトルをシミュレーションする
+        logger.info("# Simulation")
+        win, logs = simulate_battle(teams, gambits, args.n_battle, args.batch,
+                                    args.n_worker, args.seed)
+
+    if args.search:
+        # 構成の探索（モデルは保存しない）
+        logger.info("# Search")
+        search_architectures(logs, args)
+        sys.exit()
 
     # 学習を始める
     logger.info("# Training")
 
     EPOCHS = 50
     BATCH_SIZE = 128
+    SHUFFLE_BUFFER = 10000
 
-    ai = MLbasedGambit(is_training=True)
+    ai = MLbasedGambit(is_training=True, embedding=args.embedding,
+                       multi_head=args.multi_head)
     mb = master_bar(range(len(ai.estimators)))
     mb.names = [e.name for e in ai.estimators]
-    n_class = len(statuses[Side.MONSTER])
+    n_class = ai.n_class
     for i, reg in zip(mb, ai.estimators):
         logger.info('## Train %s %s' % (reg.name, reg.get_tag()))
 
-        if i == 0:  # 被ダメージ
-            _logs = list(filter(lambda l: l.target_side == Side.PLAYER, logs))
-            y = np.array([[log.damage] for log in _logs], dtype=np.float32)
-            Xv = np.array([[log.target_def] for log in _logs], dtype=np.float32)
-            Xc = np.array([ai.id2vec(log.source_id) for log in _logs], dtype=np.float32)
-        elif i == 1:  # 与ダメージ
-            _logs = list(filter(lambda l: l.source_side == Side.PLAYER, logs))
-            y = np.array([[log.damage] for log in _logs], dtype=np.float32)
-            Xv = np.array([[log.source_atk] for log in _logs], dtype=np.float32)
-            Xc = np.array([ai.id2vec(log.target_id) for log in _logs], dtype=np.float32)
-        elif i == 2:  # 最大HP
-            _logs = list(filter(lambda l: l.source_side == Side.PLAYER, logs))
-            y = np.array([[log.damage_cumsum] for log in _logs], dtype=np.float32)
-            Xv = np.array([[log.defeated] for log in _logs], dtype=np.float32)
-            Xc = np.array([ai.id2vec(log.target_id) for log in _logs], dtype=np.float32)
-
-        Xv_train, Xv_test, Xc_train, Xc_test, y_train, y_test = train_test_split(
-            Xv, Xc, y, test_size=0.125, random_state=2)
+        # メモリ上のログは分割結果を使い回し、ファイルは読むたびに分割する
+        splits = split_dataset(ai, i, logs) if isinstance(logs, TurnLogs) else None
+
+        def chunks():
+            return splits if splits is not None else split_dataset(ai, i, logs)
+
+        def train_source():
+            for split in chunks():
+                yield tuple(split[0::2])
+
+        def test_source():
+            for split in chunks():
+                yield tuple(split[1::2])
+
+        n_train, n_test = 0, 0
+        for split in chunks():
+            n_train += len(split[0])
+            n_test += len(split[1])
 
         losses = list()
         epochs = list()
-        for epoch in progress_bar(range(EPOCHS), parent=mb):
-            result = reg.model.fit([Xv_train, Xc_train], y_train,
-                                   batch_size=BATCH_SIZE,
-                                   epochs=1, verbose=0)
-            losses.append(result.history['loss'][0])
+        pb = progress_bar(range(EPOCHS), parent=mb)
+        # バーを反復しないので、開始時刻などを初期化しておく（update(0) は反復の最初に呼ばれる）
+        pb.update(0)
+
+        def on_epoch_end(epoch, history):
+            losses.append(history['loss'])
             epochs.append(epoch+1)
+            pb.update(epoch+1)
             graphs = [[epochs, losses]]
             x_bounds = [1, EPOCHS]
             y_bounds = [0, None]
@@ -121,9 +260,18 @@ if __name__ == '__main__':
             if epoch % 5 == 0:
                 logger.info('Epoch %i: %.5f MSE' % (epoch + 1, losses[-1]))
 
-        average_loss = reg.model.evaluate([Xv_test, Xc_test], y_test,
-                                          batch_size=BATCH_SIZE,
-                                          verbose=0)
+        reg.fit_stream(train_source, n_train, EPOCHS,
+                       batch_size=BATCH_SIZE,
+                       shuffle_buffer=SHUFFLE_BUFFER,
+                       callbacks=[tf.keras.callbacks.LambdaCallback(on_epoch_end=on_epoch_end)])
+
+        average_loss = reg.evaluate_stream(test_source, n_test, batch_size=BATCH_SIZE)
         logger.info('Average loss %f' % (average_loss,))
 
         reg.save_model()
+
+    # 推定器を参照テーブルに蒸留する
+    table_path = ai.estimators[0].get_dir() / 'table.npz'
+    logger.info('# Export lookup table to %s' % table_path)
+    ai.clear_cache()
+    ai.export_table(table_path)